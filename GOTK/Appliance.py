@@ -0,0 +1,117 @@
+import os
+from typing import Optional
+
+from Timer import Timer
+from PowerDetector import PowerDetector, PowerEdge
+from TimeSeriesStore import TimeSeriesStore, TimeSeriesWriter
+
+
+class Appliance:
+    """
+        State machine of one appliance (stove, oven, kettle, iron, ...) behind a power plug. Each appliance has its own power
+        store, power detector, Actuator Timer and Away Timer, so the appliances are guarded independently.
+
+        States:
+            IDLE        The appliance is not in use.
+            ON          The appliance is in use and the citizen is in the kitchen.
+            AWAY        The appliance is in use and the citizen has left the kitchen. The Away Timer escalates from Notify to
+                        Limit, where the system turns the plug off, and Upper, where it gives up and the appliance is IDLE.
+            SYSTEM_OFF  The system turned the plug off. It is turned on again when the citizen returns to the kitchen.
+
+        The Logic Controller performs the transitions and their side effects (commands, logs). The appliance only keeps its
+        state and tells when it needs attention next, see Next_Deadline().
+    """
+
+    IDLE = "IDLE"
+    ON = "ON"
+    AWAY = "AWAY"
+    SYSTEM_OFF = "SYSTEM_OFF"
+
+    POLL_PERIOD = 1     #Seconds between polls of the power detector while the power is low
+
+    def __init__(self, device_id: str, data_dir: str, power_writer: Optional[TimeSeriesWriter] = None):
+        self.device_id = device_id
+        self.State = self.IDLE
+        self.Away_State = "On"
+
+        #Last values reported by the plug
+        self.actuator_dict = {"State": None, "Power": None}
+
+        self.Power_Store = TimeSeriesStore(os.path.join(data_dir, "power", device_id), power_writer)
+        self.Power_Detector = PowerDetector(os.path.join(data_dir, "detector", f"{device_id}.json"))
+        self.clock_actuator = Timer()
+        self.clock_away = Timer()
+        self.__edge: Optional[PowerEdge] = None
+
+    @property
+    def In_Use(self) -> bool:
+        return self.State != self.IDLE
+
+    def Power_Report(self, timestamp: float, power: Optional[float], state: Optional[str]) -> Optional[PowerEdge]:
+        """
+            Records a report of the plug: updates the last values, stores the sample and feeds the power detector. Returns
+            the edge detected by the power detector, if any. An off edge of an appliance in use is also kept until Take_Edge()
+            is called.
+        """
+        power = power or 0
+        self.actuator_dict["State"] = state
+        self.actuator_dict["Power"] = power
+        self.Power_Store.Append(timestamp, power, state)
+
+        edge = self.Power_Detector.Update(timestamp, power)
+        if edge and edge.state == "OFF" and self.In_Use:
+            self.__edge = edge
+        return edge
+
+    def Take_Edge(self, now: float) -> Optional[PowerEdge]:
+        """
+            Returns the off edge detected since the last call, or polls the power detector for one.
+        """
+        edge, self.__edge = self.__edge, None
+        if edge is None and self.clock_actuator.Timer_Active:
+            edge = self.Power_Detector.Poll(now)
+        return edge
+
+    def Next_Deadline(self, now: float) -> Optional[float]:
+        """
+            Returns when the appliance needs attention next: the next Away Timer threshold, or the next poll of the power
+            detector while the power is low. None if it does not need attention until the next report.
+        """
+        deadlines = []
+        if self.__edge is not None:
+            deadlines.append(now)
+        if self.clock_actuator.Timer_Active and self.Power_Detector.Low:
+            deadlines.append(now + self.POLL_PERIOD)
+        if self.clock_away.Timer_Active:
+            threshold = self.clock_away.Next_Threshold()
+            if threshold is not None:
+                deadlines.append(threshold)
+        return min(deadlines, default=None)
+
+    def Checkpoint(self) -> dict:
+        """
+            Returns the state of the appliance for the controller's checkpoint. The timers are stored by their start times.
+        """
+        return {"State": self.State,
+                "Away_State": self.Away_State,
+                "actuator_dict": self.actuator_dict,
+                "Away_Start": self.clock_away.Start_Time if self.clock_away.Timer_Active else None,
+                "Actuator_Start": self.clock_actuator.Start_Time if self.clock_actuator.Timer_Active else None}
+
+    def Restore(self, checkpoint: dict, now: float) -> None:
+        """
+            Restores the state from a checkpoint. If the plug was on, the power detector expects its power within the
+            Actuator Period.
+        """
+        self.State = checkpoint["State"]
+        self.Away_State = checkpoint["Away_State"]
+        self.actuator_dict = checkpoint["actuator_dict"]
+
+        self.clock_away.Stop()
+        if checkpoint["Away_Start"] is not None:
+            self.clock_away.Start(checkpoint["Away_Start"])
+        self.clock_actuator.Stop()
+        if checkpoint["Actuator_Start"] is not None:
+            self.clock_actuator.Start(checkpoint["Actuator_Start"])
+            if self.actuator_dict.get("State") == "ON":
+                self.Power_Detector.Expect_On(now, self.clock_actuator.Actuator_Period)
@@ -0,0 +1,35 @@
+import os
+from typing import Optional
+
+
+class AtomicFile:
+    """
+        Helpers for small state files that must never be left half written, e.g. after a power cut on the Raspberry Pi.
+        The data is written to a temporary file next to the target, synced to disk, and renamed over the target.
+    """
+
+    @staticmethod
+    def Write(path: str, data: bytes) -> None:
+        """
+            Atomically replaces the contents of the file at path with data.
+        """
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def Read(path: str) -> Optional[bytes]:
+        """
+            Returns the contents of the file at path, or None if it does not exist.
+        """
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
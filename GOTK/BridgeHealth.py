@@ -0,0 +1,153 @@
+import random
+from typing import Dict, Optional
+
+
+class BridgeHealth:
+    """
+        Follows the health of the MQTT broker and the Zigbee2MQTT bridge from periodic health checks. The Z2M Client publishes
+        a request on bridge/request/health_check, and since it subscribes to that topic as well, the broker returns the request
+        to it. The returned request measures the round trip to the broker, and the bridge's answer on
+        bridge/response/health_check the round trip to the bridge.
+
+        The broker is stale when the client is disconnected or the request is not returned within CHECK_TIMEOUT, and the
+        bridge is stale when it reports that it is offline or does not answer within CHECK_TIMEOUT. An outage lasts from
+        the first of these until the bridge answers a health check again, and its length is the time to recover.
+
+        All times are monotonic timestamps given by the caller.
+    """
+
+    CHECK_PERIOD = 10       #Seconds between health checks
+    CHECK_TIMEOUT = 5       #Seconds to wait for the returned request and the bridge's answer
+    BACKOFF_BASE = 0.5      #Seconds before the first reconnect attempt
+    BACKOFF_MAX = 30        #Upper bound of the delay between reconnect attempts
+
+    def __init__(self):
+        self.connected = False
+        self.bridge_online: Optional[bool] = None
+        self.broker_rtt: Optional[float] = None
+        self.bridge_rtt: Optional[float] = None
+        self.outages = 0
+        self.time_to_recover: Optional[float] = None
+        self.max_time_to_recover = 0.0
+
+        self.__request_sent: Optional[float] = None
+        self.__request_returned = False
+        self.__next_check = 0.0
+        self.__attempts = 0
+        self.__outage_start: Optional[float] = None
+
+    @property
+    def Healthy(self) -> bool:
+        return self.connected and self.bridge_online is not False and self.__outage_start is None
+
+    @property
+    def Reachable(self) -> bool:
+        """
+            True unless the client is disconnected or the bridge has reported that it is offline. A health check that was
+            not answered is an outage, but does not make the bridge unreachable, since commands may still get through.
+        """
+        return self.connected and self.bridge_online is not False
+
+    def Check_Due(self, now: float) -> bool:
+        """
+            Returns True if a health check should be published now.
+        """
+        return self.connected and self.__request_sent is None and now >= self.__next_check
+
+    def Request_Sent(self, now: float) -> None:
+        self.__request_sent = now
+        self.__request_returned = False
+        self.__next_check = now + self.CHECK_PERIOD
+
+    def Request_Returned(self, now: float) -> None:
+        if self.__request_sent is not None and not self.__request_returned:
+            self.__request_returned = True
+            self.broker_rtt = now - self.__request_sent
+
+    def Response_Received(self, now: float, healthy: bool) -> Optional[float]:
+        """
+            Records the bridge's answer to the health check. Returns the time to recover if this answer ends an outage.
+        """
+        if self.__request_sent is None:
+            return None
+        self.bridge_rtt = now - self.__request_sent
+        self.__request_sent = None
+
+        if not healthy:
+            self.__begin_outage(now)
+            return None
+        self.bridge_online = True
+        return self.__end_outage(now)
+
+    def Bridge_State(self, now: float, online: bool) -> None:
+        """
+            Records the state published by the bridge on bridge/state.
+        """
+        self.bridge_online = online
+        if not online:
+            self.__begin_outage(now)
+        else:
+            #Check right away whether the bridge has recovered
+            self.__next_check = now
+
+    def Connected(self, now: float) -> None:
+        self.connected = True
+        self.__request_sent = None
+        self.__next_check = now
+
+    def Disconnected(self, now: float) -> None:
+        self.connected = False
+        self.__request_sent = None
+        self.__begin_outage(now)
+
+    def Closed(self) -> None:
+        """
+            Records that the client disconnected on purpose, which is not an outage.
+        """
+        self.connected = False
+        self.__request_sent = None
+
+    def Stale(self, now: float) -> Optional[str]:
+        """
+            Returns "broker" or "bridge" if the outstanding health check has timed out, otherwise None. A timed out check
+            is abandoned, so the next one is sent after CHECK_PERIOD.
+        """
+        if self.__request_sent is None or now - self.__request_sent < self.CHECK_TIMEOUT:
+            return None
+
+        stale = "bridge" if self.__request_returned else "broker"
+        self.__request_sent = None
+        self.__begin_outage(now)
+        return stale
+
+    def Next_Backoff(self) -> float:
+        """
+            Returns the delay before the next reconnect attempt: exponential back-off with jitter, so the delay is between
+            half and all of BACKOFF_BASE * 2^attempts, bounded by BACKOFF_MAX.
+        """
+        delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** self.__attempts)
+        self.__attempts += 1
+        return random.uniform(delay / 2, delay)
+
+    def Metrics(self) -> Dict[str, Optional[float]]:
+        def ms(seconds):
+            return round(seconds * 1000, 1) if seconds is not None else None
+
+        return {"connected": self.connected, "bridge_online": self.bridge_online,
+                "broker_rtt_ms": ms(self.broker_rtt), "bridge_rtt_ms": ms(self.bridge_rtt),
+                "outages": self.outages, "time_to_recover_ms": ms(self.time_to_recover),
+                "max_time_to_recover_ms": ms(self.max_time_to_recover)}
+
+    def __begin_outage(self, now: float) -> None:
+        if self.__outage_start is None:
+            self.__outage_start = now
+            self.outages += 1
+
+    def __end_outage(self, now: float) -> Optional[float]:
+        self.__attempts = 0
+        if self.__outage_start is None:
+            return None
+        self.time_to_recover = now - self.__outage_start
+        self.max_time_to_recover = max(self.max_time_to_recover, self.time_to_recover)
+        self.__outage_start = None
+        return self.time_to_recover
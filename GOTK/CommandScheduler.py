@@ -0,0 +1,160 @@
+import time
+from collections import OrderedDict
+from threading import Condition, Thread
+from typing import Callable, Dict, List, Optional
+
+
+class CommandScheduler:
+    """
+        Schedules the commands published to the devices within an airtime budget of COMMANDS_PER_SECOND, so a burst of light
+        commands does not congest the Zigbee mesh. The budget is a token bucket holding up to BURST commands.
+
+        Commands are kept per device, so a command that supersedes a pending command for the same device replaces it, and only
+        the latest command is published. Actuator commands have strict precedence: they are published before any pending light
+        command, and without waiting for the budget. They still use it, so the light commands after them are delayed instead.
+
+        A command that could not be published, e.g. while disconnected from the broker, is deferred and tried again after
+        RETRY_DELAY, unless a later command for the device supersedes it. The commands still pending when the scheduler is
+        stopped are tried once more, and dropped if they cannot be published.
+    """
+
+    ACTUATOR = 0
+    LIGHT = 1
+    LANE_NAMES = ("actuator", "light")
+
+    COMMANDS_PER_SECOND = 5.0
+    BURST = 5
+    RETRY_DELAY = 1.0       #Seconds before a command that could not be published is tried again
+
+    def __init__(self, publish: Callable[[str, bytes], bool], commands_per_second: float = COMMANDS_PER_SECOND,
+                 burst: int = BURST):
+        """
+            publish: Called from the scheduler thread with the device ID and payload of each command. Returns False if
+                     the command could not be published.
+        """
+        self.__publish = publish
+        self.rate = commands_per_second
+        self.burst = burst
+        self.__tokens = float(burst)
+        self.__refilled = time.monotonic()
+        self.__retry_at = 0.0
+
+        #Pending commands of each lane: device ID -> [payload, submit time, deferred]
+        self.__pending: List["OrderedDict[str, list]"] = [OrderedDict(), OrderedDict()]
+        self.__condition = Condition()
+        self.__running = False
+        self.__thread: Optional[Thread] = None
+
+        self.sent = [0, 0]
+        self.deferred = [0, 0]
+        self.dropped = [0, 0]
+        self.max_delay = [0.0, 0.0]
+
+    def Start(self) -> None:
+        with self.__condition:
+            if self.__running:
+                return
+            self.__running = True
+        self.__thread = Thread(target=self.__worker, name="Command scheduler", daemon=True)
+        self.__thread.start()
+
+    def Stop(self) -> None:
+        """
+            Stops the scheduler thread. The pending commands are published right away, actuator commands first.
+        """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+        for lane in (self.ACTUATOR, self.LIGHT):
+            while self.__pending[lane]:
+                self.__send(lane, *self.__pending[lane].popitem(last=False), retry=False)
+
+    def Submit(self, device_id: str, payload: bytes, lane: int = LIGHT) -> None:
+        """
+            Schedules a command. A pending command for the same device is superseded and dropped.
+        """
+        with self.__condition:
+            pending = self.__pending[lane]
+            if device_id in pending:
+                #Keeps the place in the queue of the superseded command
+                self.dropped[lane] += 1
+                pending[device_id][0] = payload
+            else:
+                pending[device_id] = [payload, time.monotonic(), False]
+            self.__condition.notify()
+
+    def Metrics(self) -> Dict[str, Dict[str, float]]:
+        with self.__condition:
+            return {name: {"sent": self.sent[lane], "deferred": self.deferred[lane], "dropped": self.dropped[lane],
+                           "pending": len(self.__pending[lane]), "max_delay_ms": round(self.max_delay[lane] * 1000, 1)}
+                    for lane, name in enumerate(self.LANE_NAMES)}
+
+    def __worker(self) -> None:
+        while True:
+            with self.__condition:
+                command = self.__next_command()
+                while command is None and self.__running:
+                    self.__condition.wait(self.__wait_time())
+                    command = self.__next_command()
+                if command is None:
+                    return
+
+            self.__send(*command)
+
+    def __next_command(self):
+        """
+            Returns the next command that may be published now as (lane, device ID, entry), or None.
+        """
+        now = time.monotonic()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__refilled) * self.rate)
+        self.__refilled = now
+
+        if now < self.__retry_at:
+            return None
+        if self.__pending[self.ACTUATOR]:
+            lane = self.ACTUATOR
+        elif self.__pending[self.LIGHT] and self.__tokens >= 1:
+            lane = self.LIGHT
+        else:
+            #The light command at the head waits for the budget
+            for entry in self.__pending[self.LIGHT].values():
+                if not entry[2]:
+                    entry[2] = True
+                    self.deferred[self.LIGHT] += 1
+                break
+            return None
+
+        self.__tokens -= 1
+        return (lane, *self.__pending[lane].popitem(last=False))
+
+    def __wait_time(self) -> Optional[float]:
+        now = time.monotonic()
+        if now < self.__retry_at and (self.__pending[self.ACTUATOR] or self.__pending[self.LIGHT]):
+            return self.__retry_at - now
+        if not self.__pending[self.LIGHT]:
+            return None
+        return max(0.001, (1 - self.__tokens) / self.rate)
+
+    def __send(self, lane: int, device_id: str, entry: list, retry: bool = True) -> None:
+        payload, submitted, deferred = entry
+        published = self.__publish(device_id, payload)
+
+        with self.__condition:
+            if published:
+                self.max_delay[lane] = max(self.max_delay[lane], time.monotonic() - submitted)
+                self.sent[lane] += 1
+            elif retry and device_id not in self.__pending[lane]:
+                #The command goes back to the head of its lane, and the lanes wait for RETRY_DELAY
+                if not deferred:
+                    entry[2] = True
+                    self.deferred[lane] += 1
+                self.__pending[lane][device_id] = entry
+                self.__pending[lane].move_to_end(device_id, last=False)
+                self.__retry_at = time.monotonic() + self.RETRY_DELAY
+            else:
+                #Superseded while it was being published, or the scheduler is stopping
+                self.dropped[lane] += 1
@@ -0,0 +1,104 @@
+import heapq
+import time
+from threading import Condition, Thread, current_thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class DeadlineScheduler:
+    """
+        Runs callbacks at deadlines from a single thread, so any number of timers share one thread instead of each polling
+        in its own loop. Every deadline has a key, and scheduling a key again replaces its deadline.
+
+        The deadlines are kept in a heap. A replaced or cancelled deadline stays in the heap and is skipped when it comes up,
+        so scheduling costs O(log n) in the number of deadlines.
+
+        The callback is called with the key and the current time (time.time()), and returns the key's next deadline, or
+        None if the key has no deadline any more.
+
+        The scheduler can be stopped from a callback and started again right away from another thread. The stopped thread
+        then ends after its callback, without handling any deadline of the new run, and Start() waits for it.
+    """
+
+    def __init__(self, callback: Callable[[str, float], Optional[float]]):
+        self.__callback = callback
+        self.__heap: List[Tuple[float, int, str]] = []
+        self.__deadlines: Dict[str, Tuple[float, int]] = {}
+        self.__sequence = 0
+        self.__condition = Condition()
+        self.__running = False
+        self.__generation = 0           #Incremented on every Start(), a thread only runs while its generation is current
+        self.__thread: Optional[Thread] = None
+        self.__stopped: Optional[Thread] = None
+
+    def Start(self) -> None:
+        with self.__condition:
+            if self.__running:
+                return
+            self.__running = True
+            self.__generation += 1
+            stopped, self.__stopped = self.__stopped, None
+            self.__thread = Thread(target=self.__worker, args=(self.__generation,), name="Deadline scheduler", daemon=True)
+        if stopped is not None and stopped is not current_thread():
+            stopped.join()
+        self.__thread.start()
+
+    def Stop(self) -> None:
+        """
+            Stops the thread and drops all deadlines. Can be called from a callback, in which case the thread ends after it.
+        """
+        with self.__condition:
+            self.__running = False
+            self.__heap.clear()
+            self.__deadlines.clear()
+            self.__condition.notify()
+            thread, self.__thread = self.__thread, None
+            if thread is current_thread():
+                self.__stopped = thread
+        if thread is not None and thread is not current_thread():
+            thread.join()
+
+    def Schedule(self, key: str, when: Optional[float]) -> None:
+        """
+            Sets the deadline of key, replacing its previous one. With when None the deadline is cancelled.
+        """
+        with self.__condition:
+            if when is None:
+                self.__deadlines.pop(key, None)
+                return
+            self.__sequence += 1
+            self.__deadlines[key] = (when, self.__sequence)
+            heapq.heappush(self.__heap, (when, self.__sequence, key))
+            if self.__heap[0][1] == self.__sequence:
+                self.__condition.notify()
+
+    def Deadline(self, key: str) -> Optional[float]:
+        with self.__condition:
+            deadline = self.__deadlines.get(key)
+            return deadline[0] if deadline else None
+
+    def __worker(self, generation: int) -> None:
+        while True:
+            with self.__condition:
+                key = None
+                while self.__running and self.__generation == generation and key is None:
+                    #Skip deadlines that were replaced or cancelled
+                    while self.__heap and self.__deadlines.get(self.__heap[0][2]) != self.__heap[0][:2]:
+                        heapq.heappop(self.__heap)
+                    if not self.__heap:
+                        self.__condition.wait()
+                        continue
+                    delay = self.__heap[0][0] - time.time()
+                    if delay > 0:
+                        self.__condition.wait(delay)
+                        continue
+                    _, _, key = heapq.heappop(self.__heap)
+                    del self.__deadlines[key]
+                if not self.__running or self.__generation != generation:
+                    return
+
+            next_deadline = self.__callback(key, time.time())
+            if next_deadline is not None:
+                with self.__condition:
+                    #A deadline set while the callback ran takes precedence
+                    if key not in self.__deadlines and self.__running and self.__generation == generation:
+                        self.Schedule(key, next_deadline)
@@ -5,11 +5,16 @@ from typing import List, Optional, Union
 class ZigbeeDevice:
     """ This class represents a Zigbee device. It has an ID and a type, both are strings which the 
     user can assign at its will. The id_ can be the device address or friendly name, and the type_ can be customized by the user.
+    The model_ and vendor_ of the hardware are optional, and are included in the logged events about the device.
+    blind_duration_ is the time in seconds a sensor is blind after a detection (HeucodEvent.sensor_blind_duration), for sensors.
     
     """
 
     id_: str
     type_: str
+    model_: Optional[str] = None
+    vendor_: Optional[str] = None
+    blind_duration_: Optional[int] = None
 
 class DeviceModel:
     """ The DeviceModel Class is responsible for representing and managing acces to data.
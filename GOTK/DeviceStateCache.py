@@ -0,0 +1,100 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from Z2M_Message import Z2M_Message
+
+
+@dataclass
+class DeviceState:
+    """ The last values reported by a device. A value that has never been reported is None. """
+
+    device_id: str
+    occupancy: Optional[bool] = None
+    state: Optional[str] = None
+    power: Optional[float] = None
+    brightness: Optional[int] = None
+    updated: float = 0.0
+
+
+#Called with the device id, the field, the old and the new value, and the time of the report
+ChangeCallback = Callable[[str, str, Any, Any, float], None]
+
+
+class DeviceStateCache:
+    """
+        Last-value cache of the state of every device, keyed by device id, updated from every Z2M_Message. Reads are a
+        dictionary lookup.
+
+        Updating compares each reported field with its cached value. Only the fields that changed are returned, and only
+        for those the subscribers are called, so logic can react to transitions (a sensor's occupancy or a plug's state
+        changing) instead of re-evaluating every repeated report. Subscribers are kept per field and device, so a report
+        only costs the lookups of its changed fields.
+
+        The cache is updated from one thread at a time (the idle mode client or the Z2M Client's worker). Subscribers are
+        called in that thread.
+    """
+
+    FIELDS = ("occupancy", "state", "power", "brightness")
+
+    def __init__(self):
+        self.__states: Dict[str, DeviceState] = {}
+        self.__subscribers: Dict[Tuple[str, Optional[str]], List[ChangeCallback]] = {}
+
+    def Get(self, device_id: str) -> Optional[DeviceState]:
+        return self.__states.get(device_id)
+
+    def Value(self, device_id: str, field: str, default: Any = None) -> Any:
+        state = self.__states.get(device_id)
+        value = getattr(state, field) if state is not None else None
+        return default if value is None else value
+
+    def Subscribe(self, field: str, callback: ChangeCallback, device_id: Optional[str] = None) -> None:
+        """
+            Calls callback when field changes, for the given device or, with None, for any device.
+        """
+        self.__subscribers.setdefault((field, device_id), []).append(callback)
+
+    def Unsubscribe(self, field: str, callback: ChangeCallback, device_id: Optional[str] = None) -> None:
+        callbacks = self.__subscribers.get((field, device_id), [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    def Forget(self, device_id: str) -> None:
+        """
+            Drops the cached state of a device, so its next report is a change of every reported field.
+        """
+        self.__states.pop(device_id, None)
+
+    def Update(self, device_id: str, timestamp: float, values: Dict[str, Any]) -> Set[str]:
+        """
+            Updates the cached state with the reported values (values that are None are not reported), calls the
+            subscribers of the fields that changed, and returns these fields.
+        """
+        state = self.__states.get(device_id)
+        if state is None:
+            state = self.__states[device_id] = DeviceState(device_id)
+        state.updated = timestamp
+
+        changed = set()
+        for field in self.FIELDS:
+            new = values.get(field)
+            if new is None:
+                continue
+            old = getattr(state, field)
+            if new == old:
+                continue
+            setattr(state, field, new)
+            changed.add(field)
+            for key in ((field, device_id), (field, None)):
+                for callback in self.__subscribers.get(key, ()):
+                    callback(device_id, field, old, new, timestamp)
+        return changed
+
+    def Update_Message(self, message: Z2M_Message) -> Set[str]:
+        """
+            Updates the cache from a device message (zigbee2mqtt/<device>). Other messages change nothing.
+        """
+        device_id = getattr(message, "source", None)
+        if device_id is None:
+            return set()
+        return self.Update(device_id, message.timeStamp, {field: getattr(message, field, None) for field in self.FIELDS})
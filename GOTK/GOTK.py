@@ -1,85 +1,156 @@
+import os
 import sys
 import time
-from LogicController import LogicController
-from DeviceModel import DeviceModel, ZigbeeDevice
-import json
+
+#Reference point for measuring the time to the first subscription
+STARTED = time.perf_counter()
+
+#Only what is needed to subscribe is imported here. The controller and its modules are imported once subscribed
 import paho.mqtt.client as mqtt
-from Logger import Logger
+import Settings
+from DeviceModel import DeviceModel, ZigbeeDevice
+from SystemLog import SystemLog
+from JsonCodec import JsonCodec
+from Z2M_Message import Z2M_Message
 
+log = SystemLog.get("Idle")
+
+KITCHEN_SENSOR = "Sensor 0"
 
 
-#Initializes and starts the logic controller which handles the logic when the stove is on
-def start_controller():
-    
-    controller.Start()
 
-    #Loop while the controller is running, when stove is not in use it exits this loop
-    while controller.Controller_Mode:
-        time.sleep(1)
+#Initializes and starts the logic controller which handles the logic when the stove is on. Resumes from a checkpoint if one is given.
+#Returns when no appliance is in use any more and the controller has gone idle
+def start_controller(checkpoint = None):
+    
+    if checkpoint is None:
+        controller.Start()
+    else:
+        controller.Resume(checkpoint)
+        log.info("Subscribed to all devices", time_to_first_subscription_ms=round((time.perf_counter() - STARTED) * 1000, 1))
 
-    #When stove is not in use and loop is exited, the system goes into idle mode again.
-    idle()
+    #Wait while the controller is running. Go_Idle wakes this up as soon as it has finished
+    controller.Wait_Idle()
 
-#Idle mode: Checks messages from kitchen sensor and actuator, if activity in kitchen and actuator detects power flow it starts the controller
+#Idle mode: Checks messages from kitchen sensor and power plugs, if activity in kitchen and a plug detects power flow it starts the controller
 def on_message(client, userdata, msg):
-    payload = json.loads(msg.payload.decode('utf-8'))
-    print(payload)
+    #With GOTK_CAPTURE=1 idle mode captures every message it receives, as the controller does
+    if controller.Capture is not None:
+        controller.Capture.Record(msg.topic, msg.payload, time.time())
+    
+    #Messages read together with the one that closed idle mode are left to the controller
+    if not client.is_connected():
+        return
+    
+    message = Z2M_Message(msg.topic, msg.payload)
+    log.debug("Idle message received", topic=msg.topic, payload=msg.payload)
+    
+    #The device state cache is kept up to date while idle as well, and tells which values changed
+    changed = controller.Device_States.Update_Message(message)
+    
+    #Power reports are passed to the appliance of the plug, which stores them and feeds its power detector while idle as well
+    appliance = controller.Appliances.get(getattr(message, "source", None))
+    if appliance is not None and message.power is not None:
+        appliance.Power_Report(message.timeStamp, message.power, message.state)
     
     #Check that there has been movement in kitchen before controller can be started again. 
-    if "occupancy" in payload and payload["occupancy"] == True:
-        #Ensures that actuator is on when citizen enters kitchen
-        client.kitchen_movement = True
-        client.publish(topic=f"zigbee2mqtt/Actuator/set", payload=json.dumps({"state": "ON"}))
-        client.unsubscribe("zigbee2mqtt/Sensor 0")
-        print("Client has entered kitchen - Actuator is turned on")
+    if "occupancy" in changed and message.occupancy == True:
+        #Ensures that the plugs are on when citizen enters kitchen
+        for device_id in controller.Appliances:
+            client.publish(topic=f"zigbee2mqtt/{device_id}/set", payload=JsonCodec.dumps({"state": "ON"}))
+        client.unsubscribe(f"zigbee2mqtt/{KITCHEN_SENSOR}")
+        log.info("Client has entered kitchen - Power plugs are turned on")
         
-    elif "power" in payload and payload["power"] >= 6 and client.kitchen_movement == True:
-        print("Stove has been turned on! Closing idle mode")
-        client.disconnect()
-        controller.System_Logger.logStoveOn()
-        #Assigns the received actuator values to the Actuator Dictionary, containing last detected actuator values.
-        controller.actuator_dict["State"] = payload["state"]
-        controller.actuator_dict["Power"] = payload["power"] 
-        controller.actuator_dict["PowerWasRegistered"] = True
+    elif appliance is not None and appliance.Power_Detector.State == "ON" and \
+            controller.Device_States.Value(KITCHEN_SENSOR, "occupancy") == True:
+        log.info("Appliance has been turned on! Closing idle mode", device=appliance.device_id, power=message.power)
         
-        print("Starting the Controller!")
-        start_controller()
+        #Idle mode returns when the client is disconnected, and the controller is started. It logs every appliance that is on
+        client.disconnect()
         
-#Idle mode for the system while the stove is not in use
-def idle(): 
-    print("Idle mode is now Active")
+#Connects the idle mode client to the broker of the controller, or the given one, and subscribes to the kitchen sensor and the power plugs
+def connect_idle(device_model, host = None, port = None):
     client = mqtt.Client()
-    client.kitchen_movement = False
     client.on_message = on_message
-    client.connect("localhost", 1883)
-    client.subscribe("zigbee2mqtt/Actuator")
-    client.subscribe("zigbee2mqtt/Sensor 0")
+    client.connect(host or controller.MQTT_BROKER_HOST, port or controller.MQTT_BROKER_PORT)
+    for device in device_model.actuators_list:
+        client.subscribe(f"zigbee2mqtt/{device.id_}")
+    client.subscribe(f"zigbee2mqtt/{KITCHEN_SENSOR}")
+    return client
+
+#Idle mode for the system while the stove is not in use. An already connected client can be given. Returns when an appliance has
+#been turned on with the citizen in the kitchen
+def idle(client = None): 
+    log.info("Idle mode is now Active")
+    if client is None:
+        client = connect_idle(device_model)
+    
+    #Movement in the kitchen is only counted from now on
+    controller.Device_States.Forget(KITCHEN_SENSOR)
+    
+    #The capture is stopped, and its messages written, when the controller disconnects, and runs again while idle
+    if controller.Capture is not None:
+        controller.Capture.Start()
     
     client.loop_forever()
-    print("now listening")
+
+#The system keeps going between idle mode and the controller, in this loop instead of the modes calling each other, so neither
+#the stack nor the threads grow with every cycle. If the gateway restarted while the controller was running, it resumes first
+def run(idle_client = None, checkpoint = None):
+    if checkpoint is not None:
+        start_controller(checkpoint)
+    while True:
+        idle(idle_client)
+        idle_client = None
+        log.info("Starting the Controller!")
+        start_controller()
+
+
+#Device model of the installation: the kitchen sensor (Sensor 0), a sensor and a bulb in each room, and the actuator
+def create_device_model():
+    device_model = DeviceModel()
+    device_model.add([ZigbeeDevice("Sensor 0", "pir", "RTCGQ11LM", "Aqara", 60),
+                      ZigbeeDevice("Sensor 1", "pir", "RTCGQ11LM", "Aqara", 60),
+                      ZigbeeDevice("Sensor 2", "pir", "RTCGQ11LM", "Aqara", 60),
+                      ZigbeeDevice("Sensor 3", "pir", "RTCGQ11LM", "Aqara", 60),
+                      ZigbeeDevice("Sensor 4", "pir", "RTCGQ11LM", "Aqara", 60),
+                      ZigbeeDevice("Bulb 1", "light", "LED1836G9", "IKEA"),
+                      ZigbeeDevice("Bulb 2", "light", "LED1836G9", "IKEA"),
+                      ZigbeeDevice("Bulb 3", "light", "LED1836G9", "IKEA"),
+                      ZigbeeDevice("Bulb 4", "light", "LED1836G9", "IKEA"),
+                      ZigbeeDevice("Actuator", "power plug", "07048L", "Immax")])
+    return device_model
 
 
 #Main Initializing device model and starts idle mode
 if __name__ == "__main__":
     #Server Host Address given as argument when running the python script
     ServerHost = sys.argv[1]
+    SystemLog.Configure()
+    
+    #Subscribe to the kitchen sensor and power plugs before the controller is imported and set up. The subscriptions are active
+    #at the broker right away, and the messages wait on the connection until idle mode starts its loop
+    device_model = create_device_model()
+    idle_client = connect_idle(device_model, Settings.MQTT_BROKER_HOST, Settings.MQTT_BROKER_PORT)
+    log.info("Subscribed to kitchen sensor and power plugs", time_to_first_subscription_ms=round((time.perf_counter() - STARTED) * 1000, 1))
+    
+    from LogicController import LogicController
+    from SamplingProfiler import SamplingProfiler
+    
+    #When resuming from a checkpoint the controller subscribes itself, and the idle mode client is not needed
+    checkpoint = LogicController.Load_Checkpoint()
+    if checkpoint is not None:
+        idle_client.disconnect()
+        idle_client = None
     
-    device_model = DeviceModel()
-    device_model.add([ZigbeeDevice("Sensor 0", "pir"),
-                      ZigbeeDevice("Sensor 1", "pir"),
-                      ZigbeeDevice("Sensor 2", "pir"),
-                      ZigbeeDevice("Sensor 3", "pir"),
-                      ZigbeeDevice("Sensor 4", "pir"),
-                      ZigbeeDevice("Bulb 1", "light"),
-                      ZigbeeDevice("Bulb 2", "light"),
-                      ZigbeeDevice("Bulb 3", "light"),
-                      ZigbeeDevice("Bulb 4", "light"),
-                      ZigbeeDevice("Actuator", "power plug")])
     controller = LogicController(device_model=device_model, ServerHost=ServerHost)
     
-    print("------------- SYSTEM ACTIVATED --------------")
-
-    idle()
+    #A profile of all threads can be taken while the system runs, with kill -USR2 or python3 SamplingProfiler.py start
+    SamplingProfiler(os.path.join(LogicController.DATA_DIR, "profiles")).Install()
     
-    #System should keep running going between the idle and controller mode
+    log.info("------------- SYSTEM ACTIVATED --------------")
+
+    #If the gateway restarted while the controller was running, resume straight into controller mode. The system keeps going
+    #between idle mode and the controller
+    run(idle_client, checkpoint)
 
@@ -0,0 +1,64 @@
+import os
+import re
+import sys
+import subprocess
+from typing import List, Tuple
+
+#Modules imported before the first subscription, the controller imported right after it, and the modules deferred until
+#they are needed
+STARTUP_MODULES = ["paho.mqtt.client", "Settings", "SystemLog", "DeviceModel", "Z2M_Message"]
+CONTROLLER_MODULES = ["LogicController"]
+DEFERRED_MODULES = ["requests", "heucod"]
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_times(module: str) -> List[Tuple[str, int, int, int]]:
+    """
+        Imports module in a fresh interpreter with -X importtime, and returns (name, self us, cumulative us, depth)
+        for every module it imported.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if result.returncode != 0:
+        return []
+
+    times = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            times.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return times
+
+
+def report(modules: List[str], top: int) -> None:
+    """
+        Prints the cumulative import time of each module, and the slowest modules it pulls in.
+    """
+    for module in modules:
+        times = import_times(module)
+        if not times:
+            print(f"{module:<20} not importable")
+            continue
+
+        #-X importtime lists the imports of a module before the module itself, so its direct imports are the depth 1
+        #entries between the previous top-level entry and the module
+        end = max(i for i, t in enumerate(times) if t[0] == module and t[3] == 0)
+        start = max((i for i, t in enumerate(times[:end]) if t[3] == 0), default=-1) + 1
+        print(f"{module:<20} {times[end][2] / 1000:8.1f} ms")
+        for name, _, cumulative, depth in sorted((t for t in times[start:end] if t[3] == 1), key=lambda t: -t[2])[:top]:
+            print(f"    {name:<30} {cumulative / 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    #Prints the import-time report, e.g. python3 ImportReport.py, or python3 ImportReport.py <module> ...
+    top = 5
+    if len(sys.argv) > 1:
+        report(sys.argv[1:], top)
+    else:
+        print("Imported before the first subscription:")
+        report(STARTUP_MODULES, top)
+        print("\nImported after the first subscription:")
+        report(CONTROLLER_MODULES, top)
+        print("\nDeferred until the first event is logged:")
+        report(DEFERRED_MODULES, top)
@@ -0,0 +1,90 @@
+import os
+import json
+from typing import Any, Callable, Dict, Tuple, Union
+
+
+def _stdlib_backend() -> Tuple[Callable[[Union[bytes, str]], Any], Callable[[Any], bytes]]:
+    #Zigbee2MQTT payloads are UTF-8, so bytes are decoded directly instead of letting json.loads detect the encoding.
+    #The decoder and encoder are created once, instead of on every call with non-default arguments.
+    decode = json.JSONDecoder().decode
+    encode = json.JSONEncoder(separators=(",", ":")).encode
+
+    def loads(data: Union[bytes, str]) -> Any:
+        return decode(data.decode("utf-8") if isinstance(data, (bytes, bytearray)) else data)
+
+    return loads, lambda obj: encode(obj).encode("utf-8")
+
+
+def _orjson_backend():
+    import orjson
+    return orjson.loads, orjson.dumps
+
+
+def _ujson_backend():
+    import ujson
+    return ujson.loads, lambda obj: ujson.dumps(obj).encode("utf-8")
+
+
+class JsonCodec:
+    """
+        The JSON codec used for all MQTT payloads, HTTP logs and local state files. It takes the payload bytes directly,
+        so callers never decode them to a str first (orjson parses the bytes as they are), and always encodes to bytes,
+        which is what paho and requests send anyway.
+
+        The backend is selected at runtime: orjson or ujson if they are installed, otherwise the standard library. A
+        specific backend can be chosen with the environment variable GOTK_JSON ("orjson", "ujson" or "json") or Use().
+    """
+
+    BACKENDS: Dict[str, Callable] = {"orjson": _orjson_backend, "ujson": _ujson_backend, "json": _stdlib_backend}
+    PREFERENCE = ("orjson", "ujson", "json")
+
+    backend = "json"
+    loads, dumps = map(staticmethod, _stdlib_backend())
+
+    @classmethod
+    def Use(cls, backend: str = "auto") -> str:
+        """
+            Selects the backend. With "auto" the fastest installed backend is used. Returns the name of the selected
+            backend. An explicitly requested backend that is not installed falls back to the standard library.
+        """
+        candidates = cls.PREFERENCE if backend == "auto" else (backend, "json")
+        for name in candidates:
+            try:
+                loads, dumps = cls.BACKENDS[name]()
+            except (ImportError, KeyError):
+                continue
+            cls.backend = name
+            cls.loads, cls.dumps = staticmethod(loads), staticmethod(dumps)
+            break
+        return cls.backend
+
+
+JsonCodec.Use(os.environ.get("GOTK_JSON", "auto"))
+
+
+if __name__ == "__main__":
+    #Benchmarks the per-message cost of the old decode + json.loads / json.dumps path against each installed backend
+    import timeit
+
+    sensor = b'{"battery":100,"device_temperature":27,"illuminance":9,"illuminance_lux":9,"linkquality":144,' \
+             b'"occupancy":true,"power_outage_count":2,"voltage":3005}'
+    plug = b'{"current":0.05,"energy":1.24,"linkquality":120,"power":12.3,"state":"ON","voltage":231}'
+    light = {"brightness": 5, "effect": "breathe"}
+    runs = 100000
+
+    def per_call(statement) -> float:
+        return min(timeit.repeat(statement, number=runs, repeat=3)) / runs * 1e6
+
+    baseline_decode = per_call(lambda: (json.loads(sensor.decode("utf-8")), json.loads(plug.decode("utf-8"))))
+    baseline_encode = per_call(lambda: json.dumps(light))
+    print(f"{'stdlib, decode + loads/dumps':<30} parse {baseline_decode:6.2f} us  encode {baseline_encode:6.2f} us")
+
+    for name in JsonCodec.PREFERENCE:
+        if JsonCodec.Use(name) != name:
+            continue
+        decode = per_call(lambda: (JsonCodec.loads(sensor), JsonCodec.loads(plug)))
+        encode = per_call(lambda: JsonCodec.dumps(light))
+        print(f"{'JsonCodec ' + name:<30} parse {decode:6.2f} us  encode {encode:6.2f} us")
+
+    cached = {"Notify": JsonCodec.dumps(light)}
+    print(f"{'cached light payload':<30} {'':>16}  encode {per_call(lambda: cached['Notify']):6.2f} us")
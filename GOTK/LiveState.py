@@ -0,0 +1,172 @@
+import os
+import mmap
+import math
+import struct
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from Appliance import Appliance
+from SystemLog import SystemLog
+
+log = SystemLog.get("LiveState")
+
+
+class LiveState:
+    """
+        Fixed-layout binary snapshot of the controller state in a memory-mapped file in shared memory (/dev/shm), so local
+        dashboards and watchdogs can poll whether an appliance is on, which rooms are occupied and how long the Away Timers
+        have run, without MQTT or parsing.
+
+        The snapshot is protected by a sequence counter (seqlock). The writer makes the counter odd, writes the snapshot and
+        makes it even again, and a reader retries while the counter is odd or changed while it copied the snapshot. The
+        writer never waits for the readers, and a snapshot equal to the previous one is not written at all.
+
+        Layout, little endian:
+            HEADER      sequence (u64), layout version (u16), mode (u8, 0 idle, 1 controller), in kitchen (u8), away
+                        state (u8, index in AWAY_STATES), number of appliances (u8), 2 padding bytes, occupancy bitmask
+                        (u32, bit i is room i, MAX_ROOMS rooms), 4 padding bytes, time written (f64)
+            SLOT        per appliance (MAX_APPLIANCES): device id, state (index in STATES), plug state (index in
+                        PLUG_STATES), power, Actuator Timer start, Away Timer start, next Away Timer threshold. Times
+                        are seconds since the epoch, NaN when the timer is not running.
+    """
+
+    VERSION = 2
+    MAX_APPLIANCES = 8
+    MAX_ROOMS = 32
+    SEQUENCE = struct.Struct("<Q")
+    HEADER = struct.Struct("<QHBBBB2xI4xd")
+    STATE = struct.Struct("<HBBBB2xI")      #The header without the sequence and the time written
+    SLOT = struct.Struct("<16sBB2xfddd")
+    SIZE = HEADER.size + MAX_APPLIANCES * SLOT.size
+
+    AWAY_STATES = ["On", "Notify", "Limit", "Upper"]
+    STATES = [Appliance.IDLE, Appliance.ON, Appliance.AWAY, Appliance.SYSTEM_OFF]
+    PLUG_STATES = [None, "ON", "OFF"]
+    DEFAULT_PATH = "/dev/shm/gotk-state" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "gotk-state")
+
+    def __init__(self, rooms: List[str], path: str = DEFAULT_PATH):
+        """
+            rooms: The rooms, whose index in the list is their bit in the occupancy bitmask. At most MAX_ROOMS.
+        """
+        if len(rooms) > self.MAX_ROOMS:
+            raise ValueError(f"The live state holds at most {self.MAX_ROOMS} rooms, not {len(rooms)}")
+        self.rooms = rooms
+        self.path = path
+        self.__bits = {room: 1 << i for i, room in enumerate(rooms)}
+        self.__sequence = 0
+        self.__last = b""
+        self.__truncated = False
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, self.SIZE)
+            self.__map = mmap.mmap(fd, self.SIZE)
+        finally:
+            os.close(fd)
+
+    def Publish(self, mode: bool, in_kitchen: bool, away_state: str, room_occupancy: Dict[str, Optional[bool]],
+                appliances: List[Appliance]) -> None:
+        """
+            Writes the snapshot, unless it equals the previous one. Only the first MAX_APPLIANCES appliances are included.
+        """
+        occupancy = 0
+        for room, occupied in room_occupancy.items():
+            if occupied:
+                occupancy |= self.__bits.get(room, 0)
+
+        if len(appliances) > self.MAX_APPLIANCES and not self.__truncated:
+            self.__truncated = True
+            log.warning("Only the first appliances are in the live state", appliances=len(appliances),
+                        max_appliances=self.MAX_APPLIANCES)
+        appliances = appliances[:self.MAX_APPLIANCES]
+        body = bytearray(self.SIZE - self.SEQUENCE.size)
+        for i, appliance in enumerate(appliances):
+            away_active = appliance.clock_away.Timer_Active
+            self.SLOT.pack_into(body, self.HEADER.size - self.SEQUENCE.size + i * self.SLOT.size,
+                                appliance.device_id.encode("utf-8")[:16],
+                                self.STATES.index(appliance.State),
+                                self.PLUG_STATES.index(appliance.actuator_dict["State"]) if appliance.actuator_dict["State"] in self.PLUG_STATES else 0,
+                                appliance.actuator_dict["Power"] or 0.0,
+                                appliance.clock_actuator.Start_Time if appliance.clock_actuator.Timer_Active else math.nan,
+                                appliance.clock_away.Start_Time if away_active else math.nan,
+                                (appliance.clock_away.Next_Threshold() or math.nan) if away_active else math.nan)
+        #The header without the sequence and the time written, which only change when something else does
+        state = self.STATE.pack(self.VERSION, int(mode), int(bool(in_kitchen)),
+                                self.AWAY_STATES.index(away_state) if away_state in self.AWAY_STATES else 0, len(appliances), occupancy)
+        if state + body == self.__last:
+            return
+        self.__last = state + body
+        body[:len(state)] = state
+        struct.pack_into("<d", body, self.HEADER.size - self.SEQUENCE.size - 8, time.time())
+
+        self.__sequence += 1
+        self.SEQUENCE.pack_into(self.__map, 0, self.__sequence * 2 - 1)
+        self.__map[self.SEQUENCE.size:] = body
+        self.SEQUENCE.pack_into(self.__map, 0, self.__sequence * 2)
+
+    def Close(self) -> None:
+        self.__map.close()
+
+
+class LiveStateReader:
+    """
+        Reads the snapshots written by LiveState from another process.
+    """
+
+    def __init__(self, path: str = LiveState.DEFAULT_PATH):
+        with open(path, "rb") as f:
+            self.__map = mmap.mmap(f.fileno(), LiveState.SIZE, access=mmap.ACCESS_READ)
+        self.retries = 0
+
+    def Read_Raw(self) -> bytes:
+        """
+            Returns a consistent copy of the snapshot, retrying while it is being written.
+        """
+        while True:
+            before = LiveState.SEQUENCE.unpack_from(self.__map, 0)[0]
+            if before % 2 == 0:
+                data = self.__map[:LiveState.SIZE]
+                if LiveState.SEQUENCE.unpack_from(data, 0)[0] == before and \
+                        LiveState.SEQUENCE.unpack_from(self.__map, 0)[0] == before:
+                    return data
+            self.retries += 1
+
+    def Read(self) -> dict:
+        """
+            Returns the snapshot decoded as a dictionary.
+        """
+        data = self.Read_Raw()
+        sequence, version, mode, in_kitchen, away_state, count, occupancy, written = LiveState.HEADER.unpack_from(data)
+        appliances = {}
+        for i in range(count):
+            device_id, state, plug_state, power, actuator_start, away_start, next_threshold = \
+                LiveState.SLOT.unpack_from(data, LiveState.HEADER.size + i * LiveState.SLOT.size)
+            appliances[device_id.rstrip(b"\0").decode("utf-8")] = {
+                "state": LiveState.STATES[state], "plug_state": LiveState.PLUG_STATES[plug_state], "power": round(power, 1),
+                "actuator_start": None if math.isnan(actuator_start) else actuator_start,
+                "away_start": None if math.isnan(away_start) else away_start,
+                "next_threshold": None if math.isnan(next_threshold) else next_threshold}
+        return {"sequence": sequence // 2, "version": version, "controller_mode": bool(mode), "in_kitchen": bool(in_kitchen),
+                "away_state": LiveState.AWAY_STATES[away_state], "occupancy": occupancy, "written": written,
+                "appliances": appliances}
+
+    def Close(self) -> None:
+        self.__map.close()
+
+
+if __name__ == "__main__":
+    #Prints the live state of the running controller, e.g. python3 LiveState.py, or measures the read rate with --rate
+    import sys
+
+    paths = [arg for arg in sys.argv[1:] if arg != "--rate"]
+    reader = LiveStateReader(paths[0] if paths else LiveState.DEFAULT_PATH)
+    if "--rate" in sys.argv:
+        started, reads = time.perf_counter(), 0
+        while time.perf_counter() - started < 1:
+            reader.Read_Raw()
+            reads += 1
+        print(f"{reads} reads/s, {reader.retries} retries")
+    else:
+        for key, value in reader.Read().items():
+            print(f"{key:<16} {value}")
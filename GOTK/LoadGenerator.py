@@ -0,0 +1,269 @@
+import heapq
+import random
+import time
+from http.server import BaseHTTPRequestHandler
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional
+
+from JsonCodec import JsonCodec
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class LogSink(BaseHTTPRequestHandler):
+    """ Stand-in for the HEUCOD log server, which accepts and discards the logged events. """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LoadGenerator:
+    """
+        Impersonates Zigbee2MQTT to load the controller. It publishes occupancy reports of sensors that are not in the device
+        model ("Sensor 5" and up), so they pass through the Z2M Client and the controller without changing its state, and
+        power reports of the actuator that keep the stove on. It answers the bridge health checks as well.
+
+        The response time of the controller is measured with probes: the citizen goes from the kitchen to Room 1 and back, and
+        the time from the kitchen sensor reporting occupancy until the first light is turned off (Kitchen_Entered) is the
+        end-to-end latency, including the time in the event queue behind the generated load.
+
+        The controller's queues are sampled with the stats callback (LogicController.Stats) to report their growth.
+    """
+
+    KITCHEN_SENSOR = "Sensor 0"
+    ROOM_SENSOR = "Sensor 1"
+    FIRST_LOAD_SENSOR = 5
+    PROBE_GAP = 0.5             #Seconds between leaving and entering the kitchen in a probe
+    SAMPLE_PERIOD = 0.5         #Seconds between samples of the controller's queues
+    HEALTH_REQUEST_TOPIC = "zigbee2mqtt/bridge/request/health_check"
+    HEALTH_RESPONSE = b'{"data":{"healthy":true},"status":"ok"}'
+
+    SENSOR_PAYLOAD = {"battery": 100, "device_temperature": 27, "illuminance": 9, "illuminance_lux": 9,
+                      "linkquality": 144, "occupancy": True, "power_outage_count": 2, "voltage": 3005}
+    ACTUATOR_PAYLOAD = {"current": 5.2, "energy": 1.24, "linkquality": 120, "power": 1200.0, "state": "ON", "voltage": 231}
+
+    def __init__(self, host: str, port: int, sensors: int = 200, sensor_rate: float = 1.0, power_rate: float = 10.0,
+                 probe_period: float = 2.0):
+        """
+            sensors: Number of simulated sensors, each reporting sensor_rate times per second.
+            power_rate: Power reports per second of the actuator.
+            probe_period: Seconds between latency probes.
+        """
+        self.host = host
+        self.port = port
+        self.sensors = sensors
+        self.sensor_rate = sensor_rate
+        self.power_rate = power_rate
+        self.probe_period = probe_period
+
+        self.published = 0
+        self.commands: Dict[str, int] = {}
+        self.latencies: List[float] = []
+        self.missed_probes = 0
+        self.depths: List[tuple] = []
+
+        self.__probe_sent: Optional[float] = None
+        self.__probe_lock = Lock()
+        self.__stop = Event()
+
+    def Run(self, duration: float, stats: Optional[Callable[[], dict]] = None) -> Dict[str, float]:
+        """
+            Generates load for duration seconds and returns the report.
+        """
+        from paho.mqtt.client import Client as MqttClient
+
+        publisher = MqttClient()
+        publisher.connect(self.host, self.port)
+        publisher.loop_start()
+
+        recorder = MqttClient()
+        recorder.on_message = self.__on_command
+        recorder.connect(self.host, self.port)
+        recorder.subscribe("zigbee2mqtt/+/set")
+        recorder.subscribe(self.HEALTH_REQUEST_TOPIC)
+        recorder.loop_start()
+
+        threads = [Thread(target=self.__publish_load, args=(publisher,)),
+                   Thread(target=self.__probe, args=(publisher,))]
+        if stats is not None:
+            threads.append(Thread(target=self.__sample, args=(stats,)))
+
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        self.__stop.wait(duration)
+        self.__stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        #Let the controller drain what it has received before the final sample
+        time.sleep(self.SAMPLE_PERIOD)
+        final = stats() if stats is not None else None
+        for client in (publisher, recorder):
+            client.loop_stop()
+            client.disconnect()
+
+        return self.__report(elapsed, final)
+
+    def __publish_load(self, client) -> None:
+        """
+            Publishes the sensor and actuator reports at their rates. Each device has its own schedule, and the devices
+            start at random offsets so the reports are spread out.
+        """
+        now = time.monotonic()
+        schedule = [(now + random.random() / self.sensor_rate, f"Sensor {i}", 1 / self.sensor_rate)
+                    for i in range(self.FIRST_LOAD_SENSOR, self.FIRST_LOAD_SENSOR + self.sensors)]
+        if self.power_rate > 0:
+            schedule.append((now, "Actuator", 1 / self.power_rate))
+        heapq.heapify(schedule)
+
+        sensor, actuator = dict(self.SENSOR_PAYLOAD), dict(self.ACTUATOR_PAYLOAD)
+        while not self.__stop.is_set() and schedule:
+            due, device, period = schedule[0]
+            delay = due - time.monotonic()
+            if delay > 0 and self.__stop.wait(delay):
+                break
+
+            if device == "Actuator":
+                actuator["power"] = round(random.gauss(1200, 40), 1)
+                payload = JsonCodec.dumps(actuator)
+            else:
+                sensor["occupancy"] = random.random() < 0.5
+                payload = JsonCodec.dumps(sensor)
+            client.publish(f"zigbee2mqtt/{device}", payload)
+            self.published += 1
+            heapq.heapreplace(schedule, (due + period, device, period))
+
+    def __probe(self, client) -> None:
+        while not self.__stop.wait(self.probe_period - self.PROBE_GAP):
+            #Leave the kitchen for Room 1
+            client.publish(f"zigbee2mqtt/{self.ROOM_SENSOR}", JsonCodec.dumps({"occupancy": True}))
+            client.publish(f"zigbee2mqtt/{self.KITCHEN_SENSOR}", JsonCodec.dumps({"occupancy": False}))
+            if self.__stop.wait(self.PROBE_GAP):
+                break
+
+            #A probe that has not been answered since the last one is missed
+            with self.__probe_lock:
+                if self.__probe_sent is not None:
+                    self.missed_probes += 1
+                self.__probe_sent = time.monotonic()
+            client.publish(f"zigbee2mqtt/{self.KITCHEN_SENSOR}", JsonCodec.dumps({"occupancy": True}))
+
+    def __on_command(self, client, userdata, message) -> None:
+        received = time.monotonic()
+        if message.topic == self.HEALTH_REQUEST_TOPIC:
+            #Answer the health checks as the bridge does
+            client.publish("zigbee2mqtt/bridge/response/health_check", self.HEALTH_RESPONSE)
+            return
+        
+        device = message.topic.split("/")[1]
+        self.commands[device] = self.commands.get(device, 0) + 1
+
+        #The lights are turned off (brightness 0) when the kitchen is entered
+        if device.startswith("Bulb") and JsonCodec.loads(message.payload).get("brightness") == 0:
+            with self.__probe_lock:
+                if self.__probe_sent is not None:
+                    self.latencies.append(received - self.__probe_sent)
+                    self.__probe_sent = None
+
+    def __sample(self, stats: Callable[[], dict]) -> None:
+        started = time.monotonic()
+        while not self.__stop.wait(self.SAMPLE_PERIOD):
+            depth = sum(lane["depth"] for lane in stats()["lanes"].values())
+            self.depths.append((time.monotonic() - started, depth))
+
+    def __report(self, elapsed: float, final: Optional[dict]) -> Dict[str, float]:
+        report = {"duration_s": round(elapsed, 1),
+                  "offered_rate": round(self.published / elapsed, 1),
+                  "probes": len(self.latencies) + self.missed_probes,
+                  "missed_probes": self.missed_probes,
+                  "latency_p50_ms": round(percentile(self.latencies, 0.5) * 1000, 1),
+                  "latency_p99_ms": round(percentile(self.latencies, 0.99) * 1000, 1),
+                  "latency_max_ms": round(max(self.latencies, default=0) * 1000, 1),
+                  "commands": sum(self.commands.values())}
+
+        if final is not None:
+            lanes = final["lanes"]
+            report["processed_rate"] = round(sum(lane["count"] for lane in lanes.values()) / elapsed, 1)
+            report["queue_depth_max"] = max((depth for _, depth in self.depths), default=0)
+            report["queue_depth_final"] = sum(lane["depth"] for lane in lanes.values())
+
+            #Growth of the queue in messages per second, from a least squares fit of the sampled depths
+            if len(self.depths) >= 2:
+                n = len(self.depths)
+                mean_t = sum(t for t, _ in self.depths) / n
+                mean_d = sum(d for _, d in self.depths) / n
+                variance = sum((t - mean_t) ** 2 for t, _ in self.depths)
+                report["queue_growth_per_s"] = round(
+                    sum((t - mean_t) * (d - mean_d) for t, d in self.depths) / variance, 2) if variance else 0.0
+
+            for name, lane in lanes.items():
+                report[f"{name}_queue_p99_ms"] = lane["p99_ms"]
+            report["commands_deferred"] = sum(lane["deferred"] for lane in final["commands"].values())
+            report["commands_dropped"] = sum(lane["dropped"] for lane in final["commands"].values())
+
+        return report
+
+
+if __name__ == "__main__":
+    #Runs the controller against generated load, e.g. python3 LoadGenerator.py --sensors 200 --power-rate 10
+    import argparse
+    import os
+    import tempfile
+    from http.server import ThreadingHTTPServer
+
+    from SystemLog import SystemLog
+    from StandInBroker import StandInBroker
+    from LogicController import LogicController
+    from GOTK import create_device_model
+
+    parser = argparse.ArgumentParser(description="Load the controller with simulated Zigbee2MQTT traffic.")
+    parser.add_argument("--broker", help="host:port of an MQTT broker, instead of the in-process stand-in broker")
+    parser.add_argument("--sensors", type=int, default=200)
+    parser.add_argument("--sensor-rate", type=float, default=1.0, help="reports per second of each sensor")
+    parser.add_argument("--power-rate", type=float, default=10.0, help="power reports per second of the actuator")
+    parser.add_argument("--probe-period", type=float, default=2.0)
+    parser.add_argument("--duration", type=float, default=30.0)
+    args = parser.parse_args()
+
+    SystemLog.Configure(levels=SystemLog.parse_levels(os.environ.get("GOTK_LOG_LEVEL", "WARNING")))
+
+    if args.broker:
+        host, port = args.broker.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", StandInBroker().Start()
+
+    sink = ThreadingHTTPServer(("127.0.0.1", 0), LogSink)
+    Thread(target=sink.serve_forever, daemon=True).start()
+
+    #The controller keeps its state in a temporary directory, so the load does not touch the installation's files
+    LogicController.DATA_DIR = tempfile.mkdtemp(prefix="gotk-load-")
+    LogicController.CHECKPOINT_PATH = os.path.join(LogicController.DATA_DIR, "controller.json")
+    LogicController.LIVE_STATE_PATH = os.path.join(LogicController.DATA_DIR, "live-state")
+    LogicController.MQTT_BROKER_HOST, LogicController.MQTT_BROKER_PORT = host, port
+
+    #Start the controller as idle mode does when the stove is turned on. Its plug has reported power
+    controller = LogicController(device_model=create_device_model(), ServerHost=f"127.0.0.1:{sink.server_port}")
+    controller.Appliances["Actuator"].Power_Report(time.time(), LoadGenerator.ACTUATOR_PAYLOAD["power"], "ON")
+    controller.Start()
+    time.sleep(0.5)
+
+    generator = LoadGenerator(host, port, args.sensors, args.sensor_rate, args.power_rate, args.probe_period)
+    report = generator.Run(args.duration, stats=controller.Stats)
+    controller.Go_Idle()
+    sink.shutdown()
+
+    for key, value in report.items():
+        print(f"{key:<24} {value}")
@@ -1,44 +1,68 @@
 # url = "http://127.0.0.1/writeToDB/"
-import requests
-import json
 import time
-from heucod import HeucodEventType, HeucodEvent, HeucodEventJsonEncoder
+from typing import TYPE_CHECKING, Callable, Optional, Union
+
+#requests and heucod (with its event type enum and JSON encoder) are imported when the first event is logged,
+#so they do not delay the start of the system.
+if TYPE_CHECKING:
+    from heucod import HeucodEventType
+    from EventTemplates import EventTemplates
+    from SideEffectWorker import SideEffectWorker
 
 class Logger:
-    def __init__(self, ServerHost : str):
+    def __init__(self, ServerHost : str, templates: "EventTemplates", on_event: Optional[Callable[[str, int, Optional[str]], None]] = None,
+                 worker: Optional["SideEffectWorker"] = None):
         """
             url: the url should be the endpoint, which the post request should be made to.
             
             The endpoint of our webserver should be: "http://<addrOfServerHost>/writeToDB/".
 
             The last "/" is very important, since it tells the request that it is looking for a directory and not a file.
+            
+            templates: The pre-serialized events of each device, which give the events their sensor, room and gateway.
+            
+            on_event: Optional callback invoked with the name of the event type, timestamp and device id of every logged event, before it is sent.
+            
+            worker: Optional side effect worker. The events are then only queued for its process, which sends them.
         """
         self.url = f"http://{ServerHost}/writeToDB/"
+        self.templates = templates
+        self.on_event = on_event
+        self.worker = worker
 
-    def send_log(self, timeStamp: int, eventType: HeucodEventType):
+    def send_log(self, timeStamp: int, eventType: Union["HeucodEventType", str], device_id: Optional[str] = None,
+                 power: Optional[float] = None):
         """
             Creates a log of an event.
 
             timeStamp: Given as an integer of seconds since 1. january 1930 00:00:00. (time.time())
 
-            eventType: A string describing the event type.
+            eventType: The event type, or a string with the name of the event type.
+
+            device_id: The sensor or plug the event is about. None for events of the gateway itself.
+
+            power: The power of the plug in watts, if the event is about a plug.
 
             Event types could be: 
             "..." to be continued...
         """
+        eventType = getattr(eventType, "name", eventType)
 
-        data : HeucodEvent = HeucodEvent()
+        if self.worker is not None:
+            self.worker.Submit_Event(timeStamp, eventType, device_id, power)
+            return
 
-        data.event_type = eventType
+        import requests
 
-        data.timestamp = timeStamp
-        
-        #! Tilføj evt patient_id 
+        if self.on_event is not None:
+            self.on_event(eventType, timeStamp, device_id)
+
+        #The context of the device is already serialized, only the timestamp and power are added
+        jsonData = self.templates.Encode(eventType, timeStamp, device_id, power=power)
         try:
             # Creates a post request for the HTTP-server.
             # Redirects are not allowed, since this causes the post request to be turnt into a get request.
-            jsonData = json.loads(data.to_json()) #! The to_json() function creates a str containing a json, we just want the dictionary of the json. Thus we use json.loads()
-            response = requests.post(self.url, json=jsonData, allow_redirects=False)
+            response = requests.post(self.url, data=jsonData, headers={"Content-Type": "application/json"}, allow_redirects=False)
         except Exception as error:
             # If something goes wrong, mainly no connection, raise the error.
             raise error
@@ -48,21 +72,20 @@ class Logger:
     #     print("\n -------------- this is test server host!!!! ---------------- \n\n ", self.url,"\n Type is:", type(self.url), "\n\n")
     #     print("has logged")
 
-    def logStoveOn(self):
-        self.send_log(timeStamp = int(time.time()), eventType=HeucodEventType.StoveTurnsOn)
+    def logStoveOn(self, device_id: Optional[str] = None, power: Optional[float] = None):
+        self.send_log(timeStamp = int(time.time()), eventType="StoveTurnsOn", device_id=device_id, power=power)
             
-    def logStoveOff(self):
-        self.send_log(timeStamp = int(time.time()), eventType = HeucodEventType.StoveTurnsOff)
+    def logStoveOff(self, device_id: Optional[str] = None, power: Optional[float] = None):
+        self.send_log(timeStamp = int(time.time()), eventType="StoveTurnsOff", device_id=device_id, power=power)
 
-    def logSystemTurnsStoveOn(self):
-        self.send_log(timeStamp = int(time.time()), eventType=HeucodEventType.SystemTurnsStoveOn)
+    def logSystemTurnsStoveOn(self, device_id: Optional[str] = None, power: Optional[float] = None):
+        self.send_log(timeStamp = int(time.time()), eventType="SystemTurnsStoveOn", device_id=device_id, power=power)
         
-    def logSystemTurnsStoveOff(self):
-        self.send_log(timeStamp = int(time.time()), eventType=HeucodEventType.SystemTurnsStoveOff)
+    def logSystemTurnsStoveOff(self, device_id: Optional[str] = None, power: Optional[float] = None):
+        self.send_log(timeStamp = int(time.time()), eventType="SystemTurnsStoveOff", device_id=device_id, power=power)
 
-    def logCitizenLeftKitchen(self):
-        self.send_log(timeStamp = int(time.time()), eventType=HeucodEventType.CitizenLeftKitchen)
+    def logCitizenLeftKitchen(self, device_id: Optional[str] = None):
+        self.send_log(timeStamp = int(time.time()), eventType="CitizenLeftKitchen", device_id=device_id)
 
-    def logCitizenEnteredKitchen(self):
-        self.send_log(timeStamp = int(time.time()), eventType=HeucodEventType.CitizenEnteredKitchen)
-        
+    def logCitizenEnteredKitchen(self, device_id: Optional[str] = None):
+        self.send_log(timeStamp = int(time.time()), eventType="CitizenEnteredKitchen", device_id=device_id)
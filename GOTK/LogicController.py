@@ -1,30 +1,62 @@
 from DeviceModel import DeviceModel
-from Timer import Timer
-from threading import Thread
+from threading import Event, Lock, RLock, Thread
+from typing import Optional
+import atexit
+import os
 import time
 from Logger import Logger
+from SystemLog import SystemLog
+from Appliance import Appliance
+from DeadlineScheduler import DeadlineScheduler
+from OccupancyPredictor import OccupancyPredictor
+from OccupancyHistory import OccupancyHistory
+from LiveState import LiveState
+from DeviceStateCache import DeviceStateCache
+from EventTemplates import EventTemplates
+from AtomicFile import AtomicFile
+from JsonCodec import JsonCodec
+from UsageAggregates import UsageAggregates
+from PriorityEventQueue import PriorityEventQueue
+from TrafficCapture import TrafficCapture
+from TimeSeriesStore import TimeSeriesWriter
+import Settings
 
 from Z2M_Client import Z2M_Client
 from Z2M_Message import Z2M_Message
 from Z2M_MessageType import Z2M_MessageType
 
+log = SystemLog.get("Controller")
+timer_log = SystemLog.get("Timer")
+
 class LogicController:
     """
-    The logic controller is the main driver for the GOTK system. When the stove is active it listens to the messages from the 
-    devices and holds the logic that actuates based on the messages received from the Z2M_Client. It utilizes two threads to concurrently
-    run timers with the Logic Controller. When the Away Timer thread reaches a threshold, it signals the Z2M Client to change the lights or actuator state based on 
-    depedending on the threshold. The Actuator thread is used to check if the citizen switches of the stove. 
+    The logic controller is the main driver for the GOTK system. When an appliance is active it listens to the messages from the 
+    devices and holds the logic that actuates based on the messages received from the Z2M_Client. Every power plug in the device
+    model guards its own appliance, with its own state machine, power detector and timers (see Appliance).
+    
+    The timers of all appliances share one scheduler thread, which handles each appliance when its next deadline is reached. When an
+    appliance's Away Timer reaches a threshold, the controller signals the Z2M Client to change the lights or the plug state depending
+    on the threshold. While the power of an appliance is low, its power detector is polled to check if the citizen switched it off.
     
     The Logic Controller logs when specific events happen.
     
-    When either the Away Timer Thread exceeds the Upper Threshold or the Actuator Thread detects that the citizen turns off the stove,
-    the logic controllers Go_Idle() method is called, which closes the threads, disconnects the Z2M Client and stops 
+    When no appliance is in use any more, because the citizen turned them off or their Away Timers exceeded the Upper Threshold,
+    the logic controllers Go_Idle() method is called, which stops the scheduler, disconnects the Z2M Client and stops 
     the Logic Controller, and goes back into idle mode.
     """
 
+    LIGHTS = "Lights"               #Scheduler key of the lights, which follow the citizen while away from the kitchen
+    LIGHTS_PERIOD = 1
+    AWAY_SEVERITY = {"On": 0, "Notify": 1, "Limit": 2, "Upper": 3}
+
     HTTP_HOST = "http://localhost:8000"
-    MQTT_BROKER_HOST = "localhost"
-    MQTT_BROKER_PORT = 1883
+    MQTT_BROKER_HOST = Settings.MQTT_BROKER_HOST
+    MQTT_BROKER_PORT = Settings.MQTT_BROKER_PORT
+    COMMANDS_PER_SECOND = 5         #Airtime budget of the commands published to the lights and actuators
+    DATA_DIR = Settings.DATA_DIR
+    CHECKPOINT_PATH = os.path.join(DATA_DIR, "controller.json")
+    SAVE_PERIOD = 600               #Seconds between saves of the learned state (room transitions, occupancy, duty-cycle gaps)
+    LIVE_STATE_PATH = LiveState.DEFAULT_PATH    #Shared memory file of the live state, read by local dashboards and watchdogs
 
     #Initializes the controller
     def __init__(self, device_model: DeviceModel, ServerHost: str) -> None:
@@ -33,20 +65,92 @@ class LogicController:
             multiple dictionaries.
         """
         self.__device_model = device_model
-        self.__z2m_client = Z2M_Client(host = self.MQTT_BROKER_HOST,
-                                       port = self.MQTT_BROKER_PORT,
-                                       on_message_callback=self.__zigbee2mqtt_event_received)
-        
-        #Initialise Logger and Timers
-        self.System_Logger = Logger(ServerHost=ServerHost)
-        self.__clock_away = Timer()
-        self.__clock_actuator = Timer()
         
-        #Initialise dictionaries for sensors and lights in each room. Create room occupancy dictionary and actuator dictionary
+        #Initialise dictionaries for sensors and lights in each room. Create room occupancy dictionary
         self.room_sensor = {"Sensor 0": "Kitchen", "Sensor 1": "Room 1", "Sensor 2": "Room 2", "Sensor 3": "Room 3", "Sensor 4": "Room 4"}
         self.room_light = {"Room 1": "Bulb 1", "Room 2": "Bulb 2", "Room 3": "Bulb 3", "Room 4": "Bulb 4"}
         self.room_occupancy = {}        
-        self.actuator_dict = {}
+        self.kitchen_sensor = next(sensor for sensor, room in self.room_sensor.items() if room == "Kitchen")
+        
+        #Initialise usage aggregates and Logger. Every logged event updates the aggregates. With GOTK_SIDE_PROCESS=1 the
+        #logging and the aggregates run in a separate process, which is given the events and escalations.
+        #The events carry the sensor or plug they are about, its room and make, and the gateway (see EventTemplates)
+        device_rooms = dict(self.room_sensor)
+        device_rooms.update({light: room for room, light in self.room_light.items()})
+        device_rooms.update({actuator.id_: "Kitchen" for actuator in device_model.actuators_list})
+        templates = EventTemplates(device_model, device_rooms)
+        usage_path = os.path.join(self.DATA_DIR, "usage.json")
+        if os.environ.get("GOTK_SIDE_PROCESS") == "1":
+            #Only imported when enabled, so the controller does not load multiprocessing and shared memory otherwise
+            from SideEffectWorker import SideEffectWorker
+            self.Side_Effects = SideEffectWorker(ServerHost, usage_path, templates)
+            self.Side_Effects.Start()
+            self.Usage = None
+            self.System_Logger = Logger(ServerHost=ServerHost, templates=templates, worker=self.Side_Effects)
+            self.__Record_Escalation = self.Side_Effects.Record_Escalation
+        else:
+            self.Side_Effects = None
+            self.Usage = UsageAggregates(usage_path)
+            self.Usage.Start()
+            self.System_Logger = Logger(ServerHost=ServerHost, templates=templates, on_event=self.Usage.Record)
+            self.__Record_Escalation = self.Usage.Record_Escalation
+        
+        #The Z2M Client handles the kitchen sensor and the actuators before the other sensors, and those before the rest.
+        #With GOTK_CAPTURE=1 it captures all received messages. The capture is shared with idle mode, which records its messages too
+        self.Capture = TrafficCapture(os.path.join(self.DATA_DIR, "capture")) if os.environ.get("GOTK_CAPTURE") == "1" else None
+        self.__z2m_client = Z2M_Client(host = self.MQTT_BROKER_HOST,
+                                       port = self.MQTT_BROKER_PORT,
+                                       on_message_callback=self.__zigbee2mqtt_event_received,
+                                       lanes=self.__Lanes(),
+                                       commands_per_second=self.COMMANDS_PER_SECOND,
+                                       capture=self.Capture)
+        
+        #Blind duration of each room's sensor after a detection, from the device model, and the predictor learning where the
+        #citizen goes next. Sensors without a blind duration get the predictor's default
+        self.sensor_blind_duration = {sensor.id_: sensor.blind_duration_ or OccupancyPredictor.DEFAULT_BLIND_DURATION
+                                      for sensor in device_model.sensors_list if sensor.id_ in self.room_sensor}
+        self.Occupancy_Predictor = OccupancyPredictor(
+            {self.room_sensor[sensor]: duration for sensor, duration in self.sensor_blind_duration.items()},
+            path=os.path.join(self.DATA_DIR, "transitions.json"))
+        self.predicted_room = None
+        self.prelight_deadline = -1
+        
+        #Every change of the room occupancy is recorded, for the dwell time and transition analytics (OccupancyAnalytics)
+        self.Occupancy_History = OccupancyHistory(list(self.room_sensor.values()), path=os.path.join(self.DATA_DIR, "occupancy.bin"))
+        
+        self.Controller_Mode = False
+        self.in_kitchen = False
+        self.__checkpoint_lock = Lock()
+        self.__checkpoint_due: Optional[bytes] = None
+        self.__idle = Event()
+        
+        #One state machine per power plug, each with its own power store, power detector and timers. The appliances in use
+        #are kept apart, so the events only cost in proportion to them. The state lock serializes the events and the scheduler.
+        #The power stores share one writer thread, which also keeps them within their disk budget together
+        self.Power_Writer = TimeSeriesWriter()
+        self.Appliances = {device.id_: Appliance(device.id_, self.DATA_DIR, self.Power_Writer)
+                           for device in device_model.actuators_list}
+        self.Power_Writer.Start()
+        
+        #The learned room transitions, the occupancy history and the duty-cycle gaps of the appliances are saved by a thread
+        #of their own, every SAVE_PERIOD while the controller runs, when it goes idle and when the system exits
+        self.__save_requested = Event()
+        Thread(target=self.__Saver, name="Learned state saver", daemon=True).start()
+        atexit.register(self.__Save_Learned)
+        self.__in_use = {}
+        self.Away_State = "On"
+        self.__scheduler = DeadlineScheduler(self.__Deadline_Reached)
+        self.__state_lock = RLock()
+        
+        #The last reported state of every device, shared with idle mode. The plugs' state changes are followed, to notice
+        #a plug switched off by hand while its appliance is in use
+        self.Device_States = DeviceStateCache()
+        for appliance in self.Appliances.values():
+            self.Device_States.Subscribe("state", self.__Plug_State_Changed, appliance.device_id)
+        
+        #Snapshot of the state in shared memory, for local dashboards and watchdogs (LiveStateReader)
+        self.Live_State = LiveState(list(self.room_sensor.values()), self.LIVE_STATE_PATH)
+        self.__Publish_State()
         
         
     def Start(self) -> None:
@@ -55,151 +159,362 @@ class LogicController:
         as well as initializing the two threads, which is started right after.
         """
         
-        print("System started")
-        self.__z2m_client.connect()
+        log.info("System started")
+        self.__idle.clear()
+        
+        #The controller is set up under the state lock, so the first messages handled by the Z2M Client wait for it
+        with self.__state_lock:
+            self.__z2m_client.connect()
+        
+            #The appliances that the power detectors found on in idle mode are in use. Start their Actuator Clocks, and log
+            #that each of them was turned on, not only the one that started the controller
+            for appliance in self.Appliances.values():
+                if appliance.Power_Detector.State == "ON":
+                    appliance.clock_actuator.Start()
+                    self.__Set_State(appliance, Appliance.ON)
+                    self.System_Logger.logStoveOn(appliance.device_id, appliance.actuator_dict["Power"])
         
-        self.Controller_Mode = True
+            #Call Kitchen_Entered Method. Flag to maintain occupancy in room with last detected movement is initialized
+            self.Kitchen_Entered()
+            self.occupancy_flag = None
+            self.Occupancy_Predictor.Reset_Sequence("Kitchen")
+            self.__Record_Occupancy({}, time.time())
         
-        #Start Actuator Clock
-        self.__clock_actuator.Start()
+            self.__Start_Scheduler()
+            self.Controller_Mode = True
+            self.__Checkpoint()
+            self.__Publish_State()
+        self.__Write_Checkpoint()
+    
+    def Resume(self, checkpoint: dict) -> None:
+        """
+        Starts the controller from a checkpoint written before the gateway restarted, instead of from the kitchen. The rooms,
+        active lights and the appliances in use are restored, and their timers are started from their original start times,
+        so the Away Timers keep their absolute thresholds. If a plug was on, its power detector expects its power within the
+        Actuator Period, otherwise the appliance is considered turned off.
+        """
+        started = time.perf_counter()
+        self.__idle.clear()
         
-        #Call Kitchen_Entered Method. Flag to maintain occupancy in room with last detected movement is initialized
-        self.Kitchen_Entered()
-        self.occupancy_flag = None
+        #The controller is set up under the state lock, so the first messages handled by the Z2M Client wait for it
+        with self.__state_lock:
+            self.__z2m_client.connect()
         
-        #Initialise timer threads - Away Timer and Actuator Timer
-        self.__Away_Timer_Thread = Thread(target = self.Away_Timer, daemon = True)
-        self.__Actuator_Thread = Thread(target = self.Actuator_Timer, daemon = True)
+            self.in_kitchen = checkpoint["in_kitchen"]
+            self.room_occupancy = checkpoint["room_occupancy"]
+            self.occupancy_flag = checkpoint["occupancy_flag"]
+            self.active_lights = checkpoint["active_lights"]
+            self.Away_State = checkpoint["Away_State"]
+            self.predicted_room = None
+            self.Occupancy_Predictor.Reset_Sequence(None)
         
-        #Set boolean true, controlling the loop in Away Timer Thread and start the thread.
-        self.Away_Thread_Running = True
-        self.__Away_Timer_Thread.start()
+            #Restore the appliances in use, with their timers' original start times
+            for device_id, appliance_checkpoint in checkpoint["appliances"].items():
+                appliance = self.Appliances.get(device_id)
+                if appliance is not None:
+                    appliance.Restore(appliance_checkpoint, time.time())
+                    self.__Set_State(appliance, appliance.State)
         
-        #Set boolean true, controlling the loop in Actuator Thread and start thread.
-        self.Actuator_Thread_Running = True
-        self.__Actuator_Thread.start()
+            self.__Start_Scheduler()
+            self.Controller_Mode = True
+            self.__Publish_State()
+        log.info("Controller resumed from checkpoint", away_state=self.Away_State, appliances=list(self.__in_use),
+                 resume_ms=round((time.perf_counter() - started) * 1000, 1))
+    
+    @classmethod
+    def Load_Checkpoint(cls) -> Optional[dict]:
+        """
+        Returns the last checkpoint if the controller was running when it was written, otherwise None. This is a class method,
+        so the checkpoint can be read before the controller is created.
+        """
+        data = AtomicFile.Read(cls.CHECKPOINT_PATH)
+        if not data:
+            return None
+        try:
+            checkpoint = JsonCodec.loads(data)
+        except ValueError:
+            log.warning("Ignoring unreadable checkpoint", path=cls.CHECKPOINT_PATH)
+            return None
+        if "appliances" not in checkpoint:
+            log.warning("Ignoring checkpoint written before multi-appliance support", path=cls.CHECKPOINT_PATH)
+            return None
+        return checkpoint if checkpoint.get("Controller_Mode") else None
+
+    def Stats(self) -> dict:
+        """
+        Returns the statistics of the Z2M Client: the latency and depth of each event queue lane, the health of the broker
+        and bridge, and the sent, deferred and dropped commands. With the side process, also its submitted, dropped and
+        pending events and its restarts.
+        """
+        stats = {"lanes": self.__z2m_client.Lane_Stats(),
+                 "health": self.__z2m_client.Health(),
+                 "commands": self.__z2m_client.Command_Stats()}
+        if self.Side_Effects is not None:
+            stats["side_effects"] = self.Side_Effects.Metrics()
+        return stats
+
+    def __Lanes(self) -> dict:
+        """
+        Returns the priority lane of each device's messages: the kitchen sensor and the actuators decide when the stove
+        is turned off, the sensors in the other rooms only decide the lights. Other messages (bridge, light state
+        echoes) are handled last.
+        """
+        lanes = {}
+        for sensor in self.__device_model.sensors_list:
+            kitchen = self.room_sensor.get(sensor.id_) == "Kitchen"
+            lanes[sensor.id_] = PriorityEventQueue.SAFETY if kitchen else PriorityEventQueue.OCCUPANCY
+        for actuator in self.__device_model.actuators_list:
+            lanes[actuator.id_] = PriorityEventQueue.SAFETY
+        return lanes
+
+    def __Checkpoint(self) -> None:
+        """
+        Takes a compact snapshot of the controller state, which __Write_Checkpoint() writes once the state lock is released.
+        The timers are stored by their absolute start times, from which the thresholds follow. Called on every transition
+        of the controller, under the state lock.
+        """
+        checkpoint = {"Controller_Mode": self.Controller_Mode,
+                      "in_kitchen": self.in_kitchen,
+                      "room_occupancy": self.room_occupancy,
+                      "occupancy_flag": self.occupancy_flag,
+                      "active_lights": [light for light in self.active_lights if light != self.room_light.get(self.predicted_room)],
+                      "Away_State": self.Away_State,
+                      "appliances": {device_id: appliance.Checkpoint() for device_id, appliance in self.__in_use.items()},
+                      "Written": time.time()}
+        self.__checkpoint_due = JsonCodec.dumps(checkpoint)
+    
+    def __Write_Checkpoint(self) -> None:
+        """
+        Atomically writes the last snapshot taken by __Checkpoint(), if it is not written yet. Called after the state lock is
+        released, so the events and the scheduler do not wait for the fsync. The snapshots are taken in order under the state
+        lock, and taken for writing in order under the checkpoint lock, so a newer snapshot is never overwritten by an older one.
+        """
+        with self.__checkpoint_lock:
+            data, self.__checkpoint_due = self.__checkpoint_due, None
+            if data is not None:
+                AtomicFile.Write(self.CHECKPOINT_PATH, data)
+    
+    def __Saver(self) -> None:
+        while True:
+            self.__save_requested.wait(self.SAVE_PERIOD)
+            self.__save_requested.clear()
+            self.__Save_Learned()
+    
+    def __Save_Learned(self) -> None:
+        """
+        Saves the learned room transitions, the occupancy history and the duty-cycle gaps of the appliances, if they changed
+        since they were last saved.
+        """
+        try:
+            self.Occupancy_Predictor.Save()
+            self.Occupancy_History.Save()
+            for appliance in self.Appliances.values():
+                appliance.Power_Detector.Save()
+        except OSError as error:
+            log.warning("Saving the learned state failed", error=error, throttle="learned_save")
+    
+    def __Publish_State(self) -> None:
+        """
+            Publishes the state to the live state snapshot. It is only written when it changed.
+        """
+        with self.__state_lock:
+            self.Live_State.Publish(self.Controller_Mode, self.in_kitchen, self.Away_State, self.room_occupancy,
+                                    list(self.Appliances.values()))
+    
+    def __Start_Scheduler(self) -> None:
+        """
+        Starts the scheduler thread with the deadlines of the appliances in use, and of the lights if the citizen is away.
+        """
+        self.__scheduler.Start()
+        now = time.time()
+        for device_id, appliance in self.__in_use.items():
+            self.__scheduler.Schedule(device_id, appliance.Next_Deadline(now))
+        if not self.in_kitchen:
+            self.__scheduler.Schedule(self.LIGHTS, now + self.LIGHTS_PERIOD)
 
     #Function to switch into idle mode
     def Go_Idle(self) -> None:
         """
-        Stops listening to zigbee2mqtt messages, terminates the threads and stops the loop for the controller client. 
-        When the controller loop stops, idle mode is entered.
+        Stops listening to zigbee2mqtt messages, stops the scheduler and stops the loop for the controller client. 
+        When it has finished, Wait_Idle() returns and idle mode is entered. It may be called from a scheduler callback, whose
+        thread then ends after it.
         """
-        print("Go Idle is called")
-        #Make sure clocks are stopped and threads are stopped by setting their running flags to false. 
-        self.__clock_actuator.Stop()
-        self.__clock_away.Stop()
-        self.Actuator_Thread_Running = False
-        self.Away_Thread_Running = False
+        log.info("Go Idle is called")
+        #Make sure the scheduler and all clocks are stopped
+        self.__scheduler.Stop()
+        with self.__state_lock:
+            for appliance in self.Appliances.values():
+                appliance.clock_actuator.Stop()
+                appliance.clock_away.Stop()
+                self.__Set_State(appliance, Appliance.IDLE)
         
         #Disconnects the Z2M Client - stops listening to devices.
         self.__z2m_client.disconnect()
-        print("Client is disconnected")
+        log.info("Client is disconnected")
         
-        #Change Boolean for controller loop to false.
+        #The rooms are no longer followed, so their stays end here
+        self.__Record_Occupancy(dict(self.room_occupancy), time.time(), end=True)
+        
+        #Hand the buffered power samples, the usage aggregates, the learned room transitions and the occupancy history to
+        #the threads that write them, so going idle only waits for the fsync of the checkpoint
+        for appliance in self.Appliances.values():
+            appliance.Power_Store.Flush()
+        if self.Usage is not None:
+            self.Usage.Request_Checkpoint()
+        self.__save_requested.set()
+        
+        stats = self.Stats()
+        log.info("Event queue latency", lanes=stats["lanes"])
+        log.info("Broker and bridge health", **stats["health"])
+        log.info("Outgoing commands", commands=stats["commands"])
+        if "side_effects" in stats:
+            log.info("Side effects", **stats["side_effects"])
+        
+        #Change Boolean for controller loop to false, and checkpoint that the controller is no longer running.
         self.Controller_Mode = False
+        with self.__state_lock:
+            self.__Checkpoint()
+        self.__Write_Checkpoint()
+        self.__Publish_State()
+        self.__idle.set()
     
-    def Away_Timer(self):
+    def Wait_Idle(self, timeout: Optional[float] = None) -> bool:
         """
-            Thread for the Away From Kitchen Timer. When the timer is active, it checks the timer and notifies citizen,
-            when certain thresholds are exceeded
+        Waits until Go_Idle() has finished, so idle mode can start right away instead of polling Controller_Mode. Returns
+        False if the timeout passed first.
         """
-        print("---------Away Timer Thread has started!---------")
-        #The Threads While-loop continues as long as the running flag is true
-        while self.Away_Thread_Running:
-            
-            #Ensures that it only checks the timer when it is active.
-            if self.__clock_away.Timer_Active:
-                print("\n------------- Away Timer:", self.__clock_away.Time_Passed(), "-------------")
-                #Check the timer and set state depending on time passed
-                timer_state = self.__clock_away.Check_Timer()
-                
-                #The Upper Threshold - In case the kitchen is left for too long, it goes into idle mode, to save resources
-                if timer_state == "Upper":
-                    print("\n------------------------------------UPPER THRESHOLD EXCEEDED!!!!!!!--------------------")
-                    
-                    #Publish "Dim" state to all active lights
-                    for device in self.active_lights:
-                        self.__z2m_client.Light_Controls("Dim", device)
-                    
-                    #Stop Away Timer and go idle
-                    self.__clock_away.Stop()
-                    self.Go_Idle()
-                
-                #The Limit Threshold - System turns of the stove, if Away Timer exceeds limit threshold
-                elif timer_state == "Limit":
-                    print("\n------------------------------------LIMIT EXCEEDED!!!!!!!--------------------")
-                    
-                    #Turns off the Actuator if its on. Logs it to the database
-                    if self.actuator_dict["State"] == "ON": 
-                        self.System_Logger.logSystemTurnsStoveOff()
-                        self.__z2m_client.Actuator_Controls("Actuator", "OFF")
-                        
-                        #Stops the Actuator Timer and sets its dictionary values
-                        self.__clock_actuator.Stop()
-                        self.actuator_dict["State"] = "OFF"
-                        self.actuator_dict["PowerWasRegistered"] = False
-                    
-                    #Publish "Limit" state to all active lights
-                    for device in self.active_lights:
-                        self.__z2m_client.Light_Controls("Limit", device)    
-                
-                #The Notify Threshold - System starts notifying citizen, when the Away Timer exceeds Notify threshold
-                elif timer_state == "Notify":
-                    print("\n------------------------------------NOTIFY!!!!!!!--------------------")
-                    
-                    #Publish "Notify" state to all active lights
-                    for device in self.active_lights:
-                        self.__z2m_client.Light_Controls("Notify", device)
-                        
-                else:
-                    #Else publish "On" state to all active lights
-                    for device in self.active_lights:
-                        self.__z2m_client.Light_Controls("On", device)
-                        
-            time.sleep(1)
-        
-        print("---------Away Timer Thread has been closed!---------")
+        return self.__idle.wait(timeout)
     
-    #Thread for Actuator Timer. To ensure that Actuator has time to update it power value when turned on by the system.
-    #Used to optimize the certainty that the citizen turned off the stove.
-    def Actuator_Timer(self):
+    def __Deadline_Reached(self, key: str, now: float) -> Optional[float]:
+        """
+            Called by the scheduler when the deadline of an appliance or the lights is reached. Returns the next deadline.
+            Go_Idle() is called outside the state lock, since it waits for the Z2M Client's worker, which may be waiting
+            for the lock.
+        """
+        go_idle = False
+        with self.__state_lock:
+            if key == self.LIGHTS:
+                next_deadline = self.__Lights_Tick(now)
+            else:
+                appliance = self.Appliances[key]
+                changed = self.__Appliance_Tick(appliance, now)
+                go_idle = not self.__in_use
+                if changed and not go_idle:
+                    self.__Checkpoint()
+                    self.__Publish_State()
+                next_deadline = appliance.Next_Deadline(now)
+        self.__Write_Checkpoint()
         
-        print("---------Actuator Thread has started!---------")
-        #The Threads While-loop continues as long as the running flag is true
-        while self.Actuator_Thread_Running:
-            
-            #If timer is active, thread checks if the stove is turned off by citizen. 
-            #When detected it logs it, closes the threads, which then makes system go into idle mode through the Away Timer thread
-            if self.__clock_actuator.Timer_Active:
-                
-                #If the timer exceeds 30 secs and power is still 0, system should recognize it as citizen has turned off the stove - go idle
-                if self.actuator_dict["State"] == "ON" and self.actuator_dict["Power"] == 0 and self.__clock_actuator.Time_Now() >= self.__clock_actuator.Actuator_Threshold:
-                    self.System_Logger.logStoveOff()
-                    print("Citizen turned off the stove - after 30 sec")
-                    self.__clock_actuator.Stop()
-                    self.Go_Idle()
-
-                    
-                #If a previous Power was registered while actuator has been on and power is 0. Then Citizen must have turned off the stove - go idle
-                elif self.actuator_dict["State"] == "ON" and self.actuator_dict["Power"] == 0 and self.actuator_dict["PowerWasRegistered"] == True:
-                    self.System_Logger.logStoveOff()
-                    print("Citizen turned off the stove - before 30 sec")
-                    self.__clock_actuator.Stop()
-                    self.Go_Idle()
+        if go_idle:
+            self.Go_Idle()
+            return None
+        return next_deadline
+    
+    def __Appliance_Tick(self, appliance: Appliance, now: float) -> bool:
+        """
+            Checks if the citizen turned off the appliance, and escalates its Away Timer when a threshold is exceeded.
+            Returns True if the state of the appliance changed.
+        """
+        #The power detector found an off edge while the plug is on: the citizen turned the appliance off
+        edge = appliance.Take_Edge(now)
+        if edge and edge.state == "OFF" and appliance.In_Use and appliance.actuator_dict["State"] == "ON":
+            self.System_Logger.logStoveOff(appliance.device_id, appliance.actuator_dict["Power"])
+            log.info("Citizen turned off the appliance", device=appliance.device_id, confidence=round(edge.confidence, 2))
+            appliance.clock_actuator.Stop()
+            appliance.clock_away.Stop()
+            self.__Set_State(appliance, Appliance.IDLE)
+            self.__Update_Away_State()
+            return True
+        
+        if not appliance.clock_away.Timer_Active:
+            return False
+        
+        #Check the timer and escalate once, when the timer state changes
+        timer_state = appliance.clock_away.Check_Timer()
+        if timer_state == appliance.Away_State:
+            return False
+        appliance.Away_State = timer_state
+        self.__Record_Escalation(timer_state, now, appliance.device_id)
+        
+        #The Upper Threshold - In case the kitchen is left for too long, the appliance is given up and the lights dimmed
+        if timer_state == "Upper":
+            timer_log.warning("UPPER THRESHOLD EXCEEDED", device=appliance.device_id)
+            for device in self.active_lights:
+                self.__z2m_client.Light_Controls("Dim", device)
+            appliance.clock_away.Stop()
+            self.__Set_State(appliance, Appliance.IDLE)
+            self.__Update_Away_State()
+            return True
+        
+        #The Limit Threshold - System turns off the plug, if the Away Timer exceeds the limit threshold
+        elif timer_state == "Limit":
+            timer_log.warning("LIMIT EXCEEDED", device=appliance.device_id)
+            if appliance.actuator_dict["State"] == "ON":
+                self.System_Logger.logSystemTurnsStoveOff(appliance.device_id, appliance.actuator_dict["Power"])
+                self.__z2m_client.Actuator_Controls(appliance.device_id, "OFF")
                 
-            time.sleep(1)
+                #Stops the Actuator Timer and sets its dictionary values
+                appliance.clock_actuator.Stop()
+                appliance.actuator_dict["State"] = "OFF"
+                self.__Set_State(appliance, Appliance.SYSTEM_OFF)
+        
+        #The Notify Threshold - System starts notifying citizen, when the Away Timer exceeds Notify threshold
+        elif timer_state == "Notify":
+            timer_log.warning("NOTIFY", device=appliance.device_id)
+        
+        #The lights show the most severe state of the appliances
+        if self.__Update_Away_State():
+            for device in self.active_lights:
+                self.__z2m_client.Light_Controls(self.Away_State, device)
+        return True
+    
+    def __Lights_Tick(self, now: float) -> Optional[float]:
+        """
+            Publishes the Away State to the active lights every second while the citizen is away from the kitchen, so lights
+            added to the active lights follow it.
+        """
+        if self.in_kitchen:
+            return None
         
-        print("---------Actuator Thread has been closed!---------")
+        timer_log.info("Away Timer", away_state=self.Away_State, appliances=list(self.__in_use), throttle="away_tick")
+        if self.__Expire_Prelight(now):
+            self.__Checkpoint()
+        for device in self.active_lights:
+            self.__z2m_client.Light_Controls(self.Away_State, device)
+        return now + self.LIGHTS_PERIOD
+    
+    def __Set_State(self, appliance: Appliance, state: str) -> None:
+        """
+            Sets the state of an appliance. A plug reports its power often while its appliance is in use, and rarely otherwise.
+        """
+        was_in_use = appliance.device_id in self.__in_use
+        appliance.State = state
+        if appliance.In_Use:
+            self.__in_use[appliance.device_id] = appliance
+        else:
+            self.__in_use.pop(appliance.device_id, None)
+            appliance.Away_State = "On"
+        if appliance.In_Use != was_in_use:
+            self.__z2m_client.Configure_Reporting(appliance.device_id, "Fast" if appliance.In_Use else "Sparse")
+    
+    def __Update_Away_State(self) -> bool:
+        """
+            Sets the Away State to the most severe state of the appliances in use. Returns True if it changed.
+        """
+        away_state = max((appliance.Away_State for appliance in self.__in_use.values()),
+                         key=self.AWAY_SEVERITY.get, default="On")
+        changed, self.Away_State = away_state != self.Away_State, away_state
+        return changed
     
     #This sets the occupancy in kitchen to true and the other rooms to false. This is used when kitchen is entered
     def Kitchen_Entered(self):
         """ 
             Method for when citizen enters kitchen. This logs that kitchen was entered, sets flag for citizen in_kitchen to true,
-            sets room occupancy to only be true in kitchen, turns off all lights and assigns active lights as empty, and stops Away Timer
+            sets room occupancy to only be true in kitchen, turns off all lights and assigns active lights as empty, and stops the Away
+            Timers of the appliances
         """
         self.in_kitchen = True
-        self.System_Logger.logCitizenEnteredKitchen()
+        self.System_Logger.logCitizenEnteredKitchen(self.kitchen_sensor)
         
         self.room_occupancy = {"Kitchen": True, "Room 1": False, "Room 2": False, "Room 3": False, "Room 4": False}
         
@@ -207,104 +522,228 @@ class LogicController:
         for device in self.__device_model.lights_list:
             self.__z2m_client.Light_Controls("Off", device.id_)
         self.active_lights = []
+        self.predicted_room = None
             
-        #Stop Away Timer
-        self.__clock_away.Stop()
+        #Stop the Away Timers and reset their last states. The lights no longer follow the citizen
+        for appliance in self.__in_use.values():
+            appliance.clock_away.Stop()
+            appliance.Away_State = "On"
+            if appliance.State == Appliance.AWAY:
+                appliance.State = Appliance.ON
+        self.Away_State = "On"
+        self.__scheduler.Schedule(self.LIGHTS, None)
     
     #Handles the messages from the Z2M client
     def __zigbee2mqtt_event_received(self, message: Z2M_Message) -> None:
         """
         The Event Received in shape of a message. The Logic Controller handles the messages differently depending on the device type.
 
-        Actuator Messages:  Saves the values received from actuator in the Actuator dictionary
+        Actuator Messages:  Passes the values received from a power plug to its appliance, which is in use from when its power
+        detector finds it on until it is turned off.
         Sensor Messages: Uses the occupancy from the sensor messages to assign which rooms has occupancy. Depending on the room occupancy 
         and different states, the method checks whether the citizen is in the kitchen and not.
         
-        When citizen enters kitchen, the system logs it, ensures all lights are off and turns on the actuator, if it was switched off.
-        When citizen leaves kitchen, the system logs it, starts the away timer thread, which sends signals to control the lights in the rooms 
-        with occupancy. While kitchen is not occupied, it keeps updating which rooms detects occupancy such that the lights follow the citizen.
+        When citizen enters kitchen, the system logs it, ensures all lights are off and turns on the appliances the system switched off.
+        When citizen leaves kitchen, the system logs it and starts the Away Timers of the appliances in use, and the lights follow the
+        citizen. While kitchen is not occupied, it keeps updating which rooms detects occupancy such that the lights follow the citizen.
         
+        The devices are looked up by their id, so a message costs the same however many appliances there are.
         """
-        #Splits the topic string
+        #Splits the topic string. Sub-topics of a device, such as its commands, are not reports from the device
         tokens = message.topic.split("/")
-        if len(tokens) <= 1:
+        if len(tokens) != 2:
             return
 
         #the device_id is then tokens[1]
         device_id = tokens[1]
-        device = self.__device_model.find(device_id)
-        
-        #Messages from Actuator - Extracts power and state from the actuator message
-        if device in self.__device_model.actuators_list:
-            try:
-                power = message.power
-                if power == None: 
-                    power = 0
-                state = message.state
-            except KeyError:
-                pass
-
-            #Updates values in the actuator dictionary
-            self.actuator_dict["State"] = state
-            self.actuator_dict["Power"] = power
-            
-            #Checks if power registered when the actuator is switched on, after it has been switched off. 
-            if self.actuator_dict["State"] == "ON" and self.actuator_dict["PowerWasRegistered"] == False and power > 0:
-                self.actuator_dict["PowerWasRegistered"] = True
-            
-        #Messages from Sensors. Extracts occupancy from the sensor message and changes the room occupancy accordingly
-        elif device in self.__device_model.sensors_list:
-            try:
-                occupancy = message.occupancy
-            except KeyError:
-                pass
-            
-            #The Room where the message was received from
-            room = self.room_sensor[device_id]
-            
-            #Ensures occupancy in at least one room, if current room is the only room with occupancy, and its new occupancy value is false.
-            if list(self.room_occupancy.values()).count(True) == 1 and self.room_occupancy[room] == True and occupancy == False:
-                #Flags the room which is kept occupant
-                self.occupancy_flag = room
+        appliance = self.Appliances.get(device_id)
+        
+        with self.__state_lock:
+            changed = self.Device_States.Update_Message(message)
+            if appliance is not None:
+                self.__Power_Received(appliance, message)
+            #A sensor report matters when its occupancy changed, or when it detected the citizen again, which can move the
+            #citizen back to its room. Repeated reports without occupancy change nothing, and are skipped
+            elif device_id in self.room_sensor and ("occupancy" in changed or message.occupancy == True):
+                self.__Occupancy_Received(device_id, message)
             else:
-                #Update room occupancy
-                self.room_occupancy[room] = occupancy
-                
-                #If there is a Occupancy flag and the new message has occupancy true - Remove the flag, unless its the same room
-                if isinstance(self.occupancy_flag, str) and occupancy == True:
-                    if room != self.occupancy_flag:
-                        self.room_occupancy[self.occupancy_flag] = False
-                    self.occupancy_flag = None
+                return
+            self.__Publish_State()
+        self.__Write_Checkpoint()
+    
+    def __Plug_State_Changed(self, device_id: str, field: str, old, new, timestamp: float) -> None:
+        """
+            Called when a plug reports a new state. A plug switching off while its appliance is in use, without the system
+            turning it off, was switched off by hand.
+        """
+        appliance = self.Appliances[device_id]
+        if new == "OFF" and appliance.In_Use and appliance.actuator_dict["State"] == "ON":
+            log.warning("Plug switched off while its appliance is in use", device=device_id)
+    
+    def __Power_Received(self, appliance: Appliance, message: Z2M_Message) -> None:
+        """
+            Passes the power and state of a plug to its appliance. When the power detector finds the appliance turned on, it is in
+            use, and the Away Timer starts right away if the citizen is not in the kitchen. The scheduler is given the appliance's
+            next deadline, which is now when an off edge was found.
+        """
+        try:
+            power = message.power
+            state = message.state
+        except KeyError:
+            return
+        
+        edge = appliance.Power_Report(message.timeStamp, power, state)
+        if edge and edge.state == "ON" and not appliance.In_Use:
+            self.System_Logger.logStoveOn(appliance.device_id, power)
+            log.info("Appliance turned on", device=appliance.device_id, confidence=round(edge.confidence, 2))
+            appliance.clock_actuator.Start()
+            if self.in_kitchen:
+                self.__Set_State(appliance, Appliance.ON)
+            else:
+                appliance.clock_away.Start()
+                self.__Set_State(appliance, Appliance.AWAY)
+            self.__Checkpoint()
+        
+        if appliance.In_Use:
+            self.__scheduler.Schedule(appliance.device_id, appliance.Next_Deadline(time.time()))
+    
+    def __Occupancy_Received(self, device_id: str, message: Z2M_Message) -> None:
+        """
+            Extracts occupancy from the sensor message and changes the room occupancy accordingly.
+        """
+        before = dict(self.room_occupancy)
+        try:
+            occupancy = message.occupancy
+        except KeyError:
+            pass
+        
+        #The Room where the message was received from
+        room = self.room_sensor[device_id]
+        
+        #Ensures occupancy in at least one room, if current room is the only room with occupancy, and its new occupancy value is false.
+        if list(self.room_occupancy.values()).count(True) == 1 and self.room_occupancy[room] == True and occupancy == False:
+            #Flags the room which is kept occupant
+            self.occupancy_flag = room
+        else:
+            #Update room occupancy
+            self.room_occupancy[room] = occupancy
             
-            #Update the active lights list - depending on which rooms has Occupancy 
-            if self.room_occupancy["Kitchen"] == False:
-                for room in self.room_occupancy:
-                        if room == "Kitchen":
-                            continue
-                        #Adds lights to active lights list
-                        if self.room_occupancy[room] == True and (self.room_light[room] not in self.active_lights):
-                            self.active_lights.append(self.room_light[room])
-                        #Removes lights from active lights list
-                        elif self.room_occupancy[room] == False and (self.room_light[room] in self.active_lights):
-                            self.active_lights.remove(self.room_light[room])
-                            self.__z2m_client.Light_Controls("Off", self.room_light[room]) #Sluk lys hvis rum ikke har occupancy
+            #If there is a Occupancy flag and the new message has occupancy true - Remove the flag, unless its the same room
+            if isinstance(self.occupancy_flag, str) and occupancy == True:
+                if room != self.occupancy_flag:
+                    self.room_occupancy[self.occupancy_flag] = False
+                self.occupancy_flag = None
+        
+        log.debug("Occupancy", room=room, occupancy=occupancy, rooms=dict(self.room_occupancy))
+        
+        #Learn the room transitions from the rooms where occupancy is detected
+        detected_room = room if occupancy == True else None
+        if detected_room:
+            self.Occupancy_Predictor.Observe(detected_room, message.timeStamp)
+        
+        #Update the active lights list - depending on which rooms has Occupancy 
+        if self.room_occupancy["Kitchen"] == False:
+            for room in self.room_occupancy:
+                    if room == "Kitchen":
+                        continue
+                    #Adds lights to active lights list
+                    if self.room_occupancy[room] == True and (self.room_light[room] not in self.active_lights):
+                        self.active_lights.append(self.room_light[room])
+                    #Removes lights from active lights list, except the light pre-lit in the predicted room
+                    elif self.room_occupancy[room] == False and (self.room_light[room] in self.active_lights) and room != self.predicted_room:
+                        self.active_lights.remove(self.room_light[room])
+                        self.__z2m_client.Light_Controls("Off", self.room_light[room]) #Sluk lys hvis rum ikke har occupancy
             
-            print("Occupancy:", self.room_occupancy)
+            #Pre-light the room the citizen most likely goes to next
+            if detected_room:
+                self.__Prelight(detected_room)
+            self.__Checkpoint()
+        
+        #Kitchen detects occupancy and citizen was not in kitchen before. Citizen has then entered Kitchen.
+        if self.room_occupancy["Kitchen"] == True and self.in_kitchen == False: 
+            #Kitchen Entered and Calls Kitchen_Entered method to reset variables and lights
+            self.Kitchen_Entered()
             
-            #Kitchen detects occupancy and citizen was not in kitchen before. Citizen has then entered Kitchen.
-            if self.room_occupancy["Kitchen"] == True and self.in_kitchen == False: 
-                #Kitchen Entered and Calls Kitchen_Entered method to reset variables and lights
-                self.Kitchen_Entered()
+            #The appliances switched off by the system are switched on again and system logs it. Their Actuator Timers start
+            now = time.time()
+            for appliance in self.__in_use.values():
+                if appliance.actuator_dict["State"] == "OFF":
+                    appliance.actuator_dict["State"] = "ON"
+                    self.__z2m_client.Actuator_Controls(appliance.device_id, "ON")
+                    self.System_Logger.logSystemTurnsStoveOn(appliance.device_id)
+                    appliance.clock_actuator.Start()
+                    appliance.Power_Detector.Expect_On(now, appliance.clock_actuator.Actuator_Period)
+                appliance.State = Appliance.ON
+                self.__scheduler.Schedule(appliance.device_id, appliance.Next_Deadline(now))
+            self.__Checkpoint()
                 
-                #If Actuator is switched off, it is switched on again and system logs it. Actuator Timer starts
-                if self.actuator_dict["State"] == "OFF":
-                    self.actuator_dict["State"] = "ON"
-                    self.__z2m_client.Actuator_Controls("Actuator", "ON")
-                    self.System_Logger.logSystemTurnsStoveOn()
-                    self.__clock_actuator.Start()
-                    
-            #Updates occupancy to false and Citizen was previously in kitchen. Citizen has then left Kitchen, system logs it and starts timer
-            elif self.room_occupancy["Kitchen"] == False and self.in_kitchen == True:
-                self.in_kitchen = False
-                self.System_Logger.logCitizenLeftKitchen()
-                self.__clock_away.Start()
+        #Updates occupancy to false and Citizen was previously in kitchen. Citizen has then left Kitchen, system logs it and starts timer
+        elif self.room_occupancy["Kitchen"] == False and self.in_kitchen == True:
+            self.in_kitchen = False
+            self.System_Logger.logCitizenLeftKitchen(self.kitchen_sensor)
+            now = time.time()
+            for appliance in self.__in_use.values():
+                appliance.clock_away.Start()
+                appliance.State = Appliance.AWAY
+                self.__scheduler.Schedule(appliance.device_id, appliance.Next_Deadline(now))
+            self.__scheduler.Schedule(self.LIGHTS, now + self.LIGHTS_PERIOD)
+            self.__Prelight("Kitchen")
+            self.__Checkpoint()
+        
+        self.__Record_Occupancy(before, message.timeStamp)
+    
+    def __Record_Occupancy(self, before: dict, timestamp: float, end: bool = False) -> None:
+        """
+            Records the rooms whose occupancy changed from before to the current room occupancy. With end, the occupied
+            rooms are recorded as no longer occupied.
+        """
+        for room, occupied in self.room_occupancy.items():
+            occupied = bool(occupied) and not end
+            if bool(before.get(room)) != occupied:
+                self.Occupancy_History.Record(room, occupied, timestamp)
+    
+    def __Prelight(self, room: str) -> None:
+        """
+            Called when the citizen is detected in room while away from the kitchen. The previous prediction is settled: if
+            its room has not been detected, its light is turned off again. Then the light in the most probable next room is
+            turned on and added to the active lights, so it is already on when the citizen gets there. The prediction is kept
+            while the sensor in room is blind, since until then it can not tell whether the citizen is still there.
+        """
+        self.__Clear_Prelight()
+        
+        prediction = self.Occupancy_Predictor.Predict(room)
+        if prediction is None or prediction[0] not in self.room_light:
+            return
+        
+        next_room, probability = prediction
+        light = self.room_light[next_room]
+        if light in self.active_lights:
+            return
+        
+        log.debug("Pre-lighting predicted room", room=next_room, probability=round(probability, 2))
+        self.predicted_room = next_room
+        self.prelight_deadline = self.Occupancy_Predictor.Blind_Until(room)
+        self.active_lights.append(light)
+        self.__z2m_client.Light_Controls(self.Away_State, light)
+    
+    def __Clear_Prelight(self) -> None:
+        """
+            Drops the current prediction. The light stays on if the citizen was detected in the predicted room.
+        """
+        if self.predicted_room is None:
+            return
+        
+        room, self.predicted_room = self.predicted_room, None
+        light = self.room_light[room]
+        if self.room_occupancy.get(room) != True and light in self.active_lights:
+            self.active_lights.remove(light)
+            self.__z2m_client.Light_Controls("Off", light)
+    
+    def __Expire_Prelight(self, now: float) -> bool:
+        """
+            Drops the prediction once the sensor of the room it was made from is no longer blind. Returns True if it did.
+        """
+        if self.predicted_room is not None and now >= self.prelight_deadline:
+            self.__Clear_Prelight()
+            return True
+        return False
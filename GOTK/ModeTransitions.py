@@ -0,0 +1,147 @@
+import re
+import time
+import threading
+from collections import Counter
+from typing import Dict, List
+
+from JsonCodec import JsonCodec
+from LoadGenerator import percentile
+
+
+class ModeTransitions:
+    """
+        Measures the transitions between the controller and idle mode of the running system (GOTK.run). Each round trip
+        calls the controller's Go_Idle(), as its scheduler does when no appliance is in use any more, and then publishes
+        kitchen occupancy and power reports of the actuator, as the citizen turning the stove on again does, until the
+        controller has started. The round trip is the time from calling Go_Idle() until the controller runs again.
+
+        After every round trip the threads are compared with those after the first one, so threads left behind by the
+        transitions are found. Thread names are compared without their numbers, since every MQTT client gets a new one.
+    """
+
+    KITCHEN_SENSOR = "Sensor 0"
+    ACTUATOR = "Actuator"
+    PERIOD = 0.002              #Seconds between the reports that bring the system out of idle mode
+    SETTLE = 1.0                #Seconds a stopped thread is given to end before it counts as left behind
+    START_TIMEOUT = 10.0        #Seconds a round trip may take before the run is given up
+
+    def __init__(self, host: str, port: int, controller):
+        self.host = host
+        self.port = port
+        self.controller = controller
+        self.round_trips: List[float] = []
+        self.go_idle: List[float] = []
+        self.leftover: Counter = Counter()
+
+    @staticmethod
+    def Threads() -> Counter:
+        return Counter(re.sub(r"-\d+|-[0-9A-Za-z]{22}$", "", thread.name) for thread in threading.enumerate())
+
+    def Run(self, cycles: int) -> Dict[str, float]:
+        """
+            Starts the controller from idle mode, runs cycles round trips, and returns the report.
+        """
+        from paho.mqtt.client import Client as MqttClient
+
+        publisher = MqttClient()
+        publisher.connect(self.host, self.port)
+        publisher.loop_start()
+
+        self.__wake(publisher)
+        baseline = None
+        for _ in range(cycles):
+            started = time.perf_counter()
+            self.controller.Go_Idle()
+            self.go_idle.append(time.perf_counter() - started)
+            self.__wake(publisher)
+            self.round_trips.append(time.perf_counter() - started)
+
+            if baseline is None:
+                baseline = self.Threads()
+            else:
+                self.leftover = self.__leftover(baseline)
+
+        publisher.loop_stop()
+        publisher.disconnect()
+        return {"cycles": len(self.round_trips),
+                "round_trip_p50_ms": round(percentile(self.round_trips, 0.5) * 1000, 1),
+                "round_trip_p99_ms": round(percentile(self.round_trips, 0.99) * 1000, 1),
+                "round_trip_max_ms": round(max(self.round_trips, default=0) * 1000, 1),
+                "go_idle_p50_ms": round(percentile(self.go_idle, 0.5) * 1000, 1),
+                "go_idle_max_ms": round(max(self.go_idle, default=0) * 1000, 1),
+                "threads": sum(self.Threads().values()),
+                "leftover_threads": dict(self.leftover)}
+
+    def __wake(self, publisher) -> None:
+        """
+            Publishes kitchen occupancy and actuator power until the controller runs.
+        """
+        deadline = time.monotonic() + self.START_TIMEOUT
+        while not self.controller.Controller_Mode:
+            if time.monotonic() > deadline:
+                raise TimeoutError("The controller did not start from idle mode")
+            publisher.publish(f"zigbee2mqtt/{self.KITCHEN_SENSOR}", JsonCodec.dumps({"occupancy": True}))
+            publisher.publish(f"zigbee2mqtt/{self.ACTUATOR}", JsonCodec.dumps({"power": 1200.0, "state": "ON"}))
+            time.sleep(self.PERIOD)
+
+    def __leftover(self, baseline: Counter) -> Counter:
+        deadline = time.monotonic() + self.SETTLE
+        while True:
+            leftover = self.Threads() - baseline
+            if not leftover or time.monotonic() > deadline:
+                return leftover
+            time.sleep(0.01)
+
+
+if __name__ == "__main__":
+    #Measures controller -> idle -> controller round trips, e.g. python3 ModeTransitions.py --cycles 50
+    #Exits with status 1 if threads were left behind
+    import argparse
+    import os
+    import sys
+    import tempfile
+    from http.server import ThreadingHTTPServer
+
+    import GOTK
+    from SystemLog import SystemLog
+    from StandInBroker import StandInBroker
+    from LoadGenerator import LogSink
+    from LogicController import LogicController
+
+    parser = argparse.ArgumentParser(description="Measure the transitions between the controller and idle mode.")
+    parser.add_argument("--broker", help="host:port of an MQTT broker, instead of the in-process stand-in broker")
+    parser.add_argument("--cycles", type=int, default=50)
+    args = parser.parse_args()
+
+    SystemLog.Configure(levels=SystemLog.parse_levels(os.environ.get("GOTK_LOG_LEVEL", "WARNING")))
+
+    if args.broker:
+        host, port = args.broker.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", StandInBroker().Start()
+
+    sink = ThreadingHTTPServer(("127.0.0.1", 0), LogSink)
+    threading.Thread(target=sink.serve_forever, name="Log sink", daemon=True).start()
+
+    #The controller keeps its state in a temporary directory, so the transitions do not touch the installation's files
+    LogicController.DATA_DIR = tempfile.mkdtemp(prefix="gotk-transitions-")
+    LogicController.CHECKPOINT_PATH = os.path.join(LogicController.DATA_DIR, "controller.json")
+    LogicController.LIVE_STATE_PATH = os.path.join(LogicController.DATA_DIR, "live-state")
+    LogicController.MQTT_BROKER_HOST, LogicController.MQTT_BROKER_PORT = host, port
+
+    #The system runs as GOTK.py runs it, starting in idle mode
+    GOTK.device_model = GOTK.create_device_model()
+    GOTK.controller = LogicController(device_model=GOTK.device_model, ServerHost=f"127.0.0.1:{sink.server_port}")
+    threading.Thread(target=GOTK.run, name="GOTK", daemon=True).start()
+
+    transitions = ModeTransitions(host, port, GOTK.controller)
+    report = transitions.Run(args.cycles)
+    GOTK.controller.Go_Idle()
+    sink.shutdown()
+
+    for key, value in report.items():
+        print(f"{key:<24} {value}")
+    if transitions.leftover:
+        print("Threads were left behind by the transitions")
+        sys.exit(1)
@@ -0,0 +1,140 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from OccupancyHistory import OccupancyHistory
+
+
+class OccupancyAnalytics:
+    """
+        Dwell-time, transition and inactivity analytics over the occupancy changes recorded by OccupancyHistory. The
+        changes are held as NumPy arrays in time order, and every analysis is a few vectorized operations over them, so a
+        month of changes is analysed in milliseconds.
+
+        Window() selects the changes in a time window by binary search. A stay that started before the window is not
+        counted in it.
+    """
+
+    PERCENTILES = (50, 90, 99)
+    MIN_INACTIVITY = 30 * 60        #Seconds without any occupancy change that count as an inactivity period
+
+    def __init__(self, rooms: List[str], room_ids: np.ndarray, occupied: np.ndarray, times: np.ndarray):
+        self.rooms = rooms
+        self.room_ids = room_ids
+        self.occupied = occupied
+        self.times = times
+
+    @classmethod
+    def From_History(cls, history: OccupancyHistory) -> "OccupancyAnalytics":
+        room_ids, occupied, times = history.Snapshot()
+        return cls(history.rooms, np.frombuffer(room_ids, dtype=np.uint8), np.frombuffer(occupied, dtype=np.uint8).astype(bool),
+                   np.frombuffer(times, dtype=np.float64))
+
+    def Window(self, start: float = float("-inf"), end: float = float("inf")) -> "OccupancyAnalytics":
+        """
+            Returns the analytics of the changes with start <= time < end.
+        """
+        first, last = np.searchsorted(self.times, [start, end], side="left")
+        return OccupancyAnalytics(self.rooms, self.room_ids[first:last], self.occupied[first:last], self.times[first:last])
+
+    def Dwell_Times(self) -> Dict[str, np.ndarray]:
+        """
+            Returns the durations in seconds of the stays in each room: from its occupancy changing to True until it
+            changes to False again.
+        """
+        dwell = {}
+        for room_id, room in enumerate(self.rooms):
+            mask = self.room_ids == room_id
+            times, occupied = self.times[mask], self.occupied[mask]
+            stays = np.flatnonzero(occupied[:-1] & ~occupied[1:])
+            dwell[room] = times[stays + 1] - times[stays]
+        return dwell
+
+    def Dwell_Distribution(self) -> Dict[str, Dict[str, float]]:
+        """
+            Returns the number, mean and percentiles of the stays in each room, in seconds.
+        """
+        distribution = {}
+        for room, durations in self.Dwell_Times().items():
+            summary = {"count": int(durations.size), "mean_s": round(float(durations.mean()), 1) if durations.size else 0.0}
+            if durations.size:
+                for p, value in zip(self.PERCENTILES, np.percentile(durations, self.PERCENTILES)):
+                    summary[f"p{p}_s"] = round(float(value), 1)
+            distribution[room] = summary
+        return distribution
+
+    def Transition_Matrix(self) -> np.ndarray:
+        """
+            Returns the counts of the room-to-room transitions, [from, to], in the order of the rooms. A transition is an
+            occupancy change to True in another room than the previous one.
+        """
+        n = len(self.rooms)
+        entered = self.room_ids[self.occupied].astype(np.intp)
+        moved = entered[:-1] != entered[1:]
+        index = entered[:-1][moved] * n + entered[1:][moved]
+        return np.bincount(index, minlength=n * n).reshape(n, n)
+
+    def Transition_Probabilities(self) -> np.ndarray:
+        """
+            Returns the transition matrix normalized per row. Rooms that were never left have a row of zeros.
+        """
+        counts = self.Transition_Matrix().astype(np.float64)
+        totals = counts.sum(axis=1, keepdims=True)
+        return np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+
+    def Inactivity_Periods(self, min_duration: Optional[float] = None) -> np.ndarray:
+        """
+            Returns the periods without any occupancy change of at least min_duration seconds, as rows of (start, end).
+        """
+        min_duration = self.MIN_INACTIVITY if min_duration is None else min_duration
+        gaps = np.flatnonzero(np.diff(self.times) >= min_duration)
+        return np.column_stack((self.times[gaps], self.times[gaps + 1]))
+
+    def Summary(self) -> dict:
+        inactivity = self.Inactivity_Periods()
+        return {"changes": int(self.times.size),
+                "dwell": self.Dwell_Distribution(),
+                "transitions": {room: {to: int(count) for to, count in zip(self.rooms, row) if count}
+                                for room, row in zip(self.rooms, self.Transition_Matrix())},
+                "inactivity_periods": int(len(inactivity)),
+                "inactivity_s": round(float((inactivity[:, 1] - inactivity[:, 0]).sum()), 1)}
+
+
+if __name__ == "__main__":
+    #Analyses the recorded occupancy history, e.g. python3 OccupancyAnalytics.py --days 7
+    #With --synthetic a month of occupancy changes is generated instead, to time the analyses
+    import argparse
+    import os
+    import time
+
+    parser = argparse.ArgumentParser(description="Dwell times, transitions and inactivity of the citizen.")
+    parser.add_argument("--days", type=float, help="only the last days of the history")
+    parser.add_argument("--synthetic", action="store_true")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        #A stay of 1 to 30 minutes in a random room every 1 to 35 minutes, for 30 days
+        rng = np.random.default_rng(1)
+        rooms = ["Kitchen", "Room 1", "Room 2", "Room 3", "Room 4"]
+        history = OccupancyHistory(rooms)
+        now = time.time() - 30 * 86400
+        while now < time.time():
+            room = rooms[rng.integers(len(rooms))]
+            stay = rng.uniform(60, 1800)
+            history.Record(room, True, now)
+            history.Record(room, False, now + stay)
+            now += stay + rng.uniform(0, 300)
+    else:
+        import Settings
+        history = OccupancyHistory(None, os.path.join(Settings.DATA_DIR, "occupancy.bin"))
+
+    started = time.perf_counter()
+    analytics = OccupancyAnalytics.From_History(history)
+    if args.days:
+        analytics = analytics.Window(time.time() - args.days * 86400)
+    summary = analytics.Summary()
+    elapsed = (time.perf_counter() - started) * 1000
+
+    for key, value in summary.items():
+        print(f"{key:<20} {value}")
+    print(f"{'analysed_in_ms':<20} {elapsed:.1f}")
@@ -0,0 +1,106 @@
+import struct
+from array import array
+from threading import Lock
+from typing import List, Optional, Tuple
+
+from AtomicFile import AtomicFile
+
+
+class OccupancyHistory:
+    """
+        Ring buffer of the occupancy changes of the rooms: every time a room's occupancy changes, its room id, new
+        occupancy and the time are appended to three preallocated typed arrays. When the buffer is full the oldest
+        changes are overwritten, so recording is O(1) and never allocates.
+
+        The arrays are handed to OccupancyAnalytics without conversion (see Snapshot()), which computes dwell times,
+        transitions and inactivity over them with NumPy. The history is saved to and loaded from a binary file, so it
+        covers the sessions of the controller over the last weeks.
+    """
+
+    CAPACITY = 1 << 17              #Occupancy changes kept, about 1.3 MB
+    HEADER = struct.Struct("<III")  #Capacity, count and next index, followed by the room names, one per line
+
+    def __init__(self, rooms: Optional[List[str]], path: Optional[str] = None, capacity: int = CAPACITY):
+        """
+            rooms: The rooms, whose index in the list is their room id. With None the rooms of the file are used.
+            path: Optional file the history is loaded from and saved to. A file of other rooms or capacity is ignored.
+        """
+        self.rooms = list(rooms or [])
+        self.path = path
+        self.capacity = capacity
+        self.__lock = Lock()
+
+        self.__room = array("B", bytes(capacity))
+        self.__occupied = array("B", bytes(capacity))
+        self.__time = array("d", bytes(8 * capacity))
+        self.__count = 0
+        self.__next = 0
+        self.__saved = True     #False while there are changes that are not saved
+
+        data = AtomicFile.Read(path) if path else None
+        if data:
+            self.__load(data, rooms is None)
+        self.__room_ids = {room: i for i, room in enumerate(self.rooms)}
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def Record(self, room: str, occupied: bool, timestamp: float) -> None:
+        """
+            Appends an occupancy change of room. Rooms that are not in the history are ignored.
+        """
+        room_id = self.__room_ids.get(room)
+        if room_id is None:
+            return
+        with self.__lock:
+            i = self.__next
+            self.__room[i] = room_id
+            self.__occupied[i] = 1 if occupied else 0
+            self.__time[i] = timestamp
+            self.__next = (i + 1) % self.capacity
+            self.__count = min(self.__count + 1, self.capacity)
+            self.__saved = False
+
+    def Snapshot(self) -> Tuple[array, array, array]:
+        """
+            Returns copies of the room ids, occupancies and times of the recorded changes, oldest first.
+        """
+        with self.__lock:
+            if self.__count < self.capacity:
+                return self.__room[:self.__count], self.__occupied[:self.__count], self.__time[:self.__count]
+            n = self.__next
+            return (self.__room[n:] + self.__room[:n], self.__occupied[n:] + self.__occupied[:n],
+                    self.__time[n:] + self.__time[:n])
+
+    def Save(self) -> None:
+        """
+            Writes the history to its file, if it has one and it changed since the last save.
+        """
+        if self.path is None:
+            return
+        with self.__lock:
+            if self.__saved:
+                return
+            self.__saved = True
+            data = (self.HEADER.pack(self.capacity, self.__count, self.__next) + "\n".join(self.rooms).encode("utf-8") +
+                    b"\0" + self.__room.tobytes() + self.__occupied.tobytes() + self.__time.tobytes())
+        try:
+            AtomicFile.Write(self.path, data)
+        except OSError:
+            self.__saved = False
+            raise
+
+    def __load(self, data: bytes, any_rooms: bool) -> None:
+        capacity, count, next_index = self.HEADER.unpack_from(data)
+        names_end = data.index(b"\0", self.HEADER.size)
+        rooms = data[self.HEADER.size:names_end].decode("utf-8").split("\n")
+        if capacity != self.capacity or (rooms != self.rooms and not any_rooms) or len(data) != names_end + 1 + 10 * capacity:
+            return
+        self.rooms = rooms
+
+        offset = names_end + 1
+        self.__room = array("B", data[offset:offset + capacity])
+        self.__occupied = array("B", data[offset + capacity:offset + 2 * capacity])
+        self.__time = array("d")
+        self.__time.frombytes(data[offset + 2 * capacity:])
+        self.__count, self.__next = count, next_index
@@ -0,0 +1,109 @@
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from AtomicFile import AtomicFile
+from JsonCodec import JsonCodec
+
+
+class OccupancyPredictor:
+    """
+        Learns the room-to-room transitions of the citizen from the sequence of rooms where the PIR sensors detect
+        occupancy, and predicts the most probable next room.
+
+        The transition counts are kept per room, together with the most frequent next room, so both learning and
+        predicting are O(1) per event. The predictor also knows how long each room's sensor is blind after a detection
+        (see HeucodEvent.sensor_blind_duration): while a sensor is blind it can not report that the citizen is still, or
+        again, in its room, so a prediction made from that room is only trusted for that long.
+    """
+
+    MIN_OBSERVATIONS = 3        #Transitions out of a room needed before it is used for predictions
+    MIN_PROBABILITY = 0.5       #Probability needed before the next room is predicted
+    DEFAULT_BLIND_DURATION = 60 #Seconds, the detection interval of the Aqara motion sensors
+
+    def __init__(self, blind_durations: Dict[str, float], path: Optional[str] = None):
+        """
+            blind_durations: The blind duration in seconds of the sensor in each room.
+            path: Optional file the transition counts are loaded from and saved to.
+        """
+        self.blind_durations = blind_durations
+        self.path = path
+        self.__counts: Dict[str, Dict[str, int]] = {}
+        self.__totals: Dict[str, int] = {}
+        self.__best: Dict[str, str] = {}
+        self.__last_room: Optional[str] = None
+        self.__last_detection: Dict[str, float] = {}
+        #The counts are saved from another thread than the one observing, and only when they changed
+        self.__lock = Lock()
+        self.__changed = False
+
+        data = AtomicFile.Read(path) if path else None
+        if data:
+            for room, counts in JsonCodec.loads(data).items():
+                self.__counts[room] = counts
+                self.__totals[room] = sum(counts.values())
+                self.__best[room] = max(counts, key=counts.get)
+
+    def Observe(self, room: str, timestamp: float) -> None:
+        """
+            Records that occupancy was detected in room. If the citizen was last seen in another room, the transition
+            is counted.
+        """
+        self.__last_detection[room] = timestamp
+
+        previous, self.__last_room = self.__last_room, room
+        if previous is None or previous == room:
+            return
+
+        with self.__lock:
+            counts = self.__counts.setdefault(previous, {})
+            counts[room] = counts.get(room, 0) + 1
+            self.__changed = True
+        self.__totals[previous] = self.__totals.get(previous, 0) + 1
+
+        #Only the count that changed can overtake the current best
+        best = self.__best.get(previous)
+        if best is None or counts[room] > counts[best]:
+            self.__best[previous] = room
+
+    def Predict(self, room: str) -> Optional[Tuple[str, float]]:
+        """
+            Returns the most probable next room after room and its probability, or None if there is no confident
+            prediction.
+        """
+        best = self.__best.get(room)
+        total = self.__totals.get(room, 0)
+        if best is None or total < self.MIN_OBSERVATIONS:
+            return None
+
+        probability = self.__counts[room][best] / total
+        return (best, probability) if probability >= self.MIN_PROBABILITY else None
+
+    def Blind_Until(self, room: str) -> float:
+        """
+            Returns the time until which the sensor of room is blind after its last detection.
+        """
+        return self.__last_detection.get(room, float("-inf")) + \
+            self.blind_durations.get(room, self.DEFAULT_BLIND_DURATION)
+
+    def Reset_Sequence(self, room: Optional[str] = None) -> None:
+        """
+            Starts a new sequence of rooms, e.g. when the controller starts, so no transition is counted across it.
+        """
+        self.__last_room = room
+
+    def Save(self) -> None:
+        """
+            Saves the transition counts, if a path was given and they changed since the last save.
+        """
+        if not self.path:
+            return
+        with self.__lock:
+            if not self.__changed:
+                return
+            data = JsonCodec.dumps(self.__counts)
+            self.__changed = False
+        try:
+            AtomicFile.Write(self.path, data)
+        except OSError:
+            self.__changed = True
+            raise
@@ -0,0 +1,323 @@
+import math
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from AtomicFile import AtomicFile
+from JsonCodec import JsonCodec
+
+
+class PowerEdge(NamedTuple):
+    """ An on/off edge detected in the power signal of a plug, with a confidence between 0 and 1. """
+    state: str
+    timestamp: float
+    confidence: float
+
+
+class PowerDetector:
+    """
+        Streaming detector for the on/off state of an appliance behind a smart plug.
+
+        The last samples are kept in a fixed-size ring buffer, and the power is filtered with a moving median over the
+        samples of the last MEDIAN_SPAN seconds. With fast reporting this removes single spikes and dips, while with sparse
+        reporting the median is just the last sample.
+
+        The filtered power is compared against two thresholds (hysteresis): the appliance is ON when it rises above
+        ON_THRESHOLD, and a low period starts when it falls below OFF_THRESHOLD. Values in between keep the current state.
+
+        Hobs and ovens cycle their heating elements, so a low period is not necessarily the appliance being turned off.
+        Every low period that ends with the power coming back is remembered as a duty-cycle gap. An OFF edge is emitted when
+        the low period has lasted long enough compared to these gaps: the confidence is the share of the learned gaps (with
+        a margin) that are shorter than the current low period, times a term that grows with the time spent low.
+
+        The learned gaps are a property of the appliance, so they are saved and loaded again after a restart. An appliance
+        without gaps (a kettle) is taken for off after a low period of about MIN_OFF_TIME. Once it has shown a gap, but fewer
+        than MIN_GAPS, longer gaps are likely to follow, so it is only taken for off after MAX_OFF_TIME. A new appliance that
+        cycles therefore gives one false off edge, at its first gap, which is then learned.
+    """
+
+    ON_THRESHOLD = 6            #Watts, above which the appliance is considered on
+    OFF_THRESHOLD = 2           #Watts, below which a low period starts
+    WINDOW = 5                  #Samples in the ring buffer
+    MEDIAN_SPAN = 10            #Seconds of samples used for the moving median
+    MIN_OFF_TIME = 5            #Seconds of low power before an off edge, when no cycling has been seen
+    MAX_OFF_TIME = 60           #Seconds of low power after which the appliance is always considered off
+    GAP_MARGIN = 1.25           #A low period must last this factor longer than a learned gap to rule it out
+    GAP_HISTORY = 64            #Number of duty-cycle gaps remembered
+    MIN_GAPS = 8                #Gaps needed before they are used, instead of MAX_OFF_TIME, for an appliance that cycles
+    MIN_CONFIDENCE = 0.95       #Confidence needed before an off edge is emitted
+
+    def __init__(self, path: Optional[str] = None):
+        """
+            path: Optional file the learned duty-cycle gaps are loaded from and saved to.
+        """
+        self.path = path
+        self.__times = [0.0] * self.WINDOW
+        self.__powers = [0.0] * self.WINDOW
+        self.__index = 0
+        self.__count = 0
+
+        self.__gaps = [0.0] * self.GAP_HISTORY
+        self.__gap_index = 0
+        self.__gap_count = 0
+        #The gaps are saved from another thread than the one updating, and only when they changed
+        self.__lock = Lock()
+        self.__changed = False
+
+        data = AtomicFile.Read(path) if path else None
+        if data:
+            for gap in JsonCodec.loads(data).get("gaps", [])[-self.GAP_HISTORY:]:
+                self.__add_gap(gap)
+            self.__changed = False
+
+        self.State = "OFF"
+        self.__low_since: Optional[float] = None
+        self.__grace_until = float("-inf")
+        self.__expecting = False
+        self.__last_off: Optional[Tuple[float, float]] = None
+
+    def Update(self, timestamp: float, power: Optional[float]) -> Optional[PowerEdge]:
+        """
+            Adds a power sample. Returns the edge if the sample changed the state, otherwise None.
+        """
+        self.__times[self.__index] = timestamp
+        self.__powers[self.__index] = power or 0
+        self.__index = (self.__index + 1) % self.WINDOW
+        self.__count = min(self.__count + 1, self.WINDOW)
+
+        filtered = self.Filtered_Power(timestamp)
+
+        if self.State == "OFF":
+            if filtered >= self.ON_THRESHOLD:
+                #If the power comes back shortly after an off edge, the edge was a duty-cycle gap longer than any seen so far
+                if self.__last_off is not None and timestamp - self.__last_off[0] < self.MAX_OFF_TIME:
+                    self.__add_gap(timestamp - self.__last_off[0])
+                self.__last_off = None
+                self.State = "ON"
+                self.__low_since = None
+                return PowerEdge("ON", timestamp, self.__share(lambda p: p >= self.ON_THRESHOLD, timestamp))
+            return None
+
+        if filtered >= self.ON_THRESHOLD and self.__low_since is not None:
+            #The power came back, so the low period was a duty-cycle gap. After Expect_On it was the plug starting up
+            if not self.__expecting:
+                self.__add_gap(timestamp - self.__low_since)
+            self.__expecting = False
+            self.__low_since = None
+        elif filtered < self.OFF_THRESHOLD and self.__low_since is None:
+            self.__low_since = self.__first_low(timestamp)
+
+        return self.Poll(timestamp)
+
+    def Poll(self, now: float) -> Optional[PowerEdge]:
+        """
+            Checks whether the current low period has lasted long enough to be an off edge. This must also be called
+            without new samples, since a plug may stop reporting once the power stays at zero.
+        """
+        if self.State != "ON" or self.__low_since is None or now < self.__grace_until:
+            return None
+
+        confidence = self.Off_Confidence(now)
+        if confidence < self.MIN_CONFIDENCE:
+            return None
+
+        #The appliance is off. The learned gaps are kept, since the duty cycle is a property of the appliance
+        self.State = "OFF"
+        self.__last_off = (self.__low_since, now)
+        self.__low_since = None
+        return PowerEdge("OFF", now, confidence)
+
+    def Expect_On(self, timestamp: float, grace: float) -> None:
+        """
+            Used when the system turns the plug on again. The appliance is assumed to be on, but it may take up to grace
+            seconds before its power is reported, so no off edge is emitted before then.
+        """
+        self.State = "ON"
+        self.__low_since = timestamp
+        self.__grace_until = timestamp + grace
+        self.__expecting = True
+
+    @property
+    def Low(self) -> bool:
+        """ True while the appliance is on but its power is low, i.e. while Poll() can emit an off edge. """
+        return self.State == "ON" and self.__low_since is not None
+
+    def Filtered_Power(self, now: float) -> float:
+        """
+            Returns the median of the samples received within the last MEDIAN_SPAN seconds.
+        """
+        recent = sorted(self.__powers[i] for i in range(self.__count) if now - self.__times[i] <= self.MEDIAN_SPAN)
+        if not recent:
+            return 0.0
+        middle = len(recent) // 2
+        return recent[middle] if len(recent) % 2 else (recent[middle - 1] + recent[middle]) / 2
+
+    def Off_Confidence(self, now: float) -> float:
+        """
+            Returns the confidence that the appliance has been turned off, given the current low period.
+        """
+        if self.__low_since is None:
+            return 0.0
+
+        low = now - self.__low_since
+        if low >= self.MAX_OFF_TIME:
+            return 1.0
+
+        gaps = self.__gaps[:self.__gap_count]
+        if 0 < len(gaps) < self.MIN_GAPS:
+            return 0.0
+        time_term = 1 - math.exp(-3 * low / self.MIN_OFF_TIME)
+        gap_term = (sum(1 for g in gaps if g * self.GAP_MARGIN <= low) + 1) / (len(gaps) + 1)
+        return time_term * gap_term
+
+    def Gaps(self) -> List[float]:
+        """
+            Returns the learned duty-cycle gaps, oldest first.
+        """
+        with self.__lock:
+            if self.__gap_count < self.GAP_HISTORY:
+                return self.__gaps[:self.__gap_count]
+            return self.__gaps[self.__gap_index:] + self.__gaps[:self.__gap_index]
+
+    def Save(self) -> None:
+        """
+            Saves the learned gaps, if a path was given and they changed since the last save.
+        """
+        if not self.path:
+            return
+        with self.__lock:
+            if not self.__changed:
+                return
+            self.__changed = False
+        try:
+            AtomicFile.Write(self.path, JsonCodec.dumps({"gaps": [round(gap, 1) for gap in self.Gaps()]}))
+        except OSError:
+            self.__changed = True
+            raise
+
+    def __add_gap(self, gap: float) -> None:
+        with self.__lock:
+            self.__gaps[self.__gap_index] = gap
+            self.__gap_index = (self.__gap_index + 1) % self.GAP_HISTORY
+            self.__gap_count = min(self.__gap_count + 1, self.GAP_HISTORY)
+            self.__changed = True
+
+    def __first_low(self, now: float) -> float:
+        #The low period starts at the first of the trailing samples below OFF_THRESHOLD, not when the median followed them
+        start = now
+        for back in range(1, self.__count + 1):
+            i = (self.__index - back) % self.WINDOW
+            if self.__powers[i] >= self.OFF_THRESHOLD:
+                break
+            start = self.__times[i]
+        return start
+
+    def __share(self, predicate, now: float) -> float:
+        recent = [self.__powers[i] for i in range(self.__count) if now - self.__times[i] <= self.MEDIAN_SPAN]
+        return sum(1 for p in recent if predicate(p)) / len(recent) if recent else 0.0
+
+    @classmethod
+    def Replay(cls, samples: Sequence[Tuple[float, float]], poll_period: float = 1.0,
+               detector: Optional["PowerDetector"] = None) -> List[PowerEdge]:
+        """
+            Runs a detector over recorded (timestamp, power) samples, polling every poll_period seconds between samples
+            like the controller does, and returns the detected edges. A new detector is used unless one is given, e.g.
+            one with learned gaps.
+        """
+        detector = detector or cls()
+        edges = []
+        previous = None
+        for timestamp, power in samples:
+            if previous is not None:
+                now = previous + poll_period
+                while now < timestamp:
+                    edge = detector.Poll(now)
+                    if edge:
+                        edges.append(edge)
+                    now += poll_period
+            edge = detector.Update(timestamp, power)
+            if edge:
+                edges.append(edge)
+            previous = timestamp
+
+        #Keep polling after the last sample, since the plug may have stopped reporting
+        if previous is not None:
+            now = previous + poll_period
+            while now <= previous + cls.MAX_OFF_TIME:
+                edge = detector.Poll(now)
+                if edge:
+                    edges.append(edge)
+                    break
+                now += poll_period
+        return edges
+
+    @classmethod
+    def Evaluate(cls, samples: Sequence[Tuple[float, float]], off_times: Sequence[float],
+                 tolerance: float = 300, detector: Optional["PowerDetector"] = None) -> Dict[str, float]:
+        """
+            Validates the detector against a labelled trace. off_times are the true times the appliance was turned off.
+            An off edge within tolerance seconds after a true off time is a detection, any other off edge is a false
+            positive. Returns the number of detections, misses and false positives, and the mean and maximum latency.
+        """
+        off_edges = [e.timestamp for e in cls.Replay(samples, detector=detector) if e.state == "OFF"]
+        latencies = []
+        matched = set()
+        for off_time in off_times:
+            hits = [t for t in off_edges if off_time <= t <= off_time + tolerance and t not in matched]
+            if hits:
+                matched.add(hits[0])
+                latencies.append(hits[0] - off_time)
+
+        return {"detections": len(latencies),
+                "misses": len(off_times) - len(latencies),
+                "false_positives": len(off_edges) - len(matched),
+                "mean_latency": sum(latencies) / len(latencies) if latencies else float("nan"),
+                "max_latency": max(latencies, default=float("nan"))}
+
+
+if __name__ == "__main__":
+    #Replays the samples recorded by the time-series store, e.g. python3 PowerDetector.py ~/.gotk/power/Actuator
+    #With --check, validates the detector against the labelled traces instead, e.g. python3 PowerDetector.py --check traces
+    #and exits with status 1 if an off edge is missed, comes later than the max_latency of the trace or a false off edge
+    #is seen. The detector is checked as it runs once it knows the appliance: it first learns the gaps from a replay of the
+    #trace, saves them and loads them into a new detector, as after a restart. The false off edges of a new detector, which
+    #is still learning, are only reported
+    import argparse
+    import glob
+    import json
+    import os
+    import sys
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Replay recorded power samples through the on/off detector.")
+    parser.add_argument("path", help="directory of the time-series store of a plug, or of the traces with --check")
+    parser.add_argument("--check", action="store_true", help="validate against the labelled traces (*.json)")
+    args = parser.parse_args()
+
+    if not args.check:
+        from TimeSeriesStore import TimeSeriesStore
+
+        store = TimeSeriesStore(args.path)
+        for edge in PowerDetector.Replay([(s.timestamp, s.power) for s in store.Range(0, float("inf"))]):
+            print(f"{edge.timestamp:.1f} {edge.state} confidence={edge.confidence:.2f}")
+        sys.exit(0)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        for path in sorted(glob.glob(os.path.join(args.path, "*.json"))):
+            with open(path) as f:
+                trace = json.load(f)
+            new = PowerDetector.Evaluate(trace["samples"], trace["off_times"])
+
+            gaps_path = os.path.join(directory, os.path.basename(path))
+            learning = PowerDetector(gaps_path)
+            PowerDetector.Replay(trace["samples"], detector=learning)
+            learning.Save()
+            result = PowerDetector.Evaluate(trace["samples"], trace["off_times"], detector=PowerDetector(gaps_path))
+
+            ok = result["misses"] == 0 and result["max_latency"] <= trace["max_latency"] and result["false_positives"] == 0
+            failed = failed or not ok
+            print(f"{os.path.basename(path):<16} {'ok' if ok else 'FAILED':<7} detections={result['detections']} "
+                  f"misses={result['misses']} false_positives={result['false_positives']} "
+                  f"mean_latency={result['mean_latency']:.1f}s max_latency={result['max_latency']:.1f}s "
+                  f"(new detector: false_positives={new['false_positives']} misses={new['misses']})")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,132 @@
+import time
+import queue
+from bisect import bisect_left
+from collections import deque
+from threading import Condition
+from typing import Any, Dict, List, Optional
+
+
+class LaneStats:
+    """
+        Queueing latency statistics of one lane: count, mean, maximum and an approximate 99th percentile, taken from a
+        fixed histogram of the waiting times so recording stays O(1).
+    """
+
+    BUCKETS_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf")]
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.histogram = [0] * len(self.BUCKETS_MS)
+
+    def Record(self, wait: float) -> None:
+        wait_ms = wait * 1000
+        self.count += 1
+        self.total += wait_ms
+        self.maximum = max(self.maximum, wait_ms)
+        self.histogram[bisect_left(self.BUCKETS_MS, wait_ms)] += 1
+
+    def Percentile(self, fraction: float) -> float:
+        """
+            Returns the upper bound of the histogram bucket holding the given fraction of the waiting times.
+        """
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS_MS, self.histogram):
+            seen += count
+            if seen >= target and count:
+                return min(bound, self.maximum)
+        return 0.0
+
+    def Summary(self) -> Dict[str, float]:
+        return {"count": self.count,
+                "mean_ms": round(self.total / self.count, 3) if self.count else 0.0,
+                "p99_ms": round(self.Percentile(0.99), 3),
+                "max_ms": round(self.maximum, 3)}
+
+
+class PriorityEventQueue:
+    """
+        Event queue with priority lanes. Lane 0 is the highest priority. get() always takes the oldest item of the highest
+        non-empty lane, with two exceptions that protect the lower lanes from starvation: when the oldest item of a lower
+        lane has waited longer than MAX_WAIT, or when MAX_BURST items in a row were taken while a lower lane was waiting,
+        one item of the lower lane is taken first.
+
+        The interface follows queue.Queue: put(), get(timeout) raising queue.Empty, and qsize(). Wake() makes a waiting get()
+        raise queue.Empty at once, so the consumer can wait without a timeout and still be stopped right away.
+    """
+
+    SAFETY = 0
+    OCCUPANCY = 1
+    BACKGROUND = 2
+    LANE_NAMES = ("safety", "occupancy", "background")
+
+    MAX_BURST = 32          #Items taken from higher lanes in a row before a waiting lower lane is served once
+    MAX_WAIT = 1.0          #Seconds a lower lane item may wait before it is served next
+
+    def __init__(self, lanes: int = 3):
+        self.__lanes: List[deque] = [deque() for _ in range(lanes)]
+        self.__stats = [LaneStats() for _ in range(lanes)]
+        self.__condition = Condition()
+        self.__burst = 0
+        self.__woken = False
+
+    def put(self, item: Any, lane: int = BACKGROUND) -> None:
+        with self.__condition:
+            self.__lanes[lane].append((time.monotonic(), item))
+            self.__condition.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """
+            Removes and returns the next item. Raises queue.Empty if no item arrives within timeout seconds.
+        """
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: self.__woken or self.qsize(), timeout) or not self.qsize():
+                self.__woken = False
+                raise queue.Empty
+
+            now = time.monotonic()
+            lane = self.__next_lane(now)
+            enqueued, item = self.__lanes[lane].popleft()
+            self.__stats[lane].Record(now - enqueued)
+            return item
+
+    def Wake(self) -> None:
+        """
+            Makes the waiting get(), or the next one if none is waiting, raise queue.Empty unless an item is available.
+        """
+        with self.__condition:
+            self.__woken = True
+            self.__condition.notify_all()
+
+    def qsize(self) -> int:
+        return sum(len(lane) for lane in self.__lanes)
+
+    def Stats(self) -> Dict[str, Dict[str, float]]:
+        """
+            Returns the latency statistics and the current depth of every lane.
+        """
+        with self.__condition:
+            return {name: dict(stats.Summary(), depth=len(lane))
+                    for name, stats, lane in zip(self.LANE_NAMES, self.__stats, self.__lanes)}
+
+    def __next_lane(self, now: float) -> int:
+        non_empty = [i for i, lane in enumerate(self.__lanes) if lane]
+        highest, lower = non_empty[0], non_empty[1:]
+
+        if not lower:
+            self.__burst = 0
+            return highest
+
+        #Serve a lower lane whose oldest item has waited too long, or the next lower lane after a long burst
+        for lane in lower:
+            if now - self.__lanes[lane][0][0] > self.MAX_WAIT:
+                self.__burst = 0
+                return lane
+        if self.__burst >= self.MAX_BURST:
+            self.__burst = 0
+            return lower[0]
+
+        self.__burst += 1
+        return highest
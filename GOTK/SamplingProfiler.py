@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+import signal
+import socket
+from collections import Counter
+from threading import Event, Lock, Thread, current_thread, enumerate as enumerate_threads
+from typing import Dict, Optional
+
+from AtomicFile import AtomicFile
+from SystemLog import SystemLog
+
+log = SystemLog.get("Profiler")
+
+
+class SamplingProfiler:
+    """
+        On-demand sampling profiler for the running gateway, to find the thread (paho loop, Z2M worker, schedulers, ...)
+        that burns the CPU without restarting the system.
+
+        While a profile runs, a sampler thread takes the stacks of all other threads (sys._current_frames()) RATE times a
+        second and counts them per thread. When the duration has passed, the counts are written as folded stacks, one line
+        "thread;file:function;...;file:function count" per distinct stack, which flamegraph.pl and speedscope read directly.
+
+        Nothing runs while no profile is running: the signal handler is only called by the signal, and the control socket
+        thread waits in accept(). A profile is started with SIGNAL (kill -USR2 <pid>), with the default rate and duration,
+        or through the control socket, see the commands of __command() and the __main__ block. Sending SIGNAL again stops
+        the running profile early.
+    """
+
+    RATE = 100                  #Samples per second
+    DURATION = 30               #Seconds profiled by default
+    MAX_RATE = 1000
+    MAX_DURATION = 600
+    SIGNAL = signal.SIGUSR2
+    SOCKET_NAME = "profiler.sock"
+
+    def __init__(self, directory: str):
+        """
+            directory: Where the folded stack files (profile-<time>.folded) and the control socket are placed.
+        """
+        self.directory = directory
+        self.last_profile: Optional[str] = None
+        self.__path: Optional[str] = None
+        self.__lock = Lock()
+        self.__stop = Event()
+        self.__thread: Optional[Thread] = None
+        self.__socket: Optional[socket.socket] = None
+
+    def Install(self, control_socket: bool = True) -> None:
+        """
+            Registers the signal handler and opens the control socket. Must be called from the main thread.
+        """
+        signal.signal(self.SIGNAL, self.__on_signal)
+        if control_socket and hasattr(socket, "AF_UNIX"):
+            path = os.path.join(self.directory, self.SOCKET_NAME)
+            os.makedirs(self.directory, exist_ok=True)
+            if os.path.exists(path):
+                os.remove(path)
+            self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.__socket.bind(path)
+            os.chmod(path, 0o600)
+            self.__socket.listen(1)
+            Thread(target=self.__serve, name="Profiler control", daemon=True).start()
+
+    @property
+    def Running(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def Start(self, duration: float = DURATION, rate: float = RATE) -> Optional[str]:
+        """
+            Starts a profile of duration seconds at rate samples per second. Returns the path the profile will be written
+            to, or None if one is already running.
+        """
+        with self.__lock:
+            if self.Running:
+                return None
+            duration = min(max(duration, 0.1), self.MAX_DURATION)
+            rate = min(max(rate, 1), self.MAX_RATE)
+            self.__path = os.path.join(self.directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+            self.__stop.clear()
+            self.__thread = Thread(target=self.__sample, args=(duration, rate, self.__path), name="Profiler", daemon=True)
+            self.__thread.start()
+        log.info("Profiling started", duration=duration, rate=rate, path=self.__path)
+        return self.__path
+
+    def Stop(self, wait: bool = True) -> Optional[str]:
+        """
+            Stops the running profile, which is written as if its duration had passed. Returns the path of the last profile.
+        """
+        self.__stop.set()
+        thread = self.__thread
+        if wait and thread is not None and thread is not current_thread():
+            thread.join()
+        return self.last_profile
+
+    #----------------------------- Sampling -----------------------------
+
+    def __sample(self, duration: float, rate: float, path: str) -> None:
+        stacks: Counter = Counter()
+        #Code objects are formatted once, and the thread names are looked up again only when a new thread shows up
+        frame_names: Dict[object, str] = {}
+        thread_names: Dict[int, str] = {}
+        own = current_thread().ident
+        period = 1 / rate
+        samples = 0
+
+        started = time.monotonic()
+        deadline = started + duration
+        next_sample = started
+        while not self.__stop.is_set():
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in thread_names:
+                    thread_names.update((t.ident, t.name) for t in enumerate_threads())
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = frame_names.get(code)
+                    if name is None:
+                        name = frame_names[code] = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+                    stack.append(name)
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, str(ident)).replace(";", ","))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+
+            next_sample += period
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            #A late sampler skips the samples it missed instead of catching up
+            if next_sample < now:
+                next_sample = now
+            self.__stop.wait(min(next_sample, deadline) - now)
+
+        elapsed = time.monotonic() - started
+        AtomicFile.Write(path, "".join(f"{stack} {count}\n" for stack, count in stacks.most_common()).encode("utf-8"))
+        self.last_profile = path
+        log.info("Profile written", path=path, samples=samples, elapsed_s=round(elapsed, 1),
+                 sampling_cpu_ms=round(time.thread_time() * 1000, 1))
+
+    #----------------------------- Control -----------------------------
+
+    def __on_signal(self, signum, frame) -> None:
+        #Runs in the main thread between bytecodes, so it only starts or stops the sampler thread
+        if self.Running:
+            self.Stop(wait=False)
+        else:
+            self.Start()
+
+    def __serve(self) -> None:
+        while True:
+            try:
+                connection, _ = self.__socket.accept()
+            except OSError:
+                return
+            with connection:
+                try:
+                    request = connection.makefile("r").readline()
+                    connection.sendall((self.__command(request.split()) + "\n").encode("utf-8"))
+                except (OSError, ValueError) as error:
+                    log.warning("Profiler control request failed", error=error)
+
+    def __command(self, args) -> str:
+        """
+            start [seconds] [rate]  Starts a profile, and answers at once with the path it will be written to.
+            stop                    Stops the running profile, and answers with its path once it is written.
+            status                  Answers "running" and the path of the running profile, or "idle" and the path
+                                    of the last profile.
+
+            The connections are served one at a time, so no command waits for a running profile to end.
+        """
+        command = args[0] if args else "status"
+        if command == "start":
+            duration = float(args[1]) if len(args) > 1 else self.DURATION
+            rate = float(args[2]) if len(args) > 2 else self.RATE
+            return self.Start(duration, rate) or "error: a profile is already running"
+        if command == "stop":
+            return self.Stop() or "error: no profile"
+        if command == "status":
+            if self.Running:
+                return f"running {self.__path}"
+            return f"idle {self.last_profile or ''}".strip()
+        return f"error: unknown command {command}"
+
+
+if __name__ == "__main__":
+    #Profiles the running gateway, e.g. python3 SamplingProfiler.py start 30 200
+    #The answer is the path of the folded stacks, for flamegraph.pl or speedscope. After start, the status is polled
+    #until the profile is written, and Ctrl-C stops the profile early
+    import Settings
+
+    def request(*args) -> str:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(os.path.join(Settings.DATA_DIR, "profiles", SamplingProfiler.SOCKET_NAME))
+            client.sendall((" ".join(args) + "\n").encode("utf-8"))
+            return client.makefile("r").readline().strip()
+
+    args = sys.argv[1:] or ["status"]
+    answer = request(*args)
+    if args[0] == "start" and not answer.startswith("error"):
+        try:
+            while request("status").startswith("running"):
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            request("stop")
+    print(answer)
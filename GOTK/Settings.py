@@ -0,0 +1,9 @@
+import os
+
+#Settings needed before the controller is set up. GOTK.py connects to the broker with these before it imports the
+#LogicController, so the first subscription does not wait for the controller's modules. The LogicController takes its
+#defaults from here, and its class attributes are what the tools and the running system change.
+
+MQTT_BROKER_HOST = "localhost"
+MQTT_BROKER_PORT = 1883
+DATA_DIR = os.path.join(os.path.expanduser("~"), ".gotk")
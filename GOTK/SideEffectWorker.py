@@ -0,0 +1,280 @@
+import os
+import math
+import time
+import zlib
+import atexit
+import struct
+import multiprocessing
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+from threading import Event, Lock, Thread
+from typing import Dict, Optional
+
+from SystemLog import SystemLog
+from EventTemplates import EventTemplates
+
+log = SystemLog.get("SideEffects")
+
+
+class EventRing:
+    """
+        Single-producer, single-consumer ring buffer of compact event records in shared memory. The producer only writes
+        the head and the consumer only writes the tail, so neither process ever waits for the other. A full ring drops
+        the record instead of blocking the producer.
+
+        The consumer advances the tail after it has handled a record, so a restarted consumer continues with the records
+        its predecessor had not finished.
+
+        The head and the records are plain stores to shared memory, and on a weakly ordered CPU (the ARM of the Raspberry
+        Pi) the consumer may see the new head before the record it makes visible. Every record therefore carries its
+        sequence number (its index since the ring was created) and a CRC-32 of its contents, which the producer writes
+        together with the record. The consumer only takes a record whose sequence number is the one it expects and whose
+        CRC matches, and otherwise reads it again later. A slot still holding the record of the previous lap, or a record
+        only partly visible, is thus never taken for the new one.
+    """
+
+    HEADER = struct.Struct("<QQQ")          #Head (records written), tail (records handled), stop flag
+    PAYLOAD = struct.Struct("<dBBHfQ")      #Timestamp, kind, code, device, value, sequence number
+    RECORD = struct.Struct("<24sI4x")       #Payload, CRC-32 of the payload
+
+    def __init__(self, capacity: int, name: Optional[str] = None):
+        """
+            Creates the ring, or attaches to the ring with the given shared memory name.
+        """
+        self.capacity = capacity
+        size = self.HEADER.size + capacity * self.RECORD.size
+        self.memory = SharedMemory(name=name, create=name is None, size=size)
+        self.__buffer = self.memory.buf
+        if name is None:
+            self.HEADER.pack_into(self.__buffer, 0, 0, 0, 0)
+
+    def Put(self, timestamp: float, kind: int, code: int, device: int = 0, value: float = 0.0) -> bool:
+        """
+            Appends a record. Returns False if the ring is full.
+        """
+        head, tail, _ = self.HEADER.unpack_from(self.__buffer, 0)
+        if head - tail >= self.capacity:
+            return False
+        payload = self.PAYLOAD.pack(timestamp, kind, code, device, value, head)
+        self.RECORD.pack_into(self.__buffer, self.HEADER.size + (head % self.capacity) * self.RECORD.size,
+                              payload, zlib.crc32(payload))
+        #The record is written before the head makes it visible to the consumer, which checks its sequence number and CRC
+        struct.pack_into("<Q", self.__buffer, 0, head + 1)
+        return True
+
+    def Peek(self):
+        """
+            Returns the oldest record that has not been handled as (timestamp, kind, code, device, value), or None. None
+            is also returned while the record is not completely visible yet.
+        """
+        head, tail, _ = self.HEADER.unpack_from(self.__buffer, 0)
+        if tail >= head:
+            return None
+        payload, crc = self.RECORD.unpack_from(self.__buffer, self.HEADER.size + (tail % self.capacity) * self.RECORD.size)
+        if zlib.crc32(payload) != crc:
+            return None
+        *record, sequence = self.PAYLOAD.unpack(payload)
+        return tuple(record) if sequence == tail else None
+
+    def Done(self) -> None:
+        """
+            Marks the oldest record as handled.
+        """
+        tail = struct.unpack_from("<Q", self.__buffer, 8)[0]
+        struct.pack_into("<Q", self.__buffer, 8, tail + 1)
+
+    def Backlog(self) -> int:
+        head, tail, _ = self.HEADER.unpack_from(self.__buffer, 0)
+        return head - tail
+
+    @property
+    def Stopping(self) -> bool:
+        return struct.unpack_from("<Q", self.__buffer, 16)[0] != 0
+
+    def Request_Stop(self) -> None:
+        struct.pack_into("<Q", self.__buffer, 16, 1)
+
+    def Close(self, unlink: bool = False) -> None:
+        self.__buffer.release()
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class SideEffectWorker:
+    """
+        Runs the side effects of the logged events in a separate process, so the HEUCOD encoding, the HTTP posts to the log
+        server and the usage aggregates (with their checkpoint file) never compete for the GIL with the threads that make
+        the safety decisions.
+
+        The events are passed as compact records through an EventRing in shared memory: the actuation process only packs
+        32 bytes per event, with the index of its device in the EventTemplates, which the side process is given. Every record
+        also releases a semaphore shared with the side process, which blocks on it while the ring is empty, so an idle side
+        process does not wake up. It handles the records in order and advances the tail.
+
+        The side process is supervised by a thread that waits for it to exit. If it dies, it is restarted with an
+        exponential back-off, and continues with the records that were not handled yet.
+    """
+
+    EVENT, ESCALATION = 0, 1
+    EVENT_TYPES = ("StoveTurnsOn", "StoveTurnsOff", "SystemTurnsStoveOn", "SystemTurnsStoveOff",
+                   "CitizenLeftKitchen", "CitizenEnteredKitchen")
+    ESCALATIONS = ("Notify", "Limit", "Upper")
+    NO_DEVICE = 0xFFFF          #Device of the events of the gateway itself
+
+    CAPACITY = 4096             #Records in the ring
+    STOP_TIMEOUT = 5            #Seconds the side process is given to handle the backlog when stopping
+    RESTART_BACKOFF = 1         #Seconds before the first restart, doubled for every restart up to RESTART_BACKOFF_MAX
+    RESTART_BACKOFF_MAX = 60
+    STABLE_PERIOD = 60          #Seconds the side process must run before the back-off is reset
+
+    def __init__(self, ServerHost: str, usage_path: str, templates: EventTemplates):
+        self.ServerHost = ServerHost
+        self.usage_path = usage_path
+        self.templates = templates
+        self.__devices = {device_id: i for i, device_id in enumerate(templates.device_ids)}
+        self.submitted = 0
+        self.dropped = 0
+        self.restarts = 0
+
+        self.__ring: Optional[EventRing] = None
+        self.__process: Optional[multiprocessing.Process] = None
+        self.__context = multiprocessing.get_context("spawn")
+        self.__records = self.__context.Semaphore(0)
+        self.__lock = Lock()
+        self.__stop = Event()
+        self.__wake_r, self.__wake_w = os.pipe()
+        self.__supervisor: Optional[Thread] = None
+
+    def Start(self) -> None:
+        if self.__supervisor is not None:
+            return
+        self.__ring = EventRing(self.CAPACITY)
+        self.__stop.clear()
+        self.__spawn()
+        self.__supervisor = Thread(target=self.__supervise, name="Side effect supervisor", daemon=True)
+        self.__supervisor.start()
+        atexit.register(self.Stop)
+
+    def Stop(self) -> None:
+        """
+            Lets the side process handle the backlog and exit, and removes the ring.
+        """
+        if self.__supervisor is None:
+            return
+        self.__stop.set()
+        os.write(self.__wake_w, b"\0")
+        self.__supervisor.join()
+        self.__supervisor = None
+
+        self.__ring.Request_Stop()
+        self.__records.release()
+        self.__process.join(self.STOP_TIMEOUT)
+        if self.__process.is_alive():
+            log.warning("Side process did not stop in time", backlog=self.__ring.Backlog())
+            self.__process.terminate()
+            self.__process.join()
+        self.__ring.Close(unlink=True)
+        self.__ring = None
+
+    def Submit_Event(self, timestamp: float, event_type: str, device_id: Optional[str] = None,
+                     power: Optional[float] = None) -> None:
+        """
+            Queues a HEUCOD event, by the name of its type and its device, for logging and the usage aggregates. Never
+            blocks. A power of NaN in the record means no power.
+        """
+        self.__put(timestamp, self.EVENT, self.EVENT_TYPES.index(event_type), self.__devices.get(device_id, self.NO_DEVICE),
+                   math.nan if power is None else power)
+
+    def Record_Escalation(self, level: str, timestamp: float, device_id: Optional[str] = None) -> None:
+        """
+            Queues an escalation of the Away Timer of an appliance for the usage aggregates. Never blocks.
+        """
+        if level in self.ESCALATIONS:
+            self.__put(timestamp, self.ESCALATION, self.ESCALATIONS.index(level),
+                       self.__devices.get(device_id, self.NO_DEVICE))
+
+    def Metrics(self) -> Dict[str, int]:
+        return {"submitted": self.submitted, "dropped": self.dropped, "restarts": self.restarts,
+                "backlog": self.__ring.Backlog() if self.__ring is not None else 0}
+
+    def __put(self, timestamp: float, kind: int, code: int, device: int = NO_DEVICE, value: float = 0.0) -> None:
+        #The ring has a single producer, so the threads of this process take turns
+        with self.__lock:
+            if self.__ring is not None and self.__ring.Put(timestamp, kind, code, device, value):
+                self.submitted += 1
+                self.__records.release()
+            else:
+                self.dropped += 1
+                log.warning("Side effect dropped", kind=kind, code=code, throttle="side_effect_dropped")
+
+    def __spawn(self) -> None:
+        self.__process = self.__context.Process(target=_side_process, name="GOTK side effects", daemon=True,
+                                                args=(self.__ring.memory.name, self.CAPACITY, self.__records, self.ServerHost,
+                                                      self.usage_path, self.templates))
+        self.__process.start()
+        self.__started = time.monotonic()
+
+    def __supervise(self) -> None:
+        backoff = self.RESTART_BACKOFF
+        while True:
+            ready = wait([self.__process.sentinel, self.__wake_r])
+            if self.__stop.is_set():
+                return
+            if self.__process.sentinel not in ready:
+                continue
+
+            self.__process.join()
+            if time.monotonic() - self.__started >= self.STABLE_PERIOD:
+                backoff = self.RESTART_BACKOFF
+            log.warning("Side process died, restarting", exitcode=self.__process.exitcode, backoff=backoff,
+                        backlog=self.__ring.Backlog())
+            if self.__stop.wait(backoff):
+                return
+            backoff = min(backoff * 2, self.RESTART_BACKOFF_MAX)
+            self.restarts += 1
+            self.__spawn()
+
+
+def _side_process(name: str, capacity: int, records, ServerHost: str, usage_path: str, templates: EventTemplates) -> None:
+    """
+        Main of the side process. Handles the records of the ring until the actuation process asks it to stop and the
+        ring is empty. records is released for every record put in the ring, and once more to stop, and is only waited
+        for while the ring is empty. Its count can run ahead of the ring (records handled without waiting, or handled by
+        a process that was restarted), which only costs a spurious wake-up, never a missed record.
+    """
+    from Logger import Logger
+    from UsageAggregates import UsageAggregates
+
+    SystemLog.Configure()
+    ring = EventRing(capacity, name=name)
+    logger = Logger(ServerHost=ServerHost, templates=templates)
+    usage = UsageAggregates(usage_path)
+    usage.Start()
+
+    while True:
+        record = ring.Peek()
+        if record is None:
+            #A record that is not completely visible yet is not the end of the backlog
+            if ring.Stopping and ring.Backlog() == 0:
+                break
+            records.acquire()
+            continue
+
+        timestamp, kind, code, device, value = record
+        device_id = templates.device_ids[device] if device < len(templates.device_ids) else None
+        try:
+            if kind == SideEffectWorker.EVENT:
+                event_type = SideEffectWorker.EVENT_TYPES[code]
+                usage.Record(event_type, timestamp, device_id)
+                logger.send_log(timeStamp=int(timestamp), eventType=event_type, device_id=device_id,
+                                power=None if math.isnan(value) else value)
+            elif kind == SideEffectWorker.ESCALATION:
+                usage.Record_Escalation(SideEffectWorker.ESCALATIONS[code], timestamp, device_id)
+        except Exception as error:
+            log.warning("Side effect failed", kind=kind, code=code, error=error, throttle="side_effect_failed")
+        ring.Done()
+
+    usage.Stop()
+    ring.Close()
+    SystemLog.Stop()
@@ -0,0 +1,177 @@
+import socket
+import struct
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+
+def topic_matches(subscription: str, topic: str) -> bool:
+    """
+        Returns True if topic matches the subscription filter, with the MQTT wildcards "+" and "#".
+    """
+    filter_levels, topic_levels = subscription.split("/"), topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class StandInBroker:
+    """
+        A minimal in-process MQTT 3.1.1 broker for testing on machines without mosquitto. It supports what the Z2M Client and
+        paho need: CONNECT, SUBSCRIBE and UNSUBSCRIBE with wildcards, PUBLISH (messages are delivered with QoS 0, QoS 1
+        publishes are acknowledged), PINGREQ and DISCONNECT. Retained messages, wills and sessions are not supported.
+
+        Every client connection is served by its own thread.
+    """
+
+    CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+    SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+    PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        """
+            Port 0 selects a free port, which is available as the port attribute after Start().
+        """
+        self.host = host
+        self.port = port
+        self.__server: Optional[socket.socket] = None
+        self.__clients: Dict[socket.socket, List[str]] = {}
+        self.__send_locks: Dict[socket.socket, Lock] = {}
+        self.__lock = Lock()
+        self.messages = 0
+
+    def Start(self) -> int:
+        self.__server = socket.create_server((self.host, self.port))
+        self.port = self.__server.getsockname()[1]
+        Thread(target=self.__accept, daemon=True).start()
+        return self.port
+
+    def Stop(self) -> None:
+        if self.__server is not None:
+            self.__server.close()
+            self.__server = None
+        with self.__lock:
+            for connection in list(self.__clients):
+                connection.close()
+            self.__clients.clear()
+
+    def __accept(self) -> None:
+        while self.__server is not None:
+            try:
+                connection, _ = self.__server.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Thread(target=self.__serve, args=(connection,), daemon=True).start()
+
+    def __serve(self, connection: socket.socket) -> None:
+        stream = connection.makefile("rb")
+        try:
+            while True:
+                packet = self.__read_packet(stream)
+                if packet is None or not self.__handle(connection, *packet):
+                    break
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.__lock:
+                self.__clients.pop(connection, None)
+                self.__send_locks.pop(connection, None)
+            connection.close()
+
+    @staticmethod
+    def __read_packet(stream) -> Optional[Tuple[int, int, bytes]]:
+        header = stream.read(1)
+        if not header:
+            return None
+        length, shift = 0, 0
+        while True:
+            byte = stream.read(1)
+            if not byte:
+                return None
+            length |= (byte[0] & 0x7F) << shift
+            shift += 7
+            if not byte[0] & 0x80:
+                break
+        body = stream.read(length)
+        if len(body) < length:
+            return None
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    @staticmethod
+    def __packet(packet_type: int, flags: int, body: bytes) -> bytes:
+        length, encoded = len(body), bytearray()
+        while True:
+            byte, length = length & 0x7F, length >> 7
+            encoded.append(byte | (0x80 if length else 0))
+            if not length:
+                break
+        return bytes([packet_type << 4 | flags]) + bytes(encoded) + body
+
+    def __send(self, connection: socket.socket, data: bytes) -> None:
+        lock = self.__send_locks.get(connection)
+        if lock is None:
+            return
+        with lock:
+            try:
+                connection.sendall(data)
+            except OSError:
+                pass
+
+    def __handle(self, connection: socket.socket, packet_type: int, flags: int, body: bytes) -> bool:
+        if packet_type == self.CONNECT:
+            with self.__lock:
+                self.__clients[connection] = []
+                self.__send_locks[connection] = Lock()
+            self.__send(connection, self.__packet(self.CONNACK, 0, b"\x00\x00"))
+
+        elif packet_type == self.PUBLISH:
+            topic_length = struct.unpack("!H", body[:2])[0]
+            topic = body[2:2 + topic_length].decode("utf-8")
+            offset = 2 + topic_length
+            qos = (flags >> 1) & 0x03
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                self.__send(connection, self.__packet(self.PUBACK, 0, packet_id))
+            self.__publish(topic, body[offset:])
+
+        elif packet_type in (self.SUBSCRIBE, self.UNSUBSCRIBE):
+            packet_id, offset, granted = body[:2], 2, bytearray()
+            with self.__lock:
+                subscriptions = self.__clients.get(connection, [])
+                while offset < len(body):
+                    length = struct.unpack("!H", body[offset:offset + 2])[0]
+                    topic = body[offset + 2:offset + 2 + length].decode("utf-8")
+                    offset += 2 + length
+                    if packet_type == self.SUBSCRIBE:
+                        offset += 1
+                        if topic not in subscriptions:
+                            subscriptions.append(topic)
+                        granted.append(0)
+                    elif topic in subscriptions:
+                        subscriptions.remove(topic)
+            if packet_type == self.SUBSCRIBE:
+                self.__send(connection, self.__packet(self.SUBACK, 0, packet_id + bytes(granted)))
+            else:
+                self.__send(connection, self.__packet(self.UNSUBACK, 0, packet_id))
+
+        elif packet_type == self.PINGREQ:
+            self.__send(connection, self.__packet(self.PINGRESP, 0, b""))
+
+        elif packet_type == self.DISCONNECT:
+            return False
+
+        return True
+
+    def __publish(self, topic: str, payload: bytes) -> None:
+        encoded_topic = topic.encode("utf-8")
+        data = self.__packet(self.PUBLISH, 0, struct.pack("!H", len(encoded_topic)) + encoded_topic + payload)
+        with self.__lock:
+            receivers = [connection for connection, subscriptions in self.__clients.items()
+                         if any(topic_matches(subscription, topic) for subscription in subscriptions)]
+            self.messages += 1
+        for connection in receivers:
+            self.__send(connection, data)
@@ -0,0 +1,191 @@
+import os
+import atexit
+import sys
+import time
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+from typing import Dict, Optional
+
+
+class RateLimitFilter(logging.Filter):
+    """
+        Filter for repetitive messages. Records logged with a throttle key (e.g. the Away Timer tick) are only let through
+        once per interval for that key. The number of suppressed records is attached to the next record that passes, so
+        nothing is silently lost from the output. Records without a throttle key are always let through.
+    """
+
+    def __init__(self, interval: float = 10.0):
+        super().__init__()
+        self.interval = interval
+        self.__last_emit = {}
+        self.__suppressed = {}
+        self.__lock = Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "throttle", None)
+        if key is None:
+            return True
+
+        now = time.monotonic()
+        with self.__lock:
+            #Suppress the record if the same key was emitted within the interval
+            if now - self.__last_emit.get(key, float("-inf")) < self.interval:
+                self.__suppressed[key] = self.__suppressed.get(key, 0) + 1
+                return False
+
+            self.__last_emit[key] = now
+            record.suppressed = self.__suppressed.pop(key, 0)
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+        Queue handler that never blocks the caller. When the bounded queue is full, the record is dropped and counted
+        instead of waiting for the writer thread.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            #Records are logged from many threads. The handler's lock is reentrant, so this also holds when called from handle()
+            self.acquire()
+            try:
+                self.dropped += 1
+            finally:
+                self.release()
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+        Formats a record as a single line: time, level, category and message, followed by the structured fields as
+        key=value pairs.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = "%s %-7s %-10s %s" % (self.formatTime(record, "%H:%M:%S"), record.levelname,
+                                     record.name.rpartition(".")[2], record.getMessage())
+
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            line += f" suppressed={suppressed}"
+
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class StructuredAdapter(logging.LoggerAdapter):
+    """
+        Logger adapter that turns keyword arguments into structured fields, so a call looks like
+        log.info("Occupancy changed", room="Kitchen", occupancy=True). The keyword throttle="<key>" marks the record
+        as repetitive, which makes it subject to rate limiting.
+    """
+
+    RESERVED = {"exc_info", "stack_info", "stacklevel", "extra"}
+
+    def process(self, msg, kwargs):
+        extra = dict(kwargs.pop("extra", None) or {})
+        fields = {k: kwargs.pop(k) for k in list(kwargs) if k not in self.RESERVED}
+
+        if "throttle" in fields:
+            extra["throttle"] = fields.pop("throttle")
+        extra["fields"] = fields
+        kwargs["extra"] = extra
+        return msg, kwargs
+
+
+class SystemLog:
+    """
+        The structured logging layer for the GOTK system. Every category (Idle, Controller, Timer, Z2M) is a child of
+        the "GOTK" logger and can be given its own level. Records are formatted and filtered in the calling thread, and
+        put on a bounded queue. A separate writer thread (QueueListener) takes them off the queue and writes them to
+        stdout, so blocking writes to journald never happen on the event path.
+
+        Levels can be given to Configure(), or through the environment variable GOTK_LOG_LEVEL, e.g.
+        "INFO,Z2M=DEBUG,Timer=WARNING". The first entry without a category sets the level for all categories.
+    """
+
+    ROOT = "GOTK"
+    DEFAULT_LEVEL = "INFO"
+    QUEUE_SIZE = 10000
+    THROTTLE_INTERVAL = 10.0
+
+    __listener: Optional[QueueListener] = None
+    __handler: Optional[DroppingQueueHandler] = None
+
+    @staticmethod
+    def get(category: str) -> StructuredAdapter:
+        """
+            Returns the structured logger for the given category.
+        """
+        return StructuredAdapter(logging.getLogger(f"{SystemLog.ROOT}.{category}"), {})
+
+    @staticmethod
+    def parse_levels(spec: str) -> Dict[str, str]:
+        """
+            Parses a level specification like "INFO,Z2M=DEBUG" into a dictionary. The root level is stored under "".
+        """
+        levels = {}
+        for item in filter(None, (s.strip() for s in spec.split(","))):
+            category, _, level = item.rpartition("=")
+            levels[category] = level.upper()
+        return levels
+
+    @classmethod
+    def Configure(cls, levels: Optional[Dict[str, str]] = None, stream=None) -> None:
+        """
+            Sets up the queue-backed handler and starts the writer thread. Calling it again reconfigures the levels
+            and replaces the writer thread.
+        """
+        cls.Stop()
+
+        if levels is None:
+            levels = cls.parse_levels(os.environ.get("GOTK_LOG_LEVEL", cls.DEFAULT_LEVEL))
+
+        root = logging.getLogger(cls.ROOT)
+        root.setLevel(levels.get("", cls.DEFAULT_LEVEL))
+        root.propagate = False
+        for category, level in levels.items():
+            if category:
+                logging.getLogger(f"{cls.ROOT}.{category}").setLevel(level)
+
+        log_queue = queue.Queue(maxsize=cls.QUEUE_SIZE)
+        cls.__handler = DroppingQueueHandler(log_queue)
+        cls.__handler.setFormatter(StructuredFormatter())
+        cls.__handler.addFilter(RateLimitFilter(cls.THROTTLE_INTERVAL))
+        root.handlers = [cls.__handler]
+
+        #The writer thread only writes the already formatted message
+        writer = logging.StreamHandler(stream or sys.stdout)
+        writer.setFormatter(logging.Formatter("%(message)s"))
+        cls.__listener = QueueListener(log_queue, writer)
+        cls.__listener.start()
+        atexit.register(cls.Stop)
+
+    @classmethod
+    def Stop(cls) -> None:
+        """
+            Flushes the remaining records and stops the writer thread.
+        """
+        if cls.__listener is not None:
+            cls.__listener.stop()
+            cls.__listener = None
+            atexit.unregister(cls.Stop)
+
+    @classmethod
+    def Dropped(cls) -> int:
+        """
+            Returns the number of records dropped because the queue was full.
+        """
+        return cls.__handler.dropped if cls.__handler else 0
@@ -0,0 +1,528 @@
+import os
+import time
+import zlib
+import atexit
+import struct
+from bisect import bisect_left, bisect_right, insort
+from threading import Event, Lock, Thread
+from typing import List, NamedTuple, Optional, Set, Tuple
+
+from SystemLog import SystemLog
+
+log = SystemLog.get("Store")
+
+
+class PowerSample(NamedTuple):
+    """ A single power/state reading of a plug. """
+    timestamp: float
+    power: float
+    state: Optional[str]
+
+
+class PowerBucket(NamedTuple):
+    """ A downsampled bucket of power readings. on_ratio is the fraction of the samples where the plug state was ON. """
+    start: float
+    minimum: float
+    maximum: float
+    mean: float
+    count: int
+    on_ratio: float
+
+
+class BlockRef(NamedTuple):
+    """ Location of a compressed block on disk, used by the in-memory index. """
+    first_ts: float
+    last_ts: float
+    path: str
+    offset: int
+    length: int
+
+
+#Plug states are stored as small integers, so they can be run-length encoded
+STATE_CODES = {"OFF": 0, "ON": 1, None: 2}
+CODE_STATES = {v: k for k, v in STATE_CODES.items()}
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    """ Appends an unsigned integer as a LEB128 varint. """
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, pos: int):
+    """ Reads a LEB128 varint, returns the value and the position after it. """
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _unzigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+
+class TimeSeriesStore:
+    """
+        Embedded, append-only time-series store for the power and state samples of a smart plug.
+
+        Samples are buffered in memory and written in batches as compressed blocks. Within a block the timestamps are
+        stored as millisecond deltas, the power as deltas of deci-watts (both as zigzag varints) and the states run-length
+        encoded, before the whole block is zlib compressed. Blocks are appended to segment files that are rotated by size
+        and age. An in-memory index of the block time spans, rebuilt from the block headers on start, lets range queries
+        decode only the blocks that overlap the requested window.
+
+        Append() only adds the sample to the batch, since it is called from the threads that receive the MQTT messages.
+        A full batch is handed to the TimeSeriesWriter of the store, whose thread encodes and writes it, downsamples the
+        raw segments older than the raw retention into min/max/mean buckets in rollup segments, and enforces the disk
+        budget. Without a writer, full batches are written by the thread that appends, and nothing is downsampled.
+    """
+
+    BATCH_SIZE = 128                    #Samples buffered before a block is written
+    BATCH_SPAN = 300                    #Seconds of samples buffered before a block is written
+    SEGMENT_SIZE = 1024 * 1024          #Bytes before a segment file is rotated
+    SEGMENT_SPAN = 24 * 3600            #Seconds before a raw segment is rotated, so sparse samples are downsampled too
+    RAW_RETENTION = 7 * 24 * 3600       #Seconds raw samples are kept before being downsampled
+    BUCKET_PERIOD = 60                  #Seconds per downsampled bucket
+
+    HEADER = struct.Struct("<IIdd")     #Compressed length, sample count, first and last timestamp
+    BUCKET = struct.Struct("<dfffIf")   #Start, min, max, mean, count and on ratio
+
+    def __init__(self, directory: str, writer: Optional["TimeSeriesWriter"] = None):
+        """
+            Opens the store in the given directory, creating it if needed, and rebuilds the block index from the
+            segment files. The batches are written by writer, if given.
+        """
+        self.directory = directory
+        self.writer = writer
+        os.makedirs(directory, exist_ok=True)
+
+        #The lock guards the batches and the index, the write lock serializes the writing and deleting of segments
+        self.__lock = Lock()
+        self.__write_lock = Lock()
+        self.__buffer: List[PowerSample] = []
+        self.__pending: List[List[PowerSample]] = []
+        self.__raw_index: List[BlockRef] = []
+        self.__rollup_index: List[BlockRef] = []
+        self.__raw_segment: Optional[str] = None
+        self.__rollup_segment: Optional[str] = None
+
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".seg"):
+                self.__index_segment(os.path.join(directory, name))
+
+        if writer is not None:
+            writer.Register(self)
+
+    def Append(self, timestamp: float, power: float, state: Optional[str]) -> None:
+        """
+            Adds a sample. Samples are buffered and handed to the writer as one batch when the batch is full. Samples
+            older than the last stored one are ignored, so the blocks stay ordered in time.
+        """
+        with self.__lock:
+            last = self.__last_timestamp()
+            if timestamp < last:
+                return
+
+            self.__buffer.append(PowerSample(timestamp, power or 0, state))
+            if len(self.__buffer) < self.BATCH_SIZE and timestamp - self.__buffer[0].timestamp < self.BATCH_SPAN:
+                return
+            self.__pending.append(self.__buffer)
+            self.__buffer = []
+        self.__submit()
+
+    def Flush(self) -> None:
+        """
+            Hands the buffered samples to the writer, or writes them if the store has no writer.
+        """
+        with self.__lock:
+            if not self.__buffer:
+                return
+            self.__pending.append(self.__buffer)
+            self.__buffer = []
+        self.__submit()
+
+    def Range(self, start: float, end: float) -> List[PowerSample]:
+        """
+            Returns the raw samples with start <= timestamp <= end, in time order.
+        """
+        with self.__lock:
+            samples = []
+            for ref in self.__overlapping(self.__raw_index, start, end):
+                samples.extend(s for s in self.__decode_raw(self.__read_block(ref)) if start <= s.timestamp <= end)
+            for batch in self.__pending + [self.__buffer]:
+                samples.extend(s for s in batch if start <= s.timestamp <= end)
+        return samples
+
+    def Buckets(self, start: float, end: float) -> List[PowerBucket]:
+        """
+            Returns the downsampled buckets starting within start <= bucket start <= end, in time order.
+        """
+        with self.__lock:
+            buckets = []
+            for ref in self.__overlapping(self.__rollup_index, start, end):
+                buckets.extend(b for b in self.__decode_rollup(self.__read_block(ref)) if start <= b.start <= end)
+        return buckets
+
+    def Latest(self) -> Optional[PowerSample]:
+        """
+            Returns the most recent sample, or None if the store is empty.
+        """
+        with self.__lock:
+            if self.__buffer:
+                return self.__buffer[-1]
+            if self.__pending:
+                return self.__pending[-1][-1]
+            if self.__raw_index:
+                return self.__decode_raw(self.__read_block(self.__raw_index[-1]))[-1]
+        return None
+
+    def Disk_Usage(self) -> int:
+        """
+            Returns the number of bytes used by the segment files.
+        """
+        return sum(os.path.getsize(os.path.join(self.directory, name))
+                   for name in os.listdir(self.directory) if name.endswith(".seg"))
+
+    def Segments(self) -> List[Tuple[float, str]]:
+        """
+            Returns the time of the first sample or bucket and the path of every segment that is not written to any more.
+        """
+        with self.__lock:
+            segments = {}
+            for ref in self.__raw_index + self.__rollup_index:
+                if ref.path not in (self.__raw_segment, self.__rollup_segment):
+                    segments.setdefault(ref.path, ref.first_ts)
+        return sorted((first, path) for path, first in segments.items())
+
+    #----------------------------- Writing -----------------------------
+
+    def __last_timestamp(self) -> float:
+        if self.__buffer:
+            return self.__buffer[-1].timestamp
+        if self.__pending:
+            return self.__pending[-1][-1].timestamp
+        return self.__raw_index[-1].last_ts if self.__raw_index else float("-inf")
+
+    def __submit(self) -> None:
+        if self.writer is not None:
+            self.writer.Wake(self)
+        else:
+            self.Write_Pending()
+
+    def Write_Pending(self) -> None:
+        """
+            Encodes and writes the batches handed over by Append() and Flush(). Called by the writer.
+        """
+        with self.__write_lock:
+            while True:
+                with self.__lock:
+                    if not self.__pending:
+                        return
+                    batch = self.__pending[0]
+
+                #The batch stays readable in the pending list until its block is in the index
+                first, last = batch[0].timestamp, batch[-1].timestamp
+                if self.__raw_segment is None or os.path.getsize(self.__raw_segment) >= self.SEGMENT_SIZE or \
+                        first - self.__segment_start(self.__raw_segment) >= self.SEGMENT_SPAN:
+                    self.__raw_segment = self.__segment_path("raw", first)
+                ref = self.__append_block(self.__raw_segment, self.__encode_raw(batch), len(batch), first, last)
+
+                with self.__lock:
+                    self.__raw_index.append(ref)
+                    self.__pending.pop(0)
+
+    def Downsample(self, now: float) -> None:
+        """
+            Downsamples the raw segments whose newest sample is older than the raw retention. Called by the writer.
+        """
+        with self.__write_lock:
+            with self.__lock:
+                paths = {}
+                for ref in self.__raw_index:
+                    if ref.path != self.__raw_segment:
+                        paths.setdefault(ref.path, []).append(ref)
+
+            for path, refs in paths.items():
+                if refs[-1].last_ts >= now - self.RAW_RETENTION:
+                    continue
+                #The segment is no longer written, so it is decoded without holding the lock
+                samples = [s for ref in refs for s in self.__decode_raw(self.__read_block(ref))]
+                self.__write_buckets(self.__downsample(samples))
+                with self.__lock:
+                    self.__raw_index = [ref for ref in self.__raw_index if ref.path != path]
+                os.remove(path)
+
+    def Remove_Segment(self, path: str) -> None:
+        """
+            Deletes a segment returned by Segments(). Called by the writer to meet the disk budget.
+        """
+        with self.__write_lock:
+            with self.__lock:
+                self.__raw_index = [ref for ref in self.__raw_index if ref.path != path]
+                self.__rollup_index = [ref for ref in self.__rollup_index if ref.path != path]
+            os.remove(path)
+
+    def __append_block(self, path: str, body: bytes, count: int, first: float, last: float) -> BlockRef:
+        data = zlib.compress(body)
+        with open(path, "ab") as f:
+            offset = f.tell()
+            f.write(self.HEADER.pack(len(data), count, first, last) + data)
+        return BlockRef(first, last, path, offset + self.HEADER.size, len(data))
+
+    def __segment_path(self, kind: str, timestamp: float) -> str:
+        return os.path.join(self.directory, f"{kind}-{int(timestamp * 1000):015d}.seg")
+
+    @staticmethod
+    def __segment_start(path: str) -> float:
+        return int(os.path.basename(path)[:-4].split("-")[1]) / 1000
+
+    def __downsample(self, samples: List[PowerSample]) -> List[PowerBucket]:
+        buckets = []
+        current = None
+        for s in samples:
+            start = s.timestamp - s.timestamp % self.BUCKET_PERIOD
+            if current is None or current[0] != start:
+                if current is not None:
+                    buckets.append(self.__close_bucket(current))
+                current = [start, s.power, s.power, 0.0, 0, 0]
+            current[1] = min(current[1], s.power)
+            current[2] = max(current[2], s.power)
+            current[3] += s.power
+            current[4] += 1
+            current[5] += s.state == "ON"
+        if current is not None:
+            buckets.append(self.__close_bucket(current))
+        return buckets
+
+    @staticmethod
+    def __close_bucket(acc) -> PowerBucket:
+        start, minimum, maximum, total, count, on = acc
+        return PowerBucket(start, minimum, maximum, total / count, count, on / count)
+
+    def __write_buckets(self, buckets: List[PowerBucket]) -> None:
+        if not buckets:
+            return
+
+        if self.__rollup_segment is None or os.path.getsize(self.__rollup_segment) >= self.SEGMENT_SIZE:
+            self.__rollup_segment = self.__segment_path("rollup", buckets[0].start)
+
+        body = b"".join(self.BUCKET.pack(*b) for b in buckets)
+        ref = self.__append_block(self.__rollup_segment, body, len(buckets), buckets[0].start, buckets[-1].start)
+        with self.__lock:
+            insort(self.__rollup_index, ref)
+
+    #----------------------------- Reading -----------------------------
+
+    def __index_segment(self, path: str) -> None:
+        """
+            Reads the block headers of a segment file into the index, without decompressing the blocks. A partially
+            written block at the end of the file (e.g. after a power cut) is cut off.
+        """
+        index = self.__rollup_index if os.path.basename(path).startswith("rollup") else self.__raw_index
+        size = os.path.getsize(path)
+        offset = 0
+        with open(path, "rb") as f:
+            while offset + self.HEADER.size <= size:
+                length, count, first, last = self.HEADER.unpack(f.read(self.HEADER.size))
+                if offset + self.HEADER.size + length > size:
+                    break
+                index.append(BlockRef(first, last, path, offset + self.HEADER.size, length))
+                offset += self.HEADER.size + length
+                f.seek(offset)
+        if offset < size:
+            os.truncate(path, offset)
+
+        if index is self.__raw_index:
+            self.__raw_segment = path
+        else:
+            self.__rollup_segment = path
+
+    @staticmethod
+    def __overlapping(index: List[BlockRef], start: float, end: float) -> List[BlockRef]:
+        """
+            Returns the blocks whose time span overlaps [start, end]. The blocks are ordered in time, so a binary search
+            on the last and first timestamps finds the candidates, without copying the index.
+        """
+        lo = bisect_left(index, start, key=lambda ref: ref.last_ts)
+        hi = bisect_right(index, end, lo=lo, key=lambda ref: ref.first_ts)
+        return index[lo:hi]
+
+    @staticmethod
+    def __read_block(ref: BlockRef) -> bytes:
+        with open(ref.path, "rb") as f:
+            f.seek(ref.offset)
+            return zlib.decompress(f.read(ref.length))
+
+    #----------------------------- Block encoding -----------------------------
+
+    @staticmethod
+    def __encode_raw(samples: List[PowerSample]) -> bytes:
+        """
+            Encodes samples as: count, then millisecond timestamp deltas, deci-watt power deltas and state runs.
+        """
+        out = bytearray()
+        _write_varint(out, len(samples))
+
+        previous = 0
+        for s in samples:
+            ms = int(round(s.timestamp * 1000))
+            _write_varint(out, _zigzag(ms - previous))
+            previous = ms
+
+        previous = 0
+        for s in samples:
+            deci_watts = int(round(s.power * 10))
+            _write_varint(out, _zigzag(deci_watts - previous))
+            previous = deci_watts
+
+        runs = []
+        for s in samples:
+            code = STATE_CODES.get(s.state, STATE_CODES[None])
+            if runs and runs[-1][0] == code:
+                runs[-1][1] += 1
+            else:
+                runs.append([code, 1])
+        _write_varint(out, len(runs))
+        for code, length in runs:
+            out.append(code)
+            _write_varint(out, length)
+
+        return bytes(out)
+
+    @staticmethod
+    def __decode_raw(data: bytes) -> List[PowerSample]:
+        count, pos = _read_varint(data, 0)
+
+        timestamps = []
+        previous = 0
+        for _ in range(count):
+            delta, pos = _read_varint(data, pos)
+            previous += _unzigzag(delta)
+            timestamps.append(previous / 1000)
+
+        powers = []
+        previous = 0
+        for _ in range(count):
+            delta, pos = _read_varint(data, pos)
+            previous += _unzigzag(delta)
+            powers.append(previous / 10)
+
+        states = []
+        runs, pos = _read_varint(data, pos)
+        for _ in range(runs):
+            code = data[pos]
+            length, pos = _read_varint(data, pos + 1)
+            states.extend([CODE_STATES[code]] * length)
+
+        return [PowerSample(*sample) for sample in zip(timestamps, powers, states)]
+
+    @classmethod
+    def __decode_rollup(cls, data: bytes) -> List[PowerBucket]:
+        return [PowerBucket(*values) for values in cls.BUCKET.iter_unpack(data)]
+
+
+class TimeSeriesWriter:
+    """
+        Background writer of the time-series stores of all plugs. The stores hand it their full batches, and its thread
+        encodes and writes them, so the threads that receive the MQTT messages never wait for zlib or the SD card.
+
+        Every MAINTENANCE_PERIOD seconds, and when it starts, the writer downsamples the raw segments that are older than
+        the raw retention in every store, and deletes the oldest segments of all stores together until they are within
+        DISK_BUDGET. The segments the stores are writing to are never deleted.
+    """
+
+    MAINTENANCE_PERIOD = 3600           #Seconds between the downsampling and disk budget runs
+    DISK_BUDGET = 64 * 1024 * 1024      #Bytes the segments of all stores may use on the SD card
+
+    def __init__(self):
+        self.__stores: List[TimeSeriesStore] = []
+        self.__dirty: Set[TimeSeriesStore] = set()
+        self.__lock = Lock()
+        self.__wake = Event()
+        self.__stop = Event()
+        self.__thread: Optional[Thread] = None
+
+    def Register(self, store: TimeSeriesStore) -> None:
+        with self.__lock:
+            self.__stores.append(store)
+
+    def Start(self) -> None:
+        if self.__thread is None:
+            self.__stop.clear()
+            self.__thread = Thread(target=self.__writer, name="Time-series writer", daemon=True)
+            self.__thread.start()
+            atexit.register(self.Stop)
+
+    def Stop(self) -> None:
+        """
+            Writes the batches handed over so far and stops the writer thread.
+        """
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__wake.set()
+            self.__thread.join()
+            self.__thread = None
+
+    def Wake(self, store: TimeSeriesStore) -> None:
+        """
+            Tells the writer that store has batches to write. Never blocks for long.
+        """
+        with self.__lock:
+            self.__dirty.add(store)
+        self.__wake.set()
+
+    def Disk_Usage(self) -> int:
+        with self.__lock:
+            stores = list(self.__stores)
+        return sum(store.Disk_Usage() for store in stores)
+
+    def Maintain(self, now: float) -> None:
+        """
+            Downsamples the old raw segments of every store, then deletes the oldest segments until the disk budget is met.
+        """
+        with self.__lock:
+            stores = list(self.__stores)
+        for store in stores:
+            store.Downsample(now)
+
+        usage = sum(store.Disk_Usage() for store in stores)
+        segments = sorted((first, path, store) for store in stores for first, path in store.Segments())
+        for _, path, store in segments:
+            if usage <= self.DISK_BUDGET:
+                break
+            usage -= os.path.getsize(path)
+            store.Remove_Segment(path)
+
+    def __writer(self) -> None:
+        next_maintenance = time.monotonic()
+        while True:
+            self.__wake.wait(max(0.0, next_maintenance - time.monotonic()))
+            self.__wake.clear()
+            with self.__lock:
+                dirty, self.__dirty = self.__dirty, set()
+            for store in dirty:
+                try:
+                    store.Write_Pending()
+                except OSError as error:
+                    #The batches stay pending and are written with the next ones
+                    log.warning("Writing power samples failed", directory=store.directory, error=error,
+                                throttle="store_write_failed")
+
+            if self.__stop.is_set():
+                return
+            if time.monotonic() >= next_maintenance:
+                try:
+                    self.Maintain(time.time())
+                except OSError as error:
+                    log.warning("Store maintenance failed", error=error, throttle="store_maintenance_failed")
+                next_maintenance = time.monotonic() + self.MAINTENANCE_PERIOD
@@ -43,14 +43,17 @@ class Timer:
         """
         return self.Time_Now() - self.Start_Time
 
-    def Start(self):
+    def Start(self, Start_Time = None):
         """
             Start Timer:
             Assign Start_Time as the current time and updates the different thresholds,
             using the Start_Time and the Threshold Periods, and set Timer_Active as true.
+            
+            An earlier Start_Time can be given to resume a timer, e.g. from a checkpoint. The thresholds are then
+            the same absolute times as when the timer was first started.
         """
 
-        self.Start_Time = self.Time_Now()
+        self.Start_Time = self.Time_Now() if Start_Time is None else Start_Time
         self.Notify_Threshold = self.Start_Time + self.Notify_Period
         self.Limit_Threshold = self.Start_Time + self.Limit_Period
         self.Upper_Threshold = self.Start_Time + self.Upper_Period
@@ -68,6 +71,14 @@ class Timer:
         self.Actuator_Threshold = -1
         self.Timer_Active = False
 
+    def Next_Threshold(self):
+        """
+            Returns the time of the next Away Timer threshold that has not been exceeded, or None if there is none.
+        """
+        now = self.Time_Now()
+        upcoming = [t for t in (self.Notify_Threshold, self.Limit_Threshold, self.Upper_Threshold) if t != -1 and t > now]
+        return min(upcoming, default=None)
+
     def Check_Timer(self):
         """
             Checks the timer:
@@ -0,0 +1,234 @@
+import os
+import zlib
+import atexit
+import queue
+import struct
+from bisect import bisect_right
+from threading import Thread
+from typing import Iterator, List, NamedTuple, Optional
+
+from TimeSeriesStore import _read_varint, _write_varint, _zigzag, _unzigzag
+
+
+class CapturedMessage(NamedTuple):
+    """ A received MQTT message. It has the topic and payload of a paho MQTTMessage, so it can be given to Z2M_Message. """
+    timestamp: float
+    topic: str
+    payload: bytes
+
+
+class TrafficCapture:
+    """
+        Append-only capture of the raw MQTT traffic received by the Z2M Client and by idle mode, so the exact message sequence
+        the system saw can be extracted after an incident.
+
+        Record() only puts the message in a bounded queue, so the receive thread never waits for the disk. A writer thread
+        batches the messages into blocks: the receive times as millisecond deltas, the topics as indexes into a table of the
+        block's topics, and the raw payloads, zlib compressed together. Blocks are appended to segment files that are rotated
+        by size and deleted oldest first when the capture exceeds its disk budget. If the queue is full, messages are
+        dropped and counted.
+
+        The time index is sparse and has two levels: the segment file names hold the time of their first message, and
+        every block starts with a header holding its first and last time. Reading a window only scans the headers of the
+        segments that can overlap it, and only decompresses the blocks that do.
+    """
+
+    BATCH_SIZE = 256                    #Messages buffered before a block is written
+    BATCH_SPAN = 10                     #Seconds of messages buffered before a block is written
+    SEGMENT_SIZE = 4 * 1024 * 1024      #Bytes before a segment file is rotated
+    DISK_BUDGET = 256 * 1024 * 1024     #Bytes all capture segments may use on the SD card
+    QUEUE_SIZE = 10000                  #Messages waiting for the writer before new ones are dropped
+
+    HEADER = struct.Struct("<IIdd")     #Compressed length, message count, first and last timestamp
+    PREFIX = "capture-"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self.dropped = 0
+        self.__queue: "queue.Queue[Optional[CapturedMessage]]" = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.__thread: Optional[Thread] = None
+        self.__segment: Optional[str] = None
+
+    def Start(self) -> None:
+        if self.__thread is None:
+            self.__thread = Thread(target=self.__writer, name="Traffic capture", daemon=True)
+            self.__thread.start()
+            atexit.register(self.Stop)
+
+    def Stop(self) -> None:
+        """
+            Writes the queued messages and stops the writer thread.
+        """
+        if self.__thread is not None:
+            atexit.unregister(self.Stop)
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+
+    def Record(self, topic: str, payload: bytes, timestamp: float) -> None:
+        """
+            Captures a received message. Never blocks.
+        """
+        try:
+            self.__queue.put_nowait(CapturedMessage(timestamp, topic, bytes(payload)))
+        except queue.Full:
+            self.dropped += 1
+
+    #----------------------------- Writing -----------------------------
+
+    def __writer(self) -> None:
+        batch: List[CapturedMessage] = []
+        while True:
+            timeout = self.BATCH_SPAN if batch else None
+            try:
+                message = self.__queue.get(timeout=timeout)
+            except queue.Empty:
+                message = False
+
+            if message:
+                batch.append(message)
+            if batch and (message is None or message is False or len(batch) >= self.BATCH_SIZE or
+                          batch[-1].timestamp - batch[0].timestamp >= self.BATCH_SPAN):
+                self.__write_block(batch)
+                batch = []
+            if message is None:
+                return
+
+    def __write_block(self, batch: List[CapturedMessage]) -> None:
+        if self.__segment is None or os.path.getsize(self.__segment) >= self.SEGMENT_SIZE:
+            self.__segment = os.path.join(self.directory, f"{self.PREFIX}{int(batch[0].timestamp * 1000):015d}.seg")
+            self.__enforce_budget()
+
+        data = zlib.compress(self.__encode(batch))
+        with open(self.__segment, "ab") as f:
+            f.write(self.HEADER.pack(len(data), len(batch), batch[0].timestamp, batch[-1].timestamp) + data)
+
+    def __enforce_budget(self) -> None:
+        segments = self.Segments(self.directory)
+        usage = sum(os.path.getsize(path) for path in segments)
+        for path in segments:
+            if usage <= self.DISK_BUDGET or path == self.__segment:
+                break
+            usage -= os.path.getsize(path)
+            os.remove(path)
+
+    @staticmethod
+    def __encode(batch: List[CapturedMessage]) -> bytes:
+        """
+            Encodes a block as: the topic table, then for each message its millisecond time delta, topic index and payload.
+        """
+        topics = list(dict.fromkeys(m.topic for m in batch))
+        topic_index = {topic: i for i, topic in enumerate(topics)}
+
+        out = bytearray()
+        _write_varint(out, len(topics))
+        for topic in topics:
+            encoded = topic.encode("utf-8")
+            _write_varint(out, len(encoded))
+            out += encoded
+
+        previous = 0
+        for m in batch:
+            ms = int(round(m.timestamp * 1000))
+            _write_varint(out, _zigzag(ms - previous))
+            previous = ms
+            _write_varint(out, topic_index[m.topic])
+            _write_varint(out, len(m.payload))
+            out += m.payload
+        return bytes(out)
+
+    #----------------------------- Reading -----------------------------
+
+    @classmethod
+    def Segments(cls, directory: str) -> List[str]:
+        """
+            Returns the segment files in time order.
+        """
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                if name.startswith(cls.PREFIX) and name.endswith(".seg")]
+
+    @classmethod
+    def Read(cls, directory: str, start: float = float("-inf"), end: float = float("inf")) -> Iterator[CapturedMessage]:
+        """
+            Yields the captured messages with start <= timestamp <= end, in the order they were received.
+        """
+        segments = cls.Segments(directory)
+        starts = [int(os.path.basename(path)[len(cls.PREFIX):-len(".seg")]) / 1000 for path in segments]
+
+        #The segment holding start is the last one that began before it, and later segments are read until one begins after end
+        first = max(0, bisect_right(starts, start) - 1)
+        for path, segment_start in zip(segments[first:], starts[first:]):
+            if segment_start > end:
+                break
+            yield from cls.__read_segment(path, start, end)
+
+    @classmethod
+    def Replay(cls, directory: str, start: float = float("-inf"), end: float = float("inf")):
+        """
+            Yields the captured messages as Z2M_Message objects, with the time they were received.
+        """
+        from Z2M_Message import Z2M_Message
+
+        for captured in cls.Read(directory, start, end):
+            message = Z2M_Message(captured.topic, captured.payload)
+            message.timeStamp = captured.timestamp
+            yield message
+
+    @classmethod
+    def __read_segment(cls, path: str, start: float, end: float) -> Iterator[CapturedMessage]:
+        """
+            Scans the block headers of a segment and decodes the blocks overlapping [start, end]. A partially written block
+            at the end of the segment is ignored.
+        """
+        size = os.path.getsize(path)
+        offset = 0
+        with open(path, "rb") as f:
+            while offset + cls.HEADER.size <= size:
+                f.seek(offset)
+                length, count, first, last = cls.HEADER.unpack(f.read(cls.HEADER.size))
+                offset += cls.HEADER.size + length
+                if offset > size or first > end:
+                    return
+                if last < start:
+                    continue
+
+                for message in cls.__decode(zlib.decompress(f.read(length))):
+                    if start <= message.timestamp <= end:
+                        yield message
+
+    @staticmethod
+    def __decode(data: bytes) -> Iterator[CapturedMessage]:
+        count, pos = _read_varint(data, 0)
+        topics = []
+        for _ in range(count):
+            length, pos = _read_varint(data, pos)
+            topics.append(data[pos:pos + length].decode("utf-8"))
+            pos += length
+
+        ms = 0
+        while pos < len(data):
+            delta, pos = _read_varint(data, pos)
+            ms += _unzigzag(delta)
+            topic, pos = _read_varint(data, pos)
+            length, pos = _read_varint(data, pos)
+            yield CapturedMessage(ms / 1000, topics[topic], data[pos:pos + length])
+            pos += length
+
+
+if __name__ == "__main__":
+    #Extracts a window of the capture, e.g. python3 TrafficCapture.py ~/.gotk/capture 2026-10-19T12:00 2026-10-19T12:10
+    import sys
+    from datetime import datetime
+
+    def parse_time(value: str) -> float:
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.fromisoformat(value).timestamp()
+
+    window = [parse_time(value) for value in sys.argv[2:4]]
+    for message in TrafficCapture.Read(sys.argv[1], *window):
+        print(f"{datetime.fromtimestamp(message.timestamp).isoformat(timespec='milliseconds')} {message.topic} "
+              f"{message.payload.decode('utf-8', 'replace')}")
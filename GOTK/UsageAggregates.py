@@ -0,0 +1,247 @@
+import atexit
+from datetime import date, datetime
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional
+
+from AtomicFile import AtomicFile
+from JsonCodec import JsonCodec
+from SystemLog import SystemLog
+
+log = SystemLog.get("Usage")
+
+
+class UsageAggregates:
+    """
+        Rolling aggregates of the kitchen usage, kept per day and per ISO week. The aggregates are updated incrementally
+        as the events happen, so each event costs O(1), and queries read the aggregates directly, without scanning the event
+        history.
+
+        The events only update the aggregates in memory. A checkpoint thread writes them to a small JSON file every
+        CHECKPOINT_PERIOD seconds while they change, when asked to (the controller does so when it goes idle), and when
+        stopped. A power cut loses the counts of at most the last CHECKPOINT_PERIOD seconds.
+
+        A cooking session starts when the citizen turns on an appliance (StoveTurnsOn) and ends when it is turned off,
+        either by the citizen (StoveTurnsOff) or by the system (SystemTurnsStoveOff). If the system turns the appliance on
+        again, the time until it is turned off is added to the session. The time away from the kitchen is counted per
+        appliance in use, from CitizenLeftKitchen until the citizen enters the kitchen again or the appliance is turned off.
+        Sessions and time away are kept per appliance, by the device id of its plug, and accounted to the day and week
+        they started in.
+    """
+
+    COUNTERS = ("sessions", "session_seconds", "away_count", "away_seconds",
+                "notify", "limit", "upper", "system_off", "system_on")
+    ESCALATIONS = {"Notify": "notify", "Limit": "limit", "Upper": "upper"}
+    RETENTION_DAYS = 400
+    RETENTION_WEEKS = 60
+    CHECKPOINT_PERIOD = 10      #Seconds between the checkpoints while the aggregates change
+
+    def __init__(self, path: str):
+        """
+            Loads the aggregates from the checkpoint file at path, if it exists.
+        """
+        self.path = path
+        self.__lock = Lock()
+        self.__write_lock = Lock()
+        self.__dirty = False
+        self.__wake = Event()
+        self.__stop = Event()
+        self.__thread: Optional[Thread] = None
+        self.__days: Dict[str, Dict[str, float]] = {}
+        self.__weeks: Dict[str, Dict[str, float]] = {}
+        #[start, key] of the open session of each appliance: the time the stove was last turned on (None while the system
+        #has turned it off), and the time the session started in
+        self.__sessions: Dict[Optional[str], List[Optional[float]]] = {}
+        self.__away: Dict[Optional[str], float] = {}
+
+        data = AtomicFile.Read(path)
+        if data:
+            checkpoint = JsonCodec.loads(data)
+            self.__days = checkpoint["days"]
+            self.__weeks = checkpoint["weeks"]
+            self.__sessions = {device_id: [start, key] for device_id, start, key in checkpoint.get("sessions", [])}
+            self.__away = {device_id: start for device_id, start in checkpoint.get("away", [])}
+
+    @staticmethod
+    def Day_Key(timestamp: float) -> str:
+        return date.fromtimestamp(timestamp).isoformat()
+
+    @staticmethod
+    def Week_Key(timestamp: float) -> str:
+        year, week, _ = date.fromtimestamp(timestamp).isocalendar()
+        return f"{year}-W{week:02d}"
+
+    def Record(self, event_type, timestamp: float, device_id: Optional[str] = None) -> None:
+        """
+            Updates the aggregates with a HEUCOD event about device_id. Only the name of the event type is used.
+        """
+        name = getattr(event_type, "name", event_type)
+
+        with self.__lock:
+            if name == "StoveTurnsOn":
+                self.__add(timestamp, "sessions", 1)
+                self.__sessions[device_id] = [timestamp, timestamp]
+
+            elif name == "SystemTurnsStoveOn":
+                self.__add(timestamp, "system_on", 1)
+                #The session continues, but only counts the time from now on
+                if device_id in self.__sessions:
+                    self.__sessions[device_id][0] = timestamp
+
+            elif name in ("StoveTurnsOff", "SystemTurnsStoveOff"):
+                if name == "SystemTurnsStoveOff":
+                    self.__add(timestamp, "system_off", 1)
+                self.__close_session(device_id, timestamp, end=(name == "StoveTurnsOff"))
+                self.__close_away(device_id, timestamp)
+
+            elif name == "CitizenLeftKitchen":
+                #The citizen is away from every appliance in use. Their events are about the kitchen sensor
+                for appliance in self.__sessions:
+                    self.__away.setdefault(appliance, timestamp)
+
+            elif name == "CitizenEnteredKitchen":
+                for appliance in list(self.__away):
+                    self.__close_away(appliance, timestamp)
+
+            else:
+                return
+
+            self.__dirty = True
+
+    def Record_Escalation(self, level: str, timestamp: float, device_id: Optional[str] = None) -> None:
+        """
+            Counts an escalation of the Away Timer of the appliance behind device_id (Notify, Limit or Upper).
+        """
+        if level not in self.ESCALATIONS:
+            return
+
+        with self.__lock:
+            self.__add(timestamp, self.ESCALATIONS[level], 1)
+            if level == "Upper":
+                #The appliance is given up, so its session and time away can no longer be followed
+                self.__close_session(device_id, timestamp, end=True)
+                self.__close_away(device_id, timestamp)
+            self.__dirty = True
+
+    def Start(self) -> None:
+        """
+            Starts the checkpoint thread.
+        """
+        if self.__thread is None:
+            self.__stop.clear()
+            self.__thread = Thread(target=self.__checkpointer, name="Usage checkpoint", daemon=True)
+            self.__thread.start()
+            atexit.register(self.Stop)
+
+    def Stop(self) -> None:
+        """
+            Stops the checkpoint thread and writes the last changes.
+        """
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__wake.set()
+            self.__thread.join()
+            self.__thread = None
+        self.Checkpoint()
+
+    def Request_Checkpoint(self) -> None:
+        """
+            Has the checkpoint thread write the changes now, without waiting for it.
+        """
+        self.__wake.set()
+
+    def Checkpoint(self) -> None:
+        """
+            Writes the aggregates to the checkpoint file, if they changed since the last checkpoint.
+        """
+        with self.__write_lock:
+            with self.__lock:
+                if not self.__dirty:
+                    return
+                checkpoint = {"days": self.__days, "weeks": self.__weeks,
+                              "sessions": [[device_id, start, key] for device_id, (start, key) in self.__sessions.items()],
+                              "away": [[device_id, start] for device_id, start in self.__away.items()]}
+                data = JsonCodec.dumps(checkpoint)
+                self.__dirty = False
+            try:
+                AtomicFile.Write(self.path, data)
+            except OSError:
+                self.__dirty = True
+                raise
+
+    def Day(self, day: str) -> Dict[str, float]:
+        """
+            Returns the aggregates of a day given as "YYYY-MM-DD", including averages.
+        """
+        with self.__lock:
+            return self.__summary(self.__days.get(day))
+
+    def Week(self, week: str) -> Dict[str, float]:
+        """
+            Returns the aggregates of an ISO week given as "YYYY-Www", including averages.
+        """
+        with self.__lock:
+            return self.__summary(self.__weeks.get(week))
+
+    def Today(self) -> Dict[str, float]:
+        return self.Day(self.Day_Key(datetime.now().timestamp()))
+
+    def This_Week(self) -> Dict[str, float]:
+        return self.Week(self.Week_Key(datetime.now().timestamp()))
+
+    def __summary(self, counters: Optional[Dict[str, float]]) -> Dict[str, float]:
+        summary = dict.fromkeys(self.COUNTERS, 0)
+        summary.update(counters or {})
+        summary["average_session_minutes"] = \
+            summary["session_seconds"] / summary["sessions"] / 60 if summary["sessions"] else 0.0
+        summary["average_away_minutes"] = \
+            summary["away_seconds"] / summary["away_count"] / 60 if summary["away_count"] else 0.0
+        return summary
+
+    def __close_session(self, device_id: Optional[str], timestamp: float, end: bool) -> None:
+        """
+            Adds the time the appliance has been on to its session's day and week. When end is False the session is only
+            paused (the system turned the appliance off, and may turn it on again).
+        """
+        session = self.__sessions.get(device_id)
+        if session is None:
+            return
+        start, key = session
+        if start is not None:
+            self.__add(key, "session_seconds", max(0, timestamp - start))
+            session[0] = None
+        if end:
+            del self.__sessions[device_id]
+
+    def __close_away(self, device_id: Optional[str], timestamp: float) -> None:
+        start = self.__away.pop(device_id, None)
+        if start is not None:
+            self.__add(start, "away_count", 1)
+            self.__add(start, "away_seconds", max(0, timestamp - start))
+
+    def __add(self, timestamp: float, counter: str, value: float) -> None:
+        day, week = self.Day_Key(timestamp), self.Week_Key(timestamp)
+
+        if day not in self.__days:
+            self.__days[day] = {}
+            self.__prune(self.__days, self.RETENTION_DAYS)
+        if week not in self.__weeks:
+            self.__weeks[week] = {}
+            self.__prune(self.__weeks, self.RETENTION_WEEKS)
+
+        for counters in (self.__days[day], self.__weeks[week]):
+            counters[counter] = counters.get(counter, 0) + value
+
+    @staticmethod
+    def __prune(buckets: Dict[str, Dict[str, float]], retention: int) -> None:
+        #Only runs when a new day or week starts. Keys are ISO formatted, so the oldest key is the smallest.
+        while len(buckets) > retention:
+            del buckets[min(buckets)]
+
+    def __checkpointer(self) -> None:
+        while not self.__stop.is_set():
+            self.__wake.wait(self.CHECKPOINT_PERIOD)
+            self.__wake.clear()
+            try:
+                self.Checkpoint()
+            except OSError as error:
+                log.warning("Writing the usage aggregates failed", path=self.path, error=error, throttle="usage_checkpoint")
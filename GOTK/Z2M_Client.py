@@ -1,10 +1,21 @@
+import time
 import queue
-import json
-from typing import Callable, List, Optional
-from threading import Thread, Event
-from paho.mqtt.client import Client as MqttClient, MQTTMessage
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+from threading import Thread, Event, Lock
+
+#paho is imported when the client is created, so importing this module does not load it
+if TYPE_CHECKING:
+    from paho.mqtt.client import MQTTMessage
 
 from Z2M_Message import Z2M_Message
+from JsonCodec import JsonCodec
+from PriorityEventQueue import PriorityEventQueue
+from BridgeHealth import BridgeHealth
+from CommandScheduler import CommandScheduler
+from TrafficCapture import TrafficCapture
+from SystemLog import SystemLog
+
+log = SystemLog.get("Z2M")
 
 
 class Z2M_Client:
@@ -13,28 +24,92 @@ class Z2M_Client:
         When it receives a message from a topic it puts the message in the event queue. If there are messages in the event queue, 
         a callback is set to process the received messages. This callback is blocking, meaning once the subscriber receives
         an event and invokes the callback, no new events will be processed.
+        
+        The event queue has priority lanes. Each message is put in the lane of its device when it arrives, and the worker always
+        takes the messages of the higher lanes first, so stove related messages do not wait behind bridge logs and light echoes.
+        
+        A health thread publishes health checks to the bridge (see BridgeHealth). When the broker is lost or stops responding,
+        it reconnects with jittered exponential back-off, and the subscriptions are restored when the connection is up.
+        Actuator commands given while disconnected or while the bridge reports that it is offline are kept, the latest per device,
+        and handed to the CommandScheduler when the bridge can be reached again. A kept OFF command is handed over after
+        OFF_TIMEOUT in any case, so an appliance is never left on for longer because of a stale health state.
+        
+        Commands to the devices are published by a CommandScheduler, within an airtime budget and with actuator commands first.
+        
+        The power reporting of the plugs is reconfigured through the bridge (see Configure_Reporting), so they report often
+        while their appliance is in use and rarely otherwise.
+        
+        In capture mode every received message is also written to a TrafficCapture, without blocking the receive thread.
     """
     
     # Default topic
     ROOT_TOPIC = "zigbee2mqtt/#"
+    TOPIC_PREFIX = "zigbee2mqtt/"
+    
+    # Health check topics, and the bridge state
+    HEALTH_REQUEST_TOPIC = "zigbee2mqtt/bridge/request/health_check"
+    HEALTH_RESPONSE_TOPIC = "zigbee2mqtt/bridge/response/health_check"
+    BRIDGE_STATE_TOPIC = "zigbee2mqtt/bridge/state"
+    HEALTH_POLL = 0.5
+    OFF_TIMEOUT = 5         #Seconds a kept OFF command waits for the bridge before it is scheduled anyway
+    
+    # Power reporting of the plugs for each reporting profile. Intervals are in seconds, the reportable change is in the
+    # raw units of the plug's active power attribute. The topics are those of Zigbee2MQTT 1.x
+    REPORTING_REQUEST_TOPIC = "zigbee2mqtt/bridge/request/device/configure_reporting"
+    REPORTING_RESPONSE_TOPIC = "zigbee2mqtt/bridge/response/device/configure_reporting"
+    REPORTING = {"Fast": {"minimum_report_interval": 1, "maximum_report_interval": 5, "reportable_change": 1},
+                 "Sparse": {"minimum_report_interval": 5, "maximum_report_interval": 300, "reportable_change": 5}}
     
-    def __init__(self, host: str, on_message_callback: Callable[[Optional[Z2M_Message]], None], port: int = 1883, topics: List[str] = [ROOT_TOPIC]):
+    # Settings published to the lights for each light state
+    LIGHT_STATES = {"Dim": {"brightness": 10, "effect": "finish_effect"},
+                    "Limit": {"brightness": 10, "effect": "breathe"},
+                    "Notify": {"brightness": 5, "effect": "breathe"},
+                    "On": {"brightness": 1, "effect": "finish_effect"},
+                    "Off": {"brightness": 0, "effect": "finish_effect"}}
+    
+    def __init__(self, host: str, on_message_callback: Callable[[Optional[Z2M_Message]], None], port: int = 1883, topics: List[str] = [ROOT_TOPIC],
+                 lanes: Optional[Dict[str, int]] = None, commands_per_second: float = CommandScheduler.COMMANDS_PER_SECOND,
+                 capture: Optional[TrafficCapture] = None):
         """
             Initializes the Z2M Client with the specified MQTT broker's host and port, the list of topics
-            to subscribe and a callback to handle events from zigbee2mqtt.
+            to subscribe and a callback to handle events from zigbee2mqtt. lanes maps device IDs to the priority
+            lane of their messages (see PriorityEventQueue), all other messages go in the background lane.
+            commands_per_second is the airtime budget of the commands published to the devices.
+            capture is an optional TrafficCapture receiving every message.
         """
         
-        self.__client = MqttClient()
+        from paho.mqtt.client import Client as MqttClient
+        
+        # Reconnecting is left to the health thread, which backs off with jitter
+        self.__client = MqttClient(reconnect_on_failure=False)
         self.__client.on_connect = self.__on_connect
         self.__client.on_disconnect = self.__on_disconnect
         self.__client.on_message = self.__on_message
         self.__connected = False
-        self.__events_queue = queue.Queue()
+        self.__events_queue = PriorityEventQueue()
+        self.__lanes = {f"{self.TOPIC_PREFIX}{device_id}": lane for device_id, lane in (lanes or {}).items()}
         self.__host = host
         self.__port = port
         self.__on_message_callback = on_message_callback        
         self.__stop_worker = Event()
         self.__topics = topics
+        self.__health = BridgeHealth()
+        self.__reconnect_at = 0.0
+        self.__pending_commands: Dict[str, Tuple[bytes, float]] = {}
+        self.__pending_lock = Lock()
+        self.__pending_reporting: Dict[str, bytes] = {}
+        self.__scheduler = CommandScheduler(self.__publish_command, commands_per_second)
+        self.__capture = capture
+        
+        # The health check topics are subscribed as well, unless the root topic covers them
+        self.__subscriptions = list(topics)
+        if self.ROOT_TOPIC not in topics:
+            self.__subscriptions += [self.HEALTH_REQUEST_TOPIC, self.HEALTH_RESPONSE_TOPIC, self.BRIDGE_STATE_TOPIC,
+                                     self.REPORTING_RESPONSE_TOPIC]
+        
+        # The light and actuator payloads never change, so they are encoded once instead of on every call
+        self.__light_payloads = {state: JsonCodec.dumps(settings) for state, settings in self.LIGHT_STATES.items()}
+        self.__actuator_payloads = {state: JsonCodec.dumps({"state": state}) for state in ("ON", "OFF")}
         
     def connect(self):
         """
@@ -44,95 +119,261 @@ class Z2M_Client:
         if self.__connected:
             return
         
-        # Connects to the host.
+        # Connects to the host. The topics are subscribed when the connection is established, see __on_connect.
         self.__client.connect(self.__host, self.__port)
         self.__client.loop_start()
-        
-        # Subscribe to all topics given in initializer.
-        for t in self.__topics:
-            self.__client.subscribe(t)
 
-        #Clears __stop_worker event flag, initializes subscriber thread, and starts the thread 
+        #Clears __stop_worker event flag, initializes subscriber and health threads, and starts the threads
         self.__stop_worker.clear()
-        self.__subscriber_thread = Thread(target=self.__worker, daemon=True)
+        self.__subscriber_thread = Thread(target=self.__worker, name="Z2M worker", daemon=True)
         self.__subscriber_thread.start()
+        self.__health_thread = Thread(target=self.__health_worker, name="Z2M health", daemon=True)
+        self.__health_thread.start()
+        self.__scheduler.Start()
+        if self.__capture is not None:
+            self.__capture.Start()
         
     
     def disconnect(self):
         """
             Disconnects from the MQTT broker.
         """
-        # Sets event and thereby stops worker.
+        # Sets event and wakes the worker, which thereby stops. The health thread is stopped first, so it does not reconnect,
+        # and the scheduler publishes its pending commands, including those of the worker's last message.
         self.__stop_worker.set()
-        self.__client.loop_stop()
-        
-        #Test if thread is dealt with ----
-        if self.__subscriber_thread.is_alive():
-            print("Sub Thread is alive - join!")
-            self.__subscriber_thread.join()
-        else:
-            print("Worker Should be stopped")
+        self.__events_queue.Wake()
+        self.__health_thread.join()
+        self.__subscriber_thread.join()
+        self.__scheduler.Stop()
                 
         # Unsubscribe from all topics given in initializer.
-        for t in self.__topics:
+        for t in self.__subscriptions:
             self.__client.unsubscribe(t)
         
-        # Disconnects client
+        # Disconnects client, and writes the rest of the capture. The network loop sends the queued messages and the
+        # disconnect and then ends, instead of waiting for its next timeout as it would when stopped first.
         self.__client.disconnect()
+        self.__client.loop_stop()
+        self.__health.Closed()
+        
+        #Commands kept for this session are not replayed in a later one
+        with self.__pending_lock:
+            self.__pending_commands.clear()
+        if self.__capture is not None:
+            self.__capture.Stop()
           
     def Actuator_Controls(self, device_id : str, state : str):
         """
             Method to publish changes to the Actuator state.  The device_id is used to publish to the right topic
-            and sets the state to the specified state.
+            and sets the state to the specified state. If the client is disconnected or the bridge is offline, the command
+            is kept and scheduled when the bridge can be reached again, or after OFF_TIMEOUT if it turns the device off.
         """
-        if not self.__connected:
-            pass
+        payload = self.__actuator_payloads.get(state) or JsonCodec.dumps({"state": f"{state}"})
         
-        self.__client.publish(topic=f"zigbee2mqtt/{device_id}/set", payload=json.dumps({"state": f"{state}"}))
+        #Under the lock, so a command is neither buffered after the buffer was scheduled on recovery, nor superseded by
+        #an older buffered one
+        with self.__pending_lock:
+            if not self.__health.Reachable:
+                self.__pending_commands[device_id] = (payload, time.monotonic())
+                log.warning("Actuator command buffered until the bridge recovers", device=device_id, state=state)
+                return
+            self.__scheduler.Submit(device_id, payload, CommandScheduler.ACTUATOR)
     
     def Light_Controls(self, light_state : str, device_id : str):
         """
             Method to publish changes to the Light devices. The method uses the device_id to identify which device to publish to
             and the light_state to choose which settings the light should be given.
         """
+        payload = self.__light_payloads.get(light_state)
+        if payload is not None:
+            self.__scheduler.Submit(device_id, payload, CommandScheduler.LIGHT)
+
+    def Configure_Reporting(self, device_id: str, profile: str):
+        """
+            Sets the power reporting of a plug to a profile in REPORTING: "Fast" while its appliance is in use, so an
+            appliance turned off is noticed quickly, and "Sparse" otherwise, which spares the broker and the mesh. A request
+            made while disconnected is published when the connection is up, unless a later request replaces it.
+        """
+        payload = JsonCodec.dumps(dict(self.REPORTING[profile], id=device_id, cluster="haElectricalMeasurement",
+                                       attribute="activePower"))
+        with self.__pending_lock:
+            if not self.__connected:
+                self.__pending_reporting[device_id] = payload
+                return
+            self.__pending_reporting.pop(device_id, None)
+        self.__client.publish(topic=self.REPORTING_REQUEST_TOPIC, payload=payload)
+        log.debug("Power reporting configured", device=device_id, profile=profile)
+
+    def Lane_Stats(self) -> Dict[str, Dict[str, float]]:
+        """
+            Returns the queueing latency statistics and depth of each priority lane of the event queue.
+        """
+        return self.__events_queue.Stats()
+
+    def Health(self) -> Dict[str, Optional[float]]:
+        """
+            Returns the health of the broker and bridge: round trip times, number of outages and the time to recover.
+        """
+        metrics = self.__health.Metrics()
+        metrics["buffered_commands"] = len(self.__pending_commands)
+        return metrics
+
+    def Command_Stats(self) -> Dict[str, Dict[str, float]]:
+        """
+            Returns the number of sent, deferred and dropped commands of the actuators and the lights.
+        """
+        return self.__scheduler.Metrics()
+
+    def __publish_command(self, device_id: str, payload: bytes) -> bool:
+        """
+            Publishes a command from the scheduler. Returns False if the command was not published because the client is
+            disconnected, so the scheduler tries it again.
+        """
         if not self.__connected:
-            pass
-        
-        if light_state == "Dim": 
-            self.__client.publish(topic=f"zigbee2mqtt/{device_id}/set", 
-                                  payload=json.dumps({"brightness": 10, "effect": "finish_effect"}))
-            
-        elif light_state == "Limit":
-            self.__client.publish(topic=f"zigbee2mqtt/{device_id}/set", 
-                                  payload=json.dumps({"brightness": 10, "effect": "breathe"}))
-    
-        elif light_state == "Notify":
-            self.__client.publish(topic=f"zigbee2mqtt/{device_id}/set", 
-                                  payload=json.dumps({"brightness": 5, "effect": "breathe"}))
-    
-        elif light_state == "On":
-            self.__client.publish(topic=f"zigbee2mqtt/{device_id}/set", 
-                                  payload=json.dumps({"brightness": 1, "effect": "finish_effect"}))
-            
-        elif light_state == "Off":
-            self.__client.publish(topic=f"zigbee2mqtt/{device_id}/set", 
-                                  payload=json.dumps({"brightness": 0, "effect": "finish_effect"}))
+            return False
+        #rc is MQTT_ERR_SUCCESS (0) if the command was queued, or e.g. MQTT_ERR_NO_CONN if the connection was just lost
+        return self.__client.publish(topic=f"zigbee2mqtt/{device_id}/set", payload=payload).rc == 0
 
-    def __on_message(self, client, userdata, message: MQTTMessage):
+    def __on_message(self, client, userdata, message: "MQTTMessage"):
         """ Callback invoked when a message has been received on a topic that the client subscribed.
         """
-        #Push a message to the queue
-        self.__events_queue.put(message)
+        if self.__capture is not None:
+            self.__capture.Record(message.topic, message.payload, time.time())
+        
+        #Health checks are handled right away, so their round trip does not include the time in the queue
+        if message.topic == self.HEALTH_REQUEST_TOPIC:
+            self.__health.Request_Returned(time.monotonic())
+            return
+        if message.topic == self.HEALTH_RESPONSE_TOPIC:
+            self.__health_response(message.payload)
+            return
+        if message.topic == self.REPORTING_RESPONSE_TOPIC:
+            self.__reporting_response(message.payload)
+            return
+        if message.topic == self.BRIDGE_STATE_TOPIC:
+            self.__bridge_state(message.payload)
+        
+        #Push a message to the lane of its device. Only the device's own topic is prioritized, not e.g. its availability
+        self.__events_queue.put(message, self.__lanes.get(message.topic, PriorityEventQueue.BACKGROUND))
 
     def __on_connect(self, client, userdata, flags, rc):
         """ Callback invoked when a connection with the MQTT broker is established. """
-        # Set connected flag to true.
+        if rc != 0:
+            log.warning("Connection refused by the broker", rc=rc)
+            return
+        
+        # Set connected flag to true, and subscribe to all topics. This restores the subscriptions after a reconnect.
         self.__connected = True
+        for t in self.__subscriptions:
+            self.__client.subscribe(t)
+        self.__health.Connected(time.monotonic())
+        
+        # Reporting requests made while disconnected
+        with self.__pending_lock:
+            reporting = list(self.__pending_reporting.values())
+            self.__pending_reporting.clear()
+        for payload in reporting:
+            self.__client.publish(topic=self.REPORTING_REQUEST_TOPIC, payload=payload)
         
     def __on_disconnect(self, client, userdata, rc):
         """ Callback invoked when the client disconnects from the MQTT broker. """
-        # Set connected flag to false.
+        # Set connected flag to false. Unless disconnect() was called, the health thread reconnects.
         self.__connected = False
+        if not self.__stop_worker.is_set():
+            self.__health.Disconnected(time.monotonic())
+            log.warning("Disconnected from the broker", rc=rc)
+
+    def __health_response(self, payload: bytes):
+        try:
+            response = JsonCodec.loads(payload)
+            healthy = response.get("status") == "ok" and response.get("data", {}).get("healthy", False)
+        except (ValueError, AttributeError):
+            healthy = False
+        
+        time_to_recover = self.__health.Response_Received(time.monotonic(), healthy)
+        if time_to_recover is not None:
+            log.info("Broker and bridge recovered", time_to_recover_ms=round(time_to_recover * 1000, 1),
+                     rtt_ms=self.__health.Metrics()["bridge_rtt_ms"])
+        if self.__health.Reachable:
+            self.__publish_pending(time.monotonic())
+
+    def __reporting_response(self, payload: bytes):
+        try:
+            response = JsonCodec.loads(payload)
+            ok = response.get("status") == "ok"
+        except (ValueError, AttributeError):
+            response, ok = {}, False
+        if not ok:
+            log.warning("Power reporting was not configured", error=response.get("error"), throttle="reporting_failed")
+
+    def __bridge_state(self, payload: bytes):
+        #The bridge publishes its state as "online"/"offline", or as {"state": "online"} since Zigbee2MQTT 1.29
+        state = payload.decode("utf-8", "replace").strip()
+        if state.startswith("{"):
+            try:
+                state = JsonCodec.loads(payload).get("state", "")
+            except (ValueError, AttributeError):
+                return
+        self.__health.Bridge_State(time.monotonic(), state == "online")
+        if state != "online":
+            log.warning("Bridge is offline", state=state)
+
+    def __publish_pending(self, now: float):
+        """
+            Hands the buffered actuator commands to the scheduler once the bridge can be reached, and the OFF commands
+            that have waited OFF_TIMEOUT in any case. The scheduler retries a command that cannot be published yet.
+        """
+        with self.__pending_lock:
+            reachable = self.__health.Reachable
+            for device_id, (payload, since) in list(self.__pending_commands.items()):
+                if reachable or (payload == self.__actuator_payloads["OFF"] and now - since >= self.OFF_TIMEOUT):
+                    del self.__pending_commands[device_id]
+                    self.__scheduler.Submit(device_id, payload, CommandScheduler.ACTUATOR)
+                    log.info("Buffered actuator command scheduled", device=device_id, reachable=reachable)
+
+    def __reconnect(self):
+        """
+            Reconnects to the broker. The network loop has stopped when the connection was lost, so it is restarted.
+        """
+        self.__reconnect_at = time.monotonic() + self.__health.Next_Backoff()
+        self.__client.loop_stop()
+        try:
+            self.__client.reconnect()
+        except OSError as error:
+            log.warning("Reconnect failed", error=str(error),
+                        retry_in=round(self.__reconnect_at - time.monotonic(), 1), throttle="reconnect")
+            return
+        self.__client.loop_start()
+
+    def __health_worker(self):
+        """
+        This method publishes the health checks, detects a stale broker or bridge, and reconnects to the broker. It is stopped
+        together with the subscriber thread.
+        """
+        while not self.__stop_worker.wait(self.HEALTH_POLL):
+            now = time.monotonic()
+            if self.__pending_commands:
+                self.__publish_pending(now)
+            
+            if not self.__connected:
+                if now >= self.__reconnect_at:
+                    self.__reconnect()
+                continue
+            
+            stale = self.__health.Stale(now)
+            if stale == "broker":
+                #The connection is half-open, so it is dropped and the broker is reconnected
+                log.warning("Broker did not return the health check, reconnecting")
+                self.__connected = False
+                self.__health.Disconnected(now)
+                self.__client.disconnect()
+                self.__reconnect_at = now
+            elif stale == "bridge":
+                log.warning("Bridge did not answer the health check", throttle="bridge_stale")
+            
+            if self.__health.Check_Due(now):
+                self.__health.Request_Sent(now)
+                self.__client.publish(topic=self.HEALTH_REQUEST_TOPIC, payload=b"")
     
     def __worker(self):
         """
@@ -143,11 +384,11 @@ class Z2M_Client:
         #Runs while the __stop_worker event is not set.
         while not self.__stop_worker.is_set():
             try:
-                message = self.__events_queue.get(timeout=1)
+                message = self.__events_queue.get()
             except queue.Empty:
-                # This exception is raised when the queue pull times out. Ignore it and retry
+                # This exception is raised when disconnect() wakes the worker. The loop condition then stops it
                 pass
             else: 
                 # If a message was successfully pulled from the queue, then process it.
                 if message:
-                    self.__on_message_callback(Z2M_Message(message.topic, message.payload.decode("utf-8")))
+                    self.__on_message_callback(Z2M_Message(message.topic, message.payload))
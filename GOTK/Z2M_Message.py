@@ -1,18 +1,19 @@
 import time
-import json
-from typing import Any, Callable, List, Optional
+from typing import Any, Callable, List, Optional, Union
 
 from Z2M_MessageType import Z2M_MessageType
+from JsonCodec import JsonCodec
 
 
 class Z2M_Message:
     """
         Message object
     """
-    def __init__(self, topic, message : str):
+    def __init__(self, topic, message : Union[bytes, str]):
         """
             Initializes the message object. It assigns the message topic, timestamp and type_. Depending on the message topic,
-            specific variables will be assigned values. 
+            specific variables will be assigned values. The message is the raw payload, which is parsed by the JSON codec
+            without decoding it first.
         """
         
         self.topic = topic
@@ -22,14 +23,14 @@ class Z2M_Message:
         #When topic is bridge/state, the state is assigned to the message
         if topic == "zigbee2mqtt/bridge/state":
             self.type_= Z2M_MessageType.BRIDGE_STATE 
-            self.state = message
+            self.state = message.decode("utf-8") if isinstance(message, bytes) else message
         
         #Topics bridge/event and bridge/logging, assigns variables data, message, and meta
         elif topic in ["zigbee2mqtt/bridge/event", "zigbee2mqtt/bridge/logging"]:
             self.type_ = {"zigbee2mqtt/bridge/event": Z2M_MessageType.BRIDGE_EVENT,
                         "zigbee2mqtt/bridge/logging": Z2M_MessageType.BRIDGE_LOG}.get(topic)
             
-            message_json = json.loads(message)
+            message_json = JsonCodec.loads(message)
             self.data = message_json.get("data")
             self.message = message_json.get("message")
             self.meta = message_json.get("meta")
@@ -43,19 +44,14 @@ class Z2M_Message:
                        "zigbee2mqtt/bridge/response/health_check"]:
             pass
 
-        #For sensor messages the occupancy variable is assigned.
-        elif "Sensor" in topic:
-            message_json = json.loads(message)        
-            self.source = f"Sensor {topic[19]}"
+        #Messages from the devices, zigbee2mqtt/<device>. The occupancy of sensors, the power and state of power plugs and the
+        #state and brightness of lights are assigned, so any number of devices are parsed alike.
+        elif topic.count("/") == 1:
+            message_json = JsonCodec.loads(message)
+            self.type_ = Z2M_MessageType.DEVICE_EVENT
+            self.source = topic.split("/")[1]
             
             self.occupancy = message_json.get("occupancy")
-
-        #For the Actuator messages the power and state variables are assigned.
-        elif "Actuator" in topic:
-            message_json = json.loads(message)
-            self.source = "Actuator"
             self.power = message_json.get("power")
             self.state = message_json.get("state")
-
-
-
+            self.brightness = message_json.get("brightness")